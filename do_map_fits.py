@@ -23,8 +23,8 @@ def savefits(ofile,spec,head):
 
     fits.writeto(ofile,data,header=head,clobber=True)
 
-#How to interpolate?  Note that only linear interpolation does the
-#errors properly, for now
+#How to interpolate?  Errors are propagated for any style, but linear
+#interpolation is the fastest
 istyle = sys.argv[3]
 
 #What spectrum to use as a reference?
@@ -61,6 +61,15 @@ if sys.argv[7] == 'chains':
     else:
         get_chains = False
 
+#time each stage of the fits? (optional)
+if len(sys.argv) > 8 and sys.argv[8] == 'profile':
+    get_profile = True
+    if os.path.isdir('profiles') == False:
+        os.system('mkdir profiles')
+else:
+    get_profile = False
+run_profiles = {'Delta':[], 'Gauss':[], 'Hermite':[]}
+
 #plt.ion()
 for spec in speclist:
     print spec
@@ -72,18 +81,23 @@ for spec in speclist:
     l = EmissionLine(s,window[0],[ window[1],window[2] ])
     l.set_interp(style=istyle)
 
+    profiles = {'Delta':Profile(), 'Gauss':Profile(), 'Hermite':Profile()}
     f   = RescaleModel(lref,kernel="Delta")
+    if get_profile: f.profile = profiles['Delta']
     try: 
-        chi2_delta,p_delta,frac_delta = metro_hast(1000,l,f,keep=False)
+#       Only shift and scale, so the posterior is calculated on a grid
+#       instead of with an MCMC (frac_delta is always 1)
+        chi2_delta,p_delta,frac_delta = delta_grid(l,f,keep=False)
         print frac_delta
     except:
         chi2_delta,p_delta,frac_delta = 999,{'shift':-99, 'scale':-99}, 0 
      
 
     f    = RescaleModel(lref,kernel="Gauss")
+    if get_profile: f.profile = profiles['Gauss']
  
     try: 
-#       keep = True returns the chain, which can be saved and used latter for getting model errors (mode_rescale.py).
+#       keep = True returns the chain, which can be saved and used latter for getting model errors (model_errors.py).
         chi2_gauss,p_gauss,frac_gauss,chain_gauss = metro_hast(5000,l,f,keep=True)
 #       Try this code to watch the chain as it progresses
 #        plt.ion()
@@ -108,7 +122,11 @@ for spec in speclist:
         chain_gauss.save('chains/'+spec+'.chain.gauss')
 
     
-    f    = RescaleModel(lref,kernel="Hermite")
+#    The scale is solved for at each step (scale_mode='profile'), so
+#    the chain only has to explore shift, width, h3, and h4---this
+#    converges in far fewer steps than sampling all 5 parameters.
+    f    = RescaleModel(lref,kernel="Hermite",scale_mode='profile')
+    if get_profile: f.profile = profiles['Hermite']
 #    Here is an example of how to put in a prior----we are using the
 #    posterior distribution of the kernel width from the pure Gaussian
 #    as a prior on the width for the Gauss-Hermite kernel.
@@ -126,7 +144,7 @@ for spec in speclist:
 #    f.make_func_prior('width', wprior, [1.8, 1.0] )
 
     try:
-        chi2_herm,p_herm,frac_herm,chain_herm = metro_hast(50000,l,f,keep=True)
+        chi2_herm,p_herm,frac_herm,chain_herm = metro_hast(20000,l,f,keep=True)
         print frac_herm
     except:
         chi2_herm,p_herm,frac_herm = 999, {'shift':99,'scale':-99,'width':-99,'h3':-99,'h4':-99}, 0 
@@ -156,6 +174,18 @@ for spec in speclist:
         chain_herm.save('chains/'+spec+'.chain.herm')
 
 
+    if get_profile:
+        save_profiles('profiles/'+spec+'.profile.json',profiles)
+        for key in profiles.keys():
+            run_profiles[key].append(profiles[key])
+
         
     plt.close('all')
 fout.close()
+
+if get_profile:
+    run_profiles = dict([ (key,Profile.combine(run_profiles[key])) for key in run_profiles.keys() ])
+    save_profiles('profiles/run.profile.json',run_profiles)
+    for key in sorted(run_profiles.keys()):
+        print key
+        print run_profiles[key].summary()
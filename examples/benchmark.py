@@ -0,0 +1,217 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import scipy as sp
+import numpy
+import matplotlib.pyplot as plt
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from StringIO import StringIO
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from spectrum import Spectrum,TextSpec,EmissionLine,linear_interp_error
+from sinc_interp import SincInterp
+from mapspec import RescaleModel,metro_hast,delta_grid,get_cc,get_covarmatrix
+from operators import clear_cache
+from synthetic import SyntheticSet
+
+"""
+Benchmarks for the main operations of mapspec: interpolation, error
+propagation, rebinning, emission line extraction, the rescaling
+likelihood for each kernel, and a do_map.py-style run.
+
+Each case is timed on the example data (mapspec_test/, MCG-08-11 and
+the [OIII] window) and on synthetic spectra with a range of pixel
+counts and numbers of epochs.  Results are saved as JSON, and can be
+compared to a saved baseline to flag regressions:
+
+python benchmark.py --out bench.json
+python benchmark.py --out new.json --baseline bench.json
+
+A case is a regression if its best time is slower than the baseline by
+more than the tolerance (default 20%); the exit status is then 1.
+"""
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def example_data():
+    d = os.path.join(here,'mapspec_test')
+    sref = TextSpec(os.path.join(d,'ref.smooth.txt'))
+    window = sp.genfromtxt(os.path.join(d,'oiii.window'))
+    epochs = [ TextSpec(os.path.join(d,f)) for f in sorted(os.listdir(d)) if f.startswith('mcg0811') ]
+    return sref,epochs,window
+
+def synthetic_data(npix,nepoch):
+    #see synthetic.py
+    S = SyntheticSet(npix=npix,seed=42)
+    epochs = [ S.epoch(S.draw(i)) for i in range(nepoch) ]
+    return S.reference(),epochs,S.window()
+
+def timeit(func,repeat):
+    #best and median time of repeat calls
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+    return {'min':min(times),'median':float(sp.median(times)),'repeat':repeat}
+
+def quiet(func):
+    #metro_hast prints progress---keep it out of the benchmark output
+    def wrapped():
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            return func()
+        finally:
+            sys.stdout = stdout
+    return wrapped
+
+def do_map_run(sref,epochs,window,nstep):
+    """
+    Same steps as do_map.py for each epoch, with nstep MCMC steps for
+    the Gauss and Gauss-Hermite kernels (nothing is written to disk).
+    """
+    lref = EmissionLine(sref,window[0],[window[1],window[2]])
+    for e in epochs:
+        s = _copy(e)
+        s0 = get_cc(sref.f,s.f,sref.wv,s.wv)
+        s.wv = s.wv - s0[0]
+        l = EmissionLine(s,window[0],[window[1],window[2]])
+
+        f = RescaleModel(lref,kernel='Delta')
+        delta_grid(l,f)
+        f = RescaleModel(lref,kernel='Gauss')
+        metro_hast(nstep,l,f)
+        f.output(s)
+        f = RescaleModel(lref,kernel='Hermite',scale_mode='profile')
+        metro_hast(nstep,l,f)
+        f.output(s)
+        plt.close('all')
+
+def cases(sref,epochs,window,nstep):
+    """
+    Dictionary of benchmark cases (functions with no arguments) for
+    one dataset.
+    """
+    s = epochs[0]
+    lref = EmissionLine(sref,window[0],[window[1],window[2]])
+    l = EmissionLine(s,window[0],[window[1],window[2]])
+
+    #new wavelengths, half a pixel off of the originals
+    xnew = s.wv[20:-20] + 0.5*(s.wv[1] - s.wv[0])
+    si = SincInterp(s.wv,s.f)
+    xrebin = s.wv[0] + 2*(s.wv[1] - s.wv[0])*sp.r_[0:s.wv.size//2 - 1]
+
+    k = RescaleModel(lref,kernel='Gauss')
+    k.p['width'] = 2.0
+    kernel = k._get_kernel(l.wv)
+
+    out = {}
+    out['sinc_interp'] = lambda: si(xnew.copy())
+    out['linear_interp_error'] = lambda: linear_interp_error(s.wv,xnew,s.ef)
+    #operators are cached, so clear the cache to time building them
+    out['get_covarmatrix'] = lambda: (clear_cache(),get_covarmatrix(l.wv,l.wv[5:-5] + 0.3,l.ef,kernel))
+    #rebin changes the spectrum, so work on a copy
+    out['rebin'] = lambda: _copy(s).rebin(xrebin)
+    out['emission_line'] = lambda: EmissionLine(s,window[0],[window[1],window[2]])
+    for kern in ['Delta','Gauss','Hermite']:
+        M = RescaleModel(lref,kernel=kern)
+        if kern != 'Delta':
+            M.p['width'] = 2.0
+        M.p['shift'] = 0.3
+        out['likelihood_'+kern] = (lambda M: lambda: M(l))(M)
+    out['do_map'] = quiet(lambda: do_map_run(sref,epochs,window,nstep))
+    return out
+
+def _copy(s):
+    c = Spectrum(style=s.style)
+    c.wv = s.wv.copy()
+    c.f = s.f.copy()
+    c.ef = s.ef.copy()
+    return c
+
+def run(npix_list,nepoch_list,repeat,nstep,skip_example=False):
+    results = {}
+    datasets = []
+    if not skip_example:
+        sref,epochs,window = example_data()
+        datasets.append(('example',sref,epochs,window))
+    for npix in npix_list:
+        for nepoch in nepoch_list:
+            sref,epochs,window = synthetic_data(npix,nepoch)
+            datasets.append(('npix=%d,nepoch=%d'%(npix,nepoch),sref,epochs,window))
+
+    for name,sref,epochs,window in datasets:
+        for case,func in sorted(cases(sref,epochs,window,nstep).items()):
+            #the full run is expensive, so only time it once
+            r = timeit(func,1 if case == 'do_map' else repeat)
+            r['npix'] = int(sref.wv.size)
+            r['nepoch'] = len(epochs)
+            key = '%s[%s]'%(case,name)
+            results[key] = r
+            print '%-45s %12.4e %12.4e'%(key,r['min'],r['median'])
+            sys.stdout.flush()
+    return results
+
+def compare(results,baseline,tol):
+    """
+    Print the ratio of each time to the baseline, and return the keys
+    that are slower by more than tol.
+    """
+    slow = []
+    print
+    print '%-45s %12s %12s %8s'%('case','baseline','now','ratio')
+    for key in sorted(results.keys()):
+        if key not in baseline:
+            continue
+        ratio = results[key]['min']/baseline[key]['min']
+        flag = ''
+        if ratio > 1 + tol:
+            slow.append(key)
+            flag = '  <--- slower'
+        print '%-45s %12.4e %12.4e %8.2f%s'%(key,baseline[key]['min'],results[key]['min'],ratio,flag)
+    return slow
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for mapspec')
+    parser.add_argument('--npix',default='500,2000,8000',
+                        help='comma separated pixel counts of the synthetic spectra')
+    parser.add_argument('--nepoch',default='3,10',
+                        help='comma separated numbers of synthetic epochs')
+    parser.add_argument('--repeat',type=int,default=5,help='number of timings of each case')
+    parser.add_argument('--nstep',type=int,default=200,help='MCMC steps for the do_map run')
+    parser.add_argument('--out',default='bench.json',help='output JSON file')
+    parser.add_argument('--baseline',default=None,help='JSON file of a previous run to compare with')
+    parser.add_argument('--tol',type=float,default=0.2,help='fractional slow down that counts as a regression')
+    parser.add_argument('--no-example',action='store_true',help='skip the example data')
+    args = parser.parse_args()
+
+    npix_list = [ int(n) for n in args.npix.split(',') if n ]
+    nepoch_list = [ int(n) for n in args.nepoch.split(',') if n ]
+    results = run(npix_list,nepoch_list,args.repeat,args.nstep,args.no_example)
+
+    out = {'meta':{'date':time.strftime('%c'),
+                   'python':platform.python_version(),
+                   'numpy':numpy.__version__,
+                   'scipy':sp.__version__,
+                   'platform':platform.platform(),
+                   'repeat':args.repeat,
+                   'nstep':args.nstep},
+           'results':results}
+    fout = open(args.out,'w')
+    json.dump(out,fout,indent=1,sort_keys=True)
+    fout.close()
+
+    if args.baseline is not None:
+        baseline = json.load(open(args.baseline))['results']
+        slow = compare(results,baseline,args.tol)
+        if len(slow) > 0:
+            print
+            print '%d regressions (more than %d%% slower)'%(len(slow),100*args.tol)
+            sys.exit(1)
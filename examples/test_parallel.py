@@ -0,0 +1,44 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import scipy as sp
+import json,glob,os,sys,shutil,tempfile
+sys.path.append('..')
+
+from runner import MapRunner,read_spec,run_parallel
+"""
+Checks that parallel runs (run_parallel) use the same options as a
+serial run, with the spectra in mapspec_test.  The chains are short,
+and the burn in is not the default, so the summaries of the chains
+(chains/*.summary.json) must have the same number of steps and of
+burn in steps either way.
+"""
+
+sref = read_spec('mapspec_test/ref.smooth.txt')
+window = sp.genfromtxt('mapspec_test/oiii.window')
+speclist = sorted(glob.glob('mapspec_test/mcg0811_00[12]_140110.txt'))
+opts = {'get_chains':True,'nstep_gauss':601,'nstep_herm':601,'burn':0.3,
+        'kernels':('Gauss','Hermite')}
+
+summaries = {}
+for nproc in [1,2]:
+    outdir = tempfile.mkdtemp(prefix='test_parallel')
+    runner = MapRunner(sref,window,outdir=outdir,**opts)
+    if nproc == 1:
+        runner._makedirs(outdir)
+        for spec in speclist:
+            runner.run(spec)
+    else:
+        run_parallel(runner,speclist,nproc)
+    summaries[nproc] = {}
+    for f in glob.glob(os.path.join(outdir,'chains','*.summary.json')):
+        s = json.load(open(f))
+        summaries[nproc][os.path.basename(f)] = (s['nstep'],s['nburn'])
+    shutil.rmtree(outdir)
+
+print 'chain, (nstep, nburn) serial, parallel'
+for name in sorted(summaries[1].keys()):
+    print name,summaries[1][name],summaries[2].get(name)
+assert len(summaries[1]) == 2*len(speclist)
+assert summaries[1] == summaries[2], 'serial and parallel summaries differ'
+print 'OK'
@@ -0,0 +1,45 @@
+import scipy as sp
+
+__all__ = ['get_grid','grid_index']
+
+
+def get_grid(x,rtol=1.e-8):
+    """
+    Check if the abcissas x are evenly spaced.  If so, returns a tuple
+    (start, step, n) that describes the grid, i.e., x = start +
+    step*arange(n).  Otherwise, returns None.
+
+    rtol is the tolerance on the spacing, as a fraction of the step.
+    """
+    if x is None or sp.size(x) < 2:
+        return None
+    n = x.size
+    dx = (x[-1] - x[0])/(n - 1.)
+    if dx <= 0:
+        return None
+    d = sp.diff(x)
+    if (sp.absolute(d - dx) > rtol*dx).any():
+        return None
+    return (x[0],dx,n)
+
+def grid_index(x,xnew,grid=None):
+    """
+    Locate xnew on the (sorted) abcissas x.  Returns the index i of
+    the next greater (or equal) point, such that x[i-1] < xnew <=
+    x[i], and the fractional offset f = (xnew - x[i-1])/(x[i] -
+    x[i-1]).  This is the same convention as sp.searchsorted, but i is
+    forced between 1 and x.size - 1 so that both neighbours exist.
+
+    If grid (from get_grid) is given, the index and offset are
+    computed arithmetically.  Otherwise, falls back to a (vectorized)
+    searchsorted.
+    """
+    if grid is not None:
+        x0,dx,n = grid
+        pos = (xnew - x0)/dx
+        i = sp.clip(sp.ceil(pos).astype(int),1,n - 1)
+        f = pos - (i - 1)
+    else:
+        i = sp.clip(sp.searchsorted(x,xnew),1,x.size - 1)
+        f = (xnew - x[i - 1])/(x[i] - x[i - 1])
+    return i,f
@@ -0,0 +1,42 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import scipy as sp
+from mapspec import Chain
+from priors import TabulatedPrior,save_priors
+import sys
+
+"""
+Tabulated priors from the chains of a run, for later epochs (see the
+'priors' option of do_map.py).  The samples of each parameter are
+pooled from all chains (after burn in), and the prior is a kernel
+density estimate (method=kde) or a histogram (method=hist) of them.
+"""
+
+args = [ a for a in sys.argv[1:] if '=' not in a ]
+opts = dict([ a.split('=',1) for a in sys.argv[1:] if '=' in a ])
+
+if len(args) < 3:
+    print 'Usage:'
+    print 'python  make_priors.py   priors.json  param1[,param2...]  chain1  [chain2 ...]  [method=kde]  [burn=0.5]'
+    print 'e.g., python make_priors.py priors.json width chains/*.chain.gauss'
+    sys.exit()
+
+pnames = args[1].split(',')
+method = opts.get('method','kde')
+burn = float(opts.get('burn',0.5))
+
+samples = dict([ (pname,[]) for pname in pnames ])
+for ifile in args[2:]:
+    C = Chain()
+    C.read(ifile)
+    pchain = C.pchain[int(burn*C.pchain.shape[0])::]
+    for pname in pnames:
+        samples[pname].append(pchain[:,C.index[pname]])
+
+priors = {}
+for pname in pnames:
+    x = sp.concatenate(samples[pname])
+    priors[pname] = TabulatedPrior.from_samples(x,method=method)
+    print '%s: %d samples, 16/50/84 percentiles %s'%(pname,x.size,sp.percentile(x,[16,50,84]))
+save_priors(args[0],priors)
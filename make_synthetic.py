@@ -0,0 +1,39 @@
+import scipy as sp
+from synthetic import *
+import sys
+
+"""
+Writes a synthetic data set (see synthetic.py): a reference spectrum
+(ref.txt), a window file (synth.window), epochs with known shift,
+scale, and Gauss-Hermite smoothing, a speclist, and the true
+parameters (truth.dat, with the width that fits with linear
+interpolation should find).  Run do_map.py on it like the real data, e.g.
+
+cd outdir
+python ../do_map.py ref.txt synth.window linear speclist mapspec.params no_covar chains
+"""
+
+if len(sys.argv) < 3:
+    print 'Usage:'
+    print 'python  make_synthetic.py   outdir  nepoch  [npix]  [snr]  [dx]  [format]  [seed]  [start]'
+    print 'outdir---  output directory (made if needed)'
+    print 'nepoch---  number of epochs'
+    print 'npix---  pixels per spectrum (default 1033)'
+    print 'snr---  continuum S/N per pixel of the epochs (default 50)'
+    print 'dx---  wavelength spacing in angstroms (default 1.25)'
+    print 'format---  text or fits (default text)'
+    print 'seed---  random seed of the data set (default 1)'
+    print 'start---  number of the first epoch, to add epochs to an existing data set (default 0)'
+    sys.exit()
+
+outdir = sys.argv[1]
+nepoch = int(sys.argv[2])
+npix   = int(sys.argv[3]) if len(sys.argv) > 3 else 1033
+snr    = float(sys.argv[4]) if len(sys.argv) > 4 else 50.
+dx     = float(sys.argv[5]) if len(sys.argv) > 5 else 1.25
+fmt    = sys.argv[6] if len(sys.argv) > 6 else 'text'
+seed   = int(sys.argv[7]) if len(sys.argv) > 7 else 1
+start  = int(sys.argv[8]) if len(sys.argv) > 8 else 0
+
+S = SyntheticSet(npix=npix,dx=dx,snr=snr,seed=seed)
+write_dataset(outdir,S,nepoch,fmt=fmt,start=start,verbose=True)
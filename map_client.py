@@ -0,0 +1,120 @@
+import socket
+import json
+import tempfile
+import sys,os
+
+"""
+Client for map_daemon.py: sends a rescaling job to the daemon and
+prints the results.  It only imports the standard library, so it
+starts quickly; the daemon has the reference and the fits in memory.
+
+python map_client.py ref.smooth.txt oiii.window spec1.txt [spec2.txt ...] [key=value ...]
+
+keys (defaults in brackets):
+
+istyle       --- interpolation style [linear]
+kernels      --- comma separated list of Delta, Gauss, Hermite [all 3]
+outdir       --- directory for the output spectra [current directory]
+params       --- append the fits to this parameter file, as do_map.py [none]
+covar        --- save covariance matrices (yes/no) [no]
+chains       --- save MCMC chains (yes/no) [no]
+store        --- save outputs to this RunStore instead of text files [none]
+dtype        --- float32 or float64, for the covariances in the store [float64]
+compress     --- compress the store (yes/no) [no]
+nstep_gauss  --- MCMC steps for the Gaussian kernel [5000]
+nstep_herm   --- MCMC steps for the Gauss-Hermite kernel [20000]
+select       --- bic or lrt, to only run the full Gauss-Hermite chain
+                 when a pilot chain justifies it (see do_map.py) [none]
+options      --- comma separated list of the other options of do_map.py
+                 for the fits, e.g., options=thin=10,burn=0.3,hmc (see
+                 runner.parse_options) [none]
+socket       --- path of the daemon's socket
+json         --- print the full JSON response (yes/no) [no]
+
+python map_client.py ping|status|shutdown [socket=path]
+"""
+
+def default_socket():
+    #same as map_daemon.default_socket
+    return os.path.join(tempfile.gettempdir(),'mapspec.%d.sock'%os.getuid())
+
+def send(job,path=None):
+    """
+    Sends one job to the daemon, and returns its response.
+    """
+    if path is None:
+        path = default_socket()
+    s = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    s.connect(path)
+    f = s.makefile('rw')
+    f.write(json.dumps(job)+'\n')
+    f.flush()
+    out = json.loads(f.readline())
+    f.close()
+    s.close()
+    return out
+
+
+if __name__ == '__main__':
+    args = [ a for a in sys.argv[1:] if '=' not in a ]
+    opts = dict([ a.split('=',1) for a in sys.argv[1:] if '=' in a ])
+    yes = lambda key: opts.get(key,'no').lower() in ['yes','true','1']
+
+    if len(args) == 1 and args[0] in ['ping','status','shutdown']:
+        job = {'cmd':args[0]}
+    elif len(args) >= 3:
+        #the daemon has its own working directory, so paths are absolute
+        absp = lambda p: None if p is None else os.path.abspath(p)
+        job = {'cmd':'rescale',
+               'ref':absp(args[0]),
+               'window':absp(args[1]),
+               'spec':[ absp(a) for a in args[2:] ],
+               'istyle':opts.get('istyle','linear'),
+               'kernels':opts.get('kernels','Delta,Gauss,Hermite').split(','),
+               'outdir':absp(opts.get('outdir','.')),
+               'params':absp(opts.get('params')),
+               'covar':yes('covar'),
+               'chains':yes('chains'),
+               'store':absp(opts.get('store')),
+               'dtype':opts.get('dtype','float64'),
+               'compress':yes('compress'),
+               'nstep_gauss':int(opts.get('nstep_gauss',5000)),
+               'nstep_herm':int(opts.get('nstep_herm',20000)),
+               'select':opts.get('select'),
+               'options':[ o for o in opts.get('options','').split(',') if o != '' ]}
+    else:
+        print 'Usage:'
+        print 'python  map_client.py   ref.txt  window  spec1.txt  [spec2.txt ...]  [key=value ...]'
+        print 'python  map_client.py   ping|status|shutdown  [socket=path]'
+        print 'keys---  istyle, kernels, outdir, params, covar, chains, store, dtype, compress,'
+        print '         nstep_gauss, nstep_herm, select, options, socket, json (see map_client.py)'
+        sys.exit()
+
+    try:
+        out = send(job,opts.get('socket'))
+    except socket.error as e:
+        print 'Cannot connect to the daemon (start it with python map_daemon.py):',e
+        sys.exit(1)
+
+    if yes('json') or job['cmd'] != 'rescale':
+        print json.dumps(out,indent=1)
+    elif not out['ok']:
+        print 'Error:',out['error']
+    else:
+        for r in out['results']:
+            if 'error' in r:
+                print '%s failed: %s'%(r['name'],r['error'])
+                continue
+            print '%s  %.1f s'%(r['name'],r['time'])
+            for key in job['kernels']:
+                p = r[key]
+                print '   %-8s'%key + '  '.join([ '%s=%.4g'%(k,p[k]) for k in sorted(p.keys()) ])
+            if r.get('select') is not None:
+                s = r['select']
+                print '   Gauss-Hermite %s: dchi2=%.2f threshold=%.2f, %d steps saved'%\
+                    ('run' if s['run'] else 'skipped',s['dchi2'],s['threshold'],s['steps_saved'])
+            for o in r['output']:
+                print '   ',o
+
+    if not out['ok'] or any([ 'error' in r for r in out.get('results',[]) ]):
+        sys.exit(1)
@@ -0,0 +1,185 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import scipy as sp
+from store import RunStore
+from runner import MapRunner,read_spec,params_line,parse_options
+from collections import OrderedDict
+import SocketServer
+import socket
+import json
+import traceback
+import tempfile
+
+import sys,os,time
+
+"""
+Worker daemon for quick-look rescaling.  It listens on a Unix socket
+for jobs from map_client.py, and keeps the imports, the reference
+spectra and their cross correlation tables, the run stores, and the
+cached operators in memory between jobs, so that a job only costs the
+fits.
+
+Jobs are run one at a time, in the order they arrive.  Each request
+and response is one line of JSON.  Requests have a 'cmd':
+
+rescale  --- fit spectra (see map_client.py for the fields)
+ping     --- check that the daemon is running
+status   --- references in memory, jobs done, and uptime
+shutdown --- stop the daemon
+
+The most recently used references are kept (maxref, default 8); a
+reference is reloaded if its file changes.
+"""
+
+def default_socket():
+    return os.path.join(tempfile.gettempdir(),'mapspec.%d.sock'%os.getuid())
+
+
+class MapServer(SocketServer.UnixStreamServer):
+    def __init__(self,path,maxref=8):
+        SocketServer.UnixStreamServer.__init__(self,path,MapHandler)
+        self.maxref = maxref
+        self.runners = OrderedDict()
+        self.stores = {}
+        self.njob = 0
+        self.nspec = 0
+        self.start = time.time()
+        self.done = False
+
+    def get_runner(self,ref,window,istyle,**kw):
+        """
+        MapRunner for reference file ref and window (file name or 3x2
+        list), with keywords kw.  The reference and its cross
+        correlation are read on the first request and kept.
+        """
+        if isinstance(window,basestring):
+            window = sp.genfromtxt(window)
+        window = sp.array(window,dtype=float)
+        key = (ref,os.path.getmtime(ref),tuple(window.ravel()),istyle)
+        if key in self.runners:
+            #most recently used goes to the end
+            runner = self.runners.pop(key)
+        else:
+            print 'loading reference',ref
+            runner = MapRunner(read_spec(ref,style=istyle),window,istyle)
+            while len(self.runners) >= self.maxref:
+                self.runners.popitem(last=False)
+        self.runners[key] = runner
+        return MapRunner(runner.sref,window,istyle,cc=runner.cc,**kw)
+
+    def get_store(self,path,dtype,compress):
+        key = (path,dtype,compress)
+        if key not in self.stores:
+            self.stores[key] = RunStore(path,dtype=sp.float32 if dtype == 'float32' else sp.float64,
+                                        compress=compress)
+        return self.stores[key]
+
+    def rescale(self,job):
+        #the same options as do_map.py, except the ones about the run
+        #(the store has its own fields, and jobs run one at a time)
+        kw,run = parse_options(job.get('options',[]))
+        if run['store'] or run['float32'] or run['compress'] or run['nproc'] > 1 or run['prefetch']:
+            raise ValueError('store, float32, compress, nproc, and prefetch are not job options')
+        if job.get('select') is not None:
+            kw['select'] = job['select']
+        if job.get('store') is not None:
+            store = self.get_store(job['store'],job.get('dtype','float64'),job.get('compress',False))
+        else:
+            store = None
+        runner = self.get_runner(job['ref'],job['window'],job.get('istyle','linear'),store=store,
+                                 get_covar=job.get('covar',False),get_chains=job.get('chains',False),
+                                 nstep_gauss=job.get('nstep_gauss',5000),nstep_herm=job.get('nstep_herm',20000),
+                                 **kw)
+        kernels = job.get('kernels',['Delta','Gauss','Hermite'])
+        outdir = job.get('outdir','.')
+
+        results = []
+        specs = job['spec'] if isinstance(job['spec'],list) else [job['spec']]
+        for spec in specs:
+            print spec
+            t0 = time.time()
+            try:
+                out = runner.run(spec,kernels=kernels,outdir=outdir)
+            except Exception as e:
+                traceback.print_exc()
+                results.append({'name':os.path.basename(spec),'error':str(e)})
+                continue
+            out['time'] = time.time() - t0
+            if job.get('params') is not None:
+                fout = open(job['params'],'a')
+                fout.write(params_line(out))
+                fout.close()
+            results.append(out)
+            self.nspec += 1
+        return {'ok':True,'results':results}
+
+    def status(self):
+        return {'ok':True,'refs':[ key[0] for key in self.runners.keys() ],
+                'jobs':self.njob,'spectra':self.nspec,'uptime':time.time() - self.start,
+                'pid':os.getpid()}
+
+
+class MapHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() == '':
+                continue
+            try:
+                job = json.loads(line)
+                cmd = job.get('cmd','rescale')
+                if cmd == 'rescale':
+                    out = self.server.rescale(job)
+                elif cmd == 'status':
+                    out = self.server.status()
+                elif cmd == 'ping':
+                    out = {'ok':True}
+                elif cmd == 'shutdown':
+                    self.server.done = True
+                    out = {'ok':True}
+                else:
+                    out = {'ok':False,'error':'Unknown command: '+cmd}
+            except Exception as e:
+                traceback.print_exc()
+                out = {'ok':False,'error':str(e)}
+            self.server.njob += 1
+            self.wfile.write(json.dumps(out)+'\n')
+            self.wfile.flush()
+            if self.server.done:
+                break
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ['-h','--help']:
+        print 'Usage:'
+        print 'python  map_daemon.py   [socket]  [maxref]'
+        print 'socket---  path of the Unix socket (default %s)'%default_socket()
+        print 'maxref---  number of references kept in memory (default 8)'
+        sys.exit()
+
+    path = sys.argv[1] if len(sys.argv) > 1 else default_socket()
+    maxref = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    #remove a socket left by a daemon that did not shut down cleanly
+    if os.path.exists(path):
+        s = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+            s.close()
+            print 'A daemon is already listening on',path
+            sys.exit(1)
+        except socket.error:
+            os.remove(path)
+
+    server = MapServer(path,maxref)
+    print 'listening on',path
+    sys.stdout.flush()
+    try:
+        while not server.done:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+    print 'stopped'
@@ -1,17 +1,28 @@
 import scipy as sp
 from scipy.integrate import simps
 from scipy import linalg
+from scipy.optimize import minimize
+from scipy.stats import chi2 as chi2_dist
 import matplotlib.gridspec as gridspec
 import matplotlib.pyplot as plt
 from spectrum import *
+from operators import interp_operator,convolve_operator,propagate_var,propagate_covar
+from profiling import Profile,save_profiles,null_stage
+from online import OnlineStats
+from priors import TabulatedPrior,prior_chi2,prior_dchi2,save_priors,load_priors
 from copy import deepcopy
 #these are 'probalists', turns out to matter in order to match van der
 #Marel & Franx 1993
 from numpy.polynomial.hermite_e import HermiteE as H
+from numpy import fft
+from grids import get_grid,grid_index
+import hashlib
 import re
+import json
+from time import time
 
 
-__all__ = ["RescaleModel","Chain","get_cc","metro_hast"]
+__all__ = ["RescaleModel","FourierRescaleModel","Chain","CrossCorr","get_cc","metro_hast","hmc","tempered","delta_grid","compare_kernels","propagate_chain","Profile","save_profiles"]
 
 debug = True
 
@@ -25,15 +36,29 @@ class RescaleModel(object):
     the full covariance matrix (fit_with_covar=True), or chi^2 is
     calculated from just data errors (fit_with_covar=False).
 
+    Without the covariance matrix, the scale factor can also be
+    solved for at each step instead of sampled
+    (scale_mode='profile' or 'marginal'), see _solve_scale.
+
+    Set self.profile = Profile() to time each stage of the likelihood
+    (see profiling.py).
+
     see do_map.py for examples of how to use.
     """
 
-    def __init__(self,Lref,kernel='Hermite',fit_with_covar=False):
+    def __init__(self,Lref,kernel='Hermite',fit_with_covar=False,scale_mode=None):
         """
         Constructs a rescaling model.  Needs a reference EmissionLine
         object, to which it will try to align data, a choice of
         functional form for the smoothing kernel, and if you want to
         use the covariance matrix during the fit.
+
+        scale_mode = None samples the scale like any other parameter.
+        'profile' uses the best scale for the current shift and
+        kernel, and 'marginal' integrates over the scale (Laplace
+        approximation).  In both cases, p['scale'] is the conditional
+        best scale and p['scale_err'] its uncertainty, so that they
+        are stored in the chain.
         """
         #this is an emission line object, to which we scale to 
         self.Lref = Lref  
@@ -44,6 +69,8 @@ class RescaleModel(object):
         #evaluates the prior probability at the input parameter.
         self.prior_prob = {}
         self.kernelname = kernel
+        #timing of each stage, off by default
+        self.profile = None
 
         if kernel == 'Delta':
             self._get_kernel = lambda x: sp.array([1.0])
@@ -71,6 +98,16 @@ class RescaleModel(object):
             self.set_scale = {'shift':0.05, 'scale':0.02, 'width':0.30,
                               'h3':0.03, 'h4':0.03}
 
+        if scale_mode not in [None,'profile','marginal']:
+            raise ValueError("scale_mode must be None, 'profile', or 'marginal'")
+        if scale_mode is not None and fit_with_covar:
+            raise ValueError("scale can only be solved for without the covariance matrix")
+        self.scale_mode = scale_mode
+        if scale_mode is not None:
+            #scale is not stepped, but solved for
+            self.set_scale['scale'] = 0.0
+            self.p['scale_err'] = 0.0
+
     def __call__(self,L):
         """
         Overloaded the __call__ method so that you just use the model
@@ -80,23 +117,64 @@ class RescaleModel(object):
 
         if self.use_covar:
             y,var,mask,covar  = self._get_yz(L)
-            lnlikely  = self._get_chi2_covar(y,covar,mask)
+            with self._stage('chi2'):
+                lnlikely  = self._get_chi2_covar(y,covar,mask)
+        elif self.scale_mode is not None:
+            lnlikely  = self._solve_scale(L)
         else:
             y,var,mask  = self._get_yz(L,getcovar=False)
-            lnlikely  = self._get_chi2(y,var,mask)
+            with self._stage('chi2'):
+                lnlikely  = self._get_chi2(y,var,mask)
 
-        lnlikely += self._add_priors()
+        with self._stage('priors'):
+            lnlikely += self._add_priors()
 
-        #take care of limited parameter space by setting prior
-        #probability to 0 [ -ln(prob) = inf]
-        lnlikely += self._prior_limits()
+            #take care of limited parameter space by setting prior
+            #probability to 0 [ -ln(prob) = inf]
+            lnlikely += self._prior_limits()
 
         return lnlikely
 
+    def _stage(self,name):
+        #times a block of code if profiling is on
+        if self.profile is None:
+            return null_stage
+        return self.profile.stage(name)
+
 
     def _get_chi2(self,y,v,m):
         return sp.sum(    (self.Lref.f[m] - y)**2/(self.Lref.ef[m]**2 + v))
 
+    def _solve_scale(self,L,niter=10,tol=1.e-8):
+        """
+        With data errors only, the model is linear in the scale s:
+
+        chi^2(s) = sum (r - s*y)**2/(er**2 + s**2*v)
+
+        where y and v are the shifted/smoothed data and variance for
+        s = 1.  The minimum is found with a few Newton steps (the
+        fixed point of the weighted least squares as a start), and
+        the conditional error on s is from the curvature, sqrt(2/chi^2'').
+
+        Sets p['scale'] and p['scale_err'], and returns the minimum
+        chi^2 ('profile'), or -2 ln of the likelihood integrated over
+        s ('marginal').
+        """
+        self.p['scale'] = 1.0
+        y,v,m = self._get_yz(L,getcovar=False)
+        with self._stage('chi2'):
+            s,chi2,d2 = _profile_scale(self.Lref.f[m],self.Lref.ef[m]**2,y,v,
+                                       niter=niter,tol=tol)
+        s,chi2,d2 = float(s),float(chi2),float(d2)
+
+        self.p['scale'] = s
+        self.p['scale_err'] = sp.sqrt(2./d2) if d2 > 0 else sp.inf
+        if self.scale_mode == 'marginal':
+            #Laplace approximation, int exp(-chi^2/2) ds
+            #= exp(-chi2min/2)*sqrt(2 pi)*scale_err
+            chi2 += sp.log(d2/(4*sp.pi)) if d2 > 0 else sp.inf
+        return chi2
+
     def _get_chi2_covar(self,y,C,m):
         vectoruse = sp.matrix(self.Lref.f[m] - y)
         Cuse = sp.matrix(C)
@@ -106,29 +184,76 @@ class RescaleModel(object):
     def _add_priors(self):
         prior = 0
         for key in self.prior_prob.keys():
-            prior += -2.*sp.log(
-                self.prior_prob[key](self.p[key]) 
-                )
+            prior += prior_chi2(self.prior_prob[key],self.p[key])
 
         return prior
 
 
-    def make_dist_prior(self,C,pname,burn = 0.5):
+    def make_dist_prior(self,C,pname,burn = 0.5,method='gauss',**kw):
+        """
+        Prior on pname from its distribution in Chain C, after
+        throwing out the first burn fraction.  method = 'gauss' is a
+        Gaussian with the median and 16th-84th percentile width of the
+        chain; 'kde' and 'hist' tabulate the distribution itself (see
+        priors.TabulatedPrior.from_samples for the keywords).
+        """
         params = sp.transpose(C.pchain)
         prior_dist = params[  C.index[pname]   ]
-        icut = prior_dist.size*burn
+        icut = int(prior_dist.size*burn)
         prior_dist = prior_dist[icut::]
         c1,m,c2 = sp.percentile(prior_dist,[16,50,84])
         print c1,m,c2
 
-        #will model the distribution as a  gaussian, for now....
-        self.prior_prob[pname] = lambda x: sp.exp(-0.5*(x - m)**2/ ( (c2-c1)/2 )**2 )
+        if method == 'gauss':
+            self.prior_prob[pname] = lambda x: sp.exp(-0.5*(x - m)**2/ ( (c2-c1)/2 )**2 )
+        else:
+            self.prior_prob[pname] = TabulatedPrior.from_samples(prior_dist,method=method,**kw)
         self.p[pname] = m
         
 
-    def make_func_prior(self,pname,func,params):
-        self.prior_prob[pname] = lambda x: func(x,params) 
+    def make_func_prior(self,pname,func,params,lo=None,hi=None):
+        """
+        Prior on pname from func(x,params), the prior probability.
+        With lo and hi, func is tabulated between them (it must work
+        on arrays), and is 0 outside.
+        """
+        if lo is None or hi is None:
+            self.prior_prob[pname] = lambda x: func(x,params) 
+        else:
+            self.prior_prob[pname] = TabulatedPrior.from_function(func,params,lo,hi)
 
+    def make_tab_prior(self,pname,prior):
+        """
+        Use TabulatedPrior prior (e.g., from priors.load_priors) for
+        pname.
+        """
+        self.prior_prob[pname] = prior
+
+    def save_priors(self,ofile):
+        """
+        Saves the tabulated priors (not the functions) to ofile, for
+        priors.load_priors.
+        """
+        save_priors(ofile,self.prior_prob)
+
+
+    def operator(self,S,xout=None):
+        """
+        The shift and convolution as a sparse matrix T, for the
+        current parameters, such that the output flux is
+        self.p['scale']*T*S.f, and the covariance is
+        self.p['scale']**2 T C T^T.
+
+        Output wavelengths are xout (default is S.wv), restricted to
+        where the shifted spectrum is defined---also returns this mask.
+        """
+        if xout is None:
+            xout = S.wv
+        s = deepcopy(S)
+        s.wv -= self.p['shift']
+        m = (xout >= s.wv.min()  )*(xout <= s.wv.max()  )
+        k = self._get_kernel(xout[m])
+        return convolve_operator(k,m.sum())*s.interp_operator(xout[m]),m
 
     def output(self,S,getcovar=True):
         """
@@ -145,10 +270,9 @@ class RescaleModel(object):
         #convolve
         k = self._get_kernel(S.wv[m])
         if getcovar:
-            if self.kernelname == 'Delta':
-                covar = get_covarmatrix(s.wv, S.wv[m], s.ef, k, 2)
-            else:
-                covar = get_covarmatrix(s.wv, S.wv[m], s.ef, k, 5*self.p['width'])
+            #exact propagation through the interpolation and convolution
+            T = convolve_operator(k,m.sum())*s.interp_operator(S.wv[m])
+            covar = propagate_covar(T,s.ef**2)
 
         z = sp.sqrt(sp.convolve(z**2,k**2,mode='same'))
         y = sp.convolve(y,k,mode='same')
@@ -177,24 +301,27 @@ class RescaleModel(object):
         sure everything is aligned.
         """
 
-        l = deepcopy(L)
+        with self._stage('shift'):
+            l = deepcopy(L)
 
-        #shift
-        l.wv -= self.p['shift']
+            #shift
+            l.wv -= self.p['shift']
         m = (self.Lref.wv >= l.wv.min() )*(self.Lref.wv <= l.wv.max() )
-        y,z = l.interp(self.Lref.wv[m])
+        with self._stage('interp'):
+            y,z = l.interp(self.Lref.wv[m])
         #convolve
-        k = self._get_kernel(self.Lref.wv[m])
+        with self._stage('kernel'):
+            k = self._get_kernel(self.Lref.wv[m])
 
         #have to make covar before smoothing z
         if getcovar:
-            if self.kernelname == 'Delta':
-                covar = get_covarmatrix(l.wv, self.Lref.wv[m], l.ef, k, 2)
-            else:
-                covar = get_covarmatrix(l.wv, self.Lref.wv[m], l.ef, k, 5*self.p['width'])
+            with self._stage('covar'):
+                T = convolve_operator(k,m.sum())*l.interp_operator(self.Lref.wv[m],cache=False)
+                covar = propagate_covar(T,l.ef**2)
 
-        z = sp.sqrt(sp.convolve(z**2,k**2,mode='same'))
-        y = sp.convolve(y,k,mode='same')
+        with self._stage('convolve'):
+            z = sp.sqrt(sp.convolve(z**2,k**2,mode='same'))
+            y = sp.convolve(y,k,mode='same')
 
         #scale
         z *= self.p['scale']
@@ -264,24 +391,216 @@ class RescaleModel(object):
 
         return k
 
+    def _kernel_grad(self,x):
+        """
+        The kernel (as _get_kernel), and its derivatives with respect
+        to the kernel parameters, as a dictionary.
+        """
+        if self.kernelname == 'Delta':
+            return sp.array([1.0]),{}
+        dlambda = x[1] - x[0]
+        pixwidth = self.p['width']/dlambda
+        prange = sp.r_[ -(x.size //2) + 1 : (x.size)//2  ]
+        u = prange/pixwidth
+        g = sp.exp(-0.5*u**2)
+        if self.kernelname == 'Hermite':
+            he3 = u**3 - 3*u
+            he4 = u**4 - 6*u**2 + 3
+            h = 1 + self.p['h3']*he3 + self.p['h4']*he4
+            dh = self.p['h3']*(3*u**2 - 3) + self.p['h4']*(4*u**3 - 12*u)
+        else:
+            h = 1.0
+            dh = 0.0
+
+        #the constant in front of the kernel cancels when normalizing
+        raw = g*h
+        draw = {'width':g*u*(u*h - dh)/(pixwidth*dlambda)}
+        if self.kernelname == 'Hermite':
+            draw['h3'] = g*he3
+            draw['h4'] = g*he4
+
+        norm = abs(sp.sum(raw))
+        sgn = sp.sign(sp.sum(raw))
+        k = raw/norm
+        dk = dict([ (key,(draw[key] - k*sgn*sp.sum(draw[key]))/norm) for key in draw.keys() ])
+        return k,dk
+
+    def chi2_grad(self,L):
+        """
+        chi^2 (the same as self(L)) and its derivatives with respect
+        to the parameters, as a dictionary.  The derivatives are
+        analytic, through the linear interpolation (for the shift),
+        the convolution (for the kernel parameters), and the scale.
+        Priors are included (functions are differentiated
+        numerically, see priors.prior_dchi2).
+
+        Only for linear interpolation and data errors
+        (fit_with_covar=False).  With scale_mode='profile', the scale
+        is solved for first, and the derivatives are those of the
+        profiled chi^2 (d chi^2/d scale = 0 at the best scale).
+        """
+        if self.use_covar or self.scale_mode == 'marginal':
+            raise ValueError("chi2_grad needs fit_with_covar=False, and scale_mode None or 'profile'")
+        if L.style != 'linear':
+            raise ValueError("chi2_grad needs linear interpolation")
+
+        #shift (as _get_yz): the data are interpolated at x + shift
+        x = self.Lref.wv
+        shift = self.p['shift']
+        m = (x >= L.wv.min() - shift)*(x <= L.wv.max() - shift)
+        if round(0.05*m.sum()) < 1:
+            #shifted too far to overlap the reference
+            return sp.inf,dict([ (key,0.0) for key in self.p.keys() if key != 'scale_err' ])
+        if self.scale_mode == 'profile':
+            self._solve_scale(L)
+        i,t = grid_index(L.wv,x[m] + shift)
+        dwv = L.wv[i] - L.wv[i - 1]
+        e1 = L.ef[i - 1]**2
+        e2 = L.ef[i]**2
+        y0 = L.f[i - 1] + t*(L.f[i] - L.f[i - 1])
+        v0 = t*t*e2 + (1 - t)**2*e1
+        dy0 = (L.f[i] - L.f[i - 1])/dwv
+        dv0 = (2*t*e2 - 2*(1 - t)*e1)/dwv
+
+        #convolve, scale, and trim
+        k,dk = self._kernel_grad(x[m])
+        conv = lambda y,kk: sp.convolve(y,kk,mode='same')
+        trim = int(round(0.05* (x[m].size)))
+        cut = slice(trim,x[m].size - trim)
+        y = conv(y0,k)[cut]
+        v = conv(v0,k*k)[cut]
+        m2 = (x >= x[m][trim] )*(x < x[m][-trim] )
+
+        a = self.p['scale']
+        r = self.Lref.f[m2]
+        e = r - a*y
+        w = 1./(self.Lref.ef[m2]**2 + a*a*v)
+        chi2 = sp.sum(e*e*w)
+
+        #d chi^2 = sum gy*d(model) + gv*d(variance)
+        gy = -2*e*w
+        gv = -e*e*w*w
+        grad = {}
+        if self.scale_mode is None:
+            grad['scale'] = sp.sum(gy*y + gv*2*a*v)
+        grad['shift'] = sp.sum(gy*a*conv(dy0,k)[cut] + gv*a*a*conv(dv0,k*k)[cut])
+        for key in dk.keys():
+            grad[key] = sp.sum(gy*a*conv(y0,dk[key])[cut] + gv*a*a*conv(v0,2*k*dk[key])[cut])
+
+        chi2 += self._add_priors() + self._prior_limits()
+        for key in self.prior_prob.keys():
+            if key in grad:
+                grad[key] += prior_dchi2(self.prior_prob[key],self.p[key])
+        return chi2,grad
+
+    def chi2_batch(self,L,P):
+        """
+        chi^2 (the same as self(L)) for many parameter sets at once,
+        e.g., the temperatures of tempered.  P is a dictionary with an
+        array for each parameter, one value per set.  The data are
+        interpolated at all shifts with one operator, and all kernels
+        are applied with FFTs (as propagate_chain), with the pixels of
+        each set masked as in _get_yz.  With scale_mode set,
+        P['scale'] and P['scale_err'] are set for each set, as
+        _solve_scale sets self.p.
+
+        With fit_with_covar=True, the sets are evaluated one by one.
+        """
+        if self.use_covar:
+            return self._chi2_each(L,P)
+        ref = self.Lref
+        shifts = sp.asarray(P['shift'],dtype=float)
+        nset = shifts.size
+
+        #pixels of each set (as _get_yz): m overlaps the shifted data,
+        #and m2 is what is left after the trim
+        m = (ref.wv[None,:] >= L.wv.min() - shifts[:,None])*(ref.wv[None,:] <= L.wv.max() - shifts[:,None])
+        n = m.sum(axis=1)
+        i0 = sp.argmax(m,axis=1)
+        trim = sp.floor(0.05*n + 0.5).astype(int)
+        ipix = sp.r_[0:ref.wv.size][None,:]
+        m2 = (ipix >= (i0 + trim)[:,None])*(ipix <= (i0 + n - 1 - trim)[:,None])*(trim > 0)[:,None]
+        use = m2.any(axis=1)
+        chi2 = sp.zeros(nset) + sp.inf
+        if not use.any():
+            return chi2
+
+        #only the sets that overlap the data from here
+        Pu = dict([ (key,sp.asarray(P[key],dtype=float)[use]) for key in P.keys() ])
+        m,m2 = m[use],m2[use]
+        X = ref.wv[None,:] + Pu['shift'][:,None]
+        A = L.interp_operator(X[m],cache=False)
+        Y = sp.zeros(X.shape)
+        V = sp.zeros(X.shape)
+        Y[m] = A*L.f
+        V[m] = propagate_var(A,L.ef**2)
+        k = _batch_kernels(self.kernelname,ref.wv,Pu,n=n[use])
+        if k is not None:
+            Y = _convolve_rows(Y,k)
+            V = _convolve_rows(V,k**2)
+
+        r = ref.f[None,:]
+        er = ref.ef[None,:]**2
+        if self.scale_mode is None:
+            s = Pu['scale'][:,None]
+            chi2[use] = sp.sum(m2*(r - s*Y)**2/(er + s*s*V),axis=1)
+        else:
+            s = sp.ones(nset)
+            d2 = sp.zeros(nset)
+            s[use],chi2[use],d2[use] = _profile_scale(r,er,Y,V,m2)
+            good = d2 > 0
+            P['scale'] = s
+            P['scale_err'] = sp.where(good,sp.sqrt(2./sp.where(good,d2,1.)),sp.inf)
+            if self.scale_mode == 'marginal':
+                chi2 += sp.where(good,sp.log(sp.where(good,d2,1.)/(4*sp.pi)),sp.inf)
+
+        #priors, and the limits of _prior_limits
+        for key in self.prior_prob.keys():
+            chi2 += prior_chi2(self.prior_prob[key],sp.asarray(P[key],dtype=float))
+        if 'width' in P:
+            chi2[sp.asarray(P['width'])/(ref.wv[1] - ref.wv[0]) < 0.5] = sp.inf
+        for key in ['h3','h4']:
+            if key in P:
+                chi2[sp.absolute(P[key]) > 0.3] = sp.inf
+        return chi2
+
+    def _chi2_each(self,L,P):
+        #chi2_batch, one parameter set at a time
+        p_save = deepcopy(self.p)
+        chi2 = sp.zeros(sp.size(P['shift']))
+        for j in range(chi2.size):
+            self.p = dict([ (key,P[key][j]) for key in self.p.keys() ])
+            x = self.Lref.wv
+            m = (x >= L.wv.min() - self.p['shift'])*(x <= L.wv.max() - self.p['shift'])
+            if round(0.05*m.sum()) < 1:
+                #shifted too far to overlap the reference
+                chi2[j] = sp.inf
+                continue
+            chi2[j] = self(L)
+            for key in ['scale','scale_err']:
+                if key in self.p:
+                    P[key][j] = self.p[key]
+        self.p = p_save
+        return chi2
+
 
     def step(self):
         pout = {}
         for key in self.p.keys():
-            pout[key] = self.p[key] + self.set_scale[key]*sp.randn()
+            pout[key] = self.p[key] + self.set_scale.get(key,0.0)*sp.randn()
 
         return pout
 
     def _prior_limits(self):
         prior = 0
-        if len(self.p) > 2:
+        if 'width' in self.p:
             dlambda = self.Lref.wv[1] - self.Lref.wv[0]
             #if width is too small, the kernel is undersampled.  Weird
             #things will happen, so this represents a lower limit.
             if self.p['width']/dlambda <0.5:
                 prior = sp.inf
 
-        if len(self.p) > 3:
+        if 'h3' in self.p:
             #experiments have found that h3 and h4 between -0.3 and
             #0.3 should be adequate (very diverse line shapes appear)
             if self.p['h3'] < -0.3:
@@ -298,31 +617,241 @@ class RescaleModel(object):
 
 
 
+class FourierRescaleModel(RescaleModel):
+    """
+    The same model as RescaleModel, but the likelihood is calculated
+    in Fourier space.  The shift, convolution, and scale are all
+    diagonal in Fourier space: the Fourier transform of the data line
+    is calculated once (and cached), and each evaluation only
+    multiplies by the analytic transform of the kernel and a phase
+    ramp for the shift, then transforms back.  The cost per step is
+    O(N log N), without any re-interpolation.
+
+    For a Gauss-Hermite kernel with width s (in pixels) and w =
+    2*pi*s*nu (nu in cycles per pixel), the transform is
+
+    exp(-w**2/2)*(1 + 1j*h3*w**3 + h4*w**4)
+
+    (h4 = h3 = 0 for a Gaussian, 1 for a delta function).
+
+    Differences with RescaleModel:
+
+    The shift is a band-limited (sinc) interpolation, instead of the
+    interpolation style of the data.  For band-limited data, the two
+    agree.
+
+    Edges are handled by zero-padding the data line (after continuum
+    subtraction, the line goes to zero at the edges) to at least
+    twice its length, so that the convolution does not wrap around
+    unless the kernel is wider than the line window.
+    RescaleModel instead convolves only the part of the line that
+    overlaps the reference, so the two differ within a kernel width
+    of the edges---most of this is removed by the 5% trim of the
+    data (see RescaleModel._get_yz).
+
+    Errors are also propagated in Fourier space: the variances go
+    through linear interpolation weights and the squared (sampled)
+    kernel.  The covariance matrix is not available
+    (fit_with_covar=True is not supported).  RescaleModel.output
+    still works as usual for applying the best fit.
+
+    The data line and reference must be evenly spaced, with the same
+    wavelength spacing.
+    """
+
+    def __init__(self,Lref,kernel='Hermite',fit_with_covar=False,scale_mode=None):
+        if fit_with_covar:
+            raise ValueError("FourierRescaleModel cannot fit with the covariance matrix")
+        super(FourierRescaleModel,self).__init__(Lref,kernel=kernel,fit_with_covar=False,
+                                                 scale_mode=scale_mode)
+        if self.Lref.grid is None:
+            raise ValueError("Reference must be evenly spaced for FourierRescaleModel")
+        self._fkey = None
+
+    def chi2_batch(self,L,P):
+        """
+        As RescaleModel.chi2_batch, but one set at a time (each
+        evaluation is already a few FFTs).
+        """
+        return self._chi2_each(L,P)
+
+    def _set_data(self,L):
+        """
+        Cache the Fourier transforms of the data line and its
+        variance.
+        """
+        key = (id(L),L.wv[0],L.wv[-1],L.f.sum(),L.ef.sum())
+        if key == self._fkey:
+            return
+        if L.grid is None:
+            raise ValueError("Data must be evenly spaced for FourierRescaleModel")
+        if abs(L.grid[1] - self.Lref.grid[1]) > 1.e-6*self.Lref.grid[1]:
+            raise ValueError("Data and reference must have the same wavelength spacing")
+
+        n = L.wv.size
+        self._nfft = int(2**sp.ceil(sp.log2(2*n)))
+        self._nu = fft.rfftfreq(self._nfft)
+        self._ffft = fft.rfft(L.f,self._nfft)
+        self._vfft = fft.rfft(L.ef**2,self._nfft)
+        self._x0 = L.wv[0]
+        self._fkey = key
+
+    def _kernel_fourier(self):
+        """
+        Analytic Fourier transform of the kernel, at self._nu.
+        """
+        if self.kernelname == 'Delta':
+            return 1.0
+        w = 2*sp.pi*self._nu*self.p['width']/self.Lref.grid[1]
+        khat = sp.exp(-0.5*w**2)
+        if self.kernelname == 'Hermite':
+            khat = khat*(1 + 1j*self.p['h3']*w**3 + self.p['h4']*w**4)
+        return khat
+
+    def _kernel2_fourier(self):
+        """
+        Fourier transform of the squared kernel (for the variance),
+        sampled on pixels as in RescaleModel.
+        """
+        if self.kernelname == 'Delta':
+            return 1.0
+        pixwidth = self.p['width']/self.Lref.grid[1]
+        half = int(min(sp.ceil(10*pixwidth),self._nfft//2 - 1))
+        prange = sp.r_[-half:half + 1]
+        k = sp.exp(-0.5*prange**2/pixwidth**2)
+        if self.kernelname == 'Hermite':
+            k = k*H([ 1.0, 0.0, 0.0,self.p['h3'], self.p['h4'] ])(prange/pixwidth)
+        k /= abs(sp.sum(k))
+        #center the kernel on pixel 0, wrapping around
+        return fft.rfft(sp.roll(sp.r_[k**2,sp.zeros(self._nfft - k.size)],-half))
+
+    def _get_yz(self,L,getcovar=False):
+        """
+        As RescaleModel._get_yz, but the shift and convolution are
+        done in Fourier space.
+        """
+        if getcovar:
+            raise ValueError("FourierRescaleModel cannot calculate the covariance matrix")
+        with self._stage('fft'):
+            self._set_data(L)
+        dx = self.Lref.grid[1]
+
+        #reference pixels covered by the shifted data
+        m = (self.Lref.wv >= L.wv.min() - self.p['shift'])*(self.Lref.wv <= L.wv.max() - self.p['shift'])
+        #position of the first reference pixel on the data pixels,
+        #split into an integer and fractional part
+        delta = (self.Lref.wv[0] + self.p['shift'] - self._x0)/dx
+        q = int(sp.floor(delta))
+        r = delta - q
+        ramp = sp.exp(2j*sp.pi*self._nu*r)
+
+        i = (sp.where(m)[0] + q) % self._nfft
+        with self._stage('kernel'):
+            khat = self._kernel_fourier()
+            k2hat = self._kernel2_fourier()
+        with self._stage('convolve'):
+            y = fft.irfft(self._ffft*khat*ramp,self._nfft)[i]
+            v = fft.irfft(self._vfft*k2hat*((1 - r)**2 + r**2*sp.exp(2j*sp.pi*self._nu)),self._nfft)[i]
+
+        #scale
+        y *= self.p['scale']
+        v *= self.p['scale']**2
+
+        #same trim as RescaleModel
+        trim = int(round(0.05* (self.Lref.wv[m].size)))
+        y = y[trim:-trim]
+        v = v[trim:-trim]
+        m2 = (self.Lref.wv >= self.Lref.wv[m][trim] )*(self.Lref.wv < self.Lref.wv[m][-trim] )
+
+        return y,v,m2
+
+
 class Chain(object):
     """
     This is an object for storing MCMC chains.  It names the
     parameters by storming them in a dictionary.  It knows how to read
     and write itself, and how to plot both histograms and triangle
     (correlation) plots.
+
+    Only every thin-th step is kept.  If maxkeep is set, the thinning
+    doubles whenever more than maxkeep steps are kept, so the memory
+    is bounded however long the chain is.  The mean, covariance, and
+    percentiles of every step after the first nburn (not only the
+    kept ones) are updated as the chain grows (see summary), along
+    with the number of accepted steps.
     """
-    def __init__(self):
+    def __init__(self,thin=1,maxkeep=None,nburn=0):
         self.pchain   = []
         self.lnlikely = []
 
         self.index   = {}
         self.figure = None
 
+        self.thin = thin
+        self.maxkeep = maxkeep
+        self.nburn = nburn
+        self.nstep = 0
+        self.ntrial = 0
+        self.naccept = 0
+        self.stats = None
+
 #        self.figure,(self.axes) = plt.subplots(len(pnames) + 1,1)
 
-    def add(self,M,chi2):
-        if len(self.pchain) == 0:
+    def add(self,M,chi2,accept=None):
+        """
+        Adds the current parameters of M, with chi^2 chi2.  accept is
+        True/False for a step of the MCMC (None for the first point).
+        """
+        if self.nstep == 0:
             for i,k in enumerate(M.p.keys() ):            
                 self.index[k] = i
 
             self.figure,(self.axes) = plt.subplots( len(M.p.keys()) + 1,1)
-
-        self.pchain.append(deepcopy( M.p.values() ))
-        self.lnlikely.append(chi2)
+            self.stats = OnlineStats(len(M.p.keys()))
+
+        values = M.p.values()
+        if self.nstep >= self.nburn:
+            self.stats.add(values)
+        if accept is not None:
+            self.ntrial += 1
+            if accept:
+                self.naccept += 1
+
+        if self.nstep % self.thin == 0:
+            self.pchain.append(deepcopy( values ))
+            self.lnlikely.append(chi2)
+            if self.maxkeep is not None and len(self.pchain) > self.maxkeep:
+                self.pchain = self.pchain[::2]
+                self.lnlikely = self.lnlikely[::2]
+                self.thin *= 2
+        self.nstep += 1
+
+    def summary(self):
+        """
+        Summary of every step after nburn: the mean, standard
+        deviation, and 16th, 50th, and 84th percentiles of each
+        parameter, the covariance matrix (in the order of names), and
+        the number of steps (and of burn in steps) and accepted steps.
+        """
+        names = sorted(self.index.keys(),key=lambda k: self.index[k])
+        out = {'names':names,'nstep':self.nstep,'nburn':self.nburn,'ntrial':self.ntrial,'naccept':self.naccept,
+               'frac':self.naccept/float(max(self.ntrial,1)),'thin':self.thin,'nkeep':len(self.pchain)}
+        if self.stats is None or self.stats.count() == 0:
+            return out
+        mean = self.stats.mean()
+        covar = self.stats.covar()
+        q = self.stats.quantile([0.16,0.50,0.84])
+        for name in names:
+            i = self.index[name]
+            out[name] = {'mean':mean[i],'std':sp.sqrt(covar[i,i]),
+                         'p16':q[0,i],'p50':q[1,i],'p84':q[2,i]}
+        out['covar'] = covar.tolist()
+        return out
+
+    def save_summary(self,ofile):
+        fout = open(ofile,'w')
+        json.dump(self.summary(),fout,indent=1)
+        fout.close()
 
     def save(self,ofile):
         head = 'lnlikely   '
@@ -347,6 +876,12 @@ class Chain(object):
 
         assert max(self.index.values()) == sp.transpose(self.pchain).shape[0] - 1
 
+        #summaries of the steps in the file
+        self.stats = OnlineStats(self.pchain.shape[1])
+        for x in self.pchain:
+            self.stats.add(x)
+        self.nstep = self.pchain.shape[0]
+
 
     def burn(self,frac):
         assert frac < 1
@@ -450,107 +985,161 @@ class Chain(object):
 
 
 
+def _profile_scale(r,er,y,v,m=1.0,niter=10,tol=1.e-8):
+    """
+    Best scale s for chi^2(s) = sum m*(r - s*y)**2/(er + s**2*v),
+    with sums along the last axis (so y and v can hold many models,
+    one per row, masked by m).  Returns s, the minimum chi^2, and the
+    curvature chi^2''(s).  See RescaleModel._solve_scale.
+    """
+    def derivs(s):
+        sx = sp.asarray(s)[...,None]
+        e = r - sx*y
+        w = m/(er + sx*sx*v)
+        chi2 = sp.sum(e*e*w,axis=-1)
+        #m is 0 or 1, so powers of w are still masked correctly
+        d1 = sp.sum(-2*e*y*w - 2*sx*v*e*e*w*w,axis=-1)
+        d2 = sp.sum(2*y*y*w + 8*sx*v*e*y*w*w - 2*v*e*e*w*w + 8*sx*sx*v*v*e*e*w**3,axis=-1)
+        return chi2,d1,d2,w
+
+    #start from weighted least squares, ignoring the data errors
+    s = sp.sum(m*r*y/er,axis=-1)/sp.sum(m*y*y/er,axis=-1)
+    for i in range(niter):
+        chi2,d1,d2,w = derivs(s)
+        #if not near the minimum, fall back to the fixed point
+        snew = sp.where(d2 > 0,s - d1/sp.where(d2 > 0,d2,1.0),
+                        sp.sum(r*y*w,axis=-1)/sp.sum(y*y*w,axis=-1))
+        done = (sp.absolute(snew - s) < tol*sp.absolute(s)).all()
+        s = snew
+        if done:
+            break
+
+    chi2,d1,d2,w = derivs(s)
+    return s,chi2,d2
+
+class CrossCorr(object):
+    """
+    FFT cross correlation against a fixed reference spectrum.  The
+    Fourier transform of the reference is calculated once, and each
+    call resamples the other spectra onto the reference wavelengths,
+    correlates them all in one batch, and refines the peak to a
+    fraction of a pixel with a parabola through the 3 highest points.
+
+    The shift has the same sign as get_cc: spec2 is aligned with the
+    reference by spec2.wv -= shift.
+
+    Parameters
+    ----------
+    y1 = flux of the reference
+    x1 = wavelengths of the reference (if not evenly spaced, the
+         reference is resampled at its median spacing)
+    maxshift = largest shift to search (wavelength units), default
+               is half the reference width
+
+    Examples
+    --------
+    >>> cc = CrossCorr(sref.f,sref.wv)
+    >>> shift = cc(s.f,s.wv)
+    >>> shifts = cc([s1.f,s2.f,s3.f],[s1.wv,s2.wv,s3.wv])
+    """
+    def __init__(self,y1,x1,maxshift=None):
+        grid = get_grid(x1)
+        if grid is None:
+            dx = sp.median(sp.diff(x1))
+            x = x1[0] + dx*sp.r_[0:int((x1[-1] - x1[0])/dx) + 1]
+            y1 = sp.interp(x,x1,y1)
+            grid = (x[0],dx,x.size)
+        self.grid = grid
+        self.x = grid[0] + grid[1]*sp.r_[0:grid[2]]
+        n = self.x.size
+        self.nfft = int(2**sp.ceil(sp.log2(2*n)))
+        self.fref = fft.rfft(y1 - y1.mean(),self.nfft)
+
+        if maxshift is None:
+            self.maxlag = n//2
+        else:
+            self.maxlag = int(maxshift/grid[1])
+
+    def __call__(self,y2,x2):
+        """
+        y2 can be one spectrum, or many (a 2D array or list); x2 is
+        shared by all spectra or given for each.  Returns an array
+        with one shift per spectrum.
+        """
+        if sp.ndim(y2) == 1 and not isinstance(y2,list):
+            y2 = [y2]
+        if sp.ndim(x2) == 1 and not isinstance(x2,list):
+            x2 = [x2]*len(y2)
+        assert len(x2) == len(y2)
+
+        #resample onto the reference, zero outside the overlap
+        Y = sp.zeros((len(y2),self.x.size))
+        for i in range(len(y2)):
+            m = (self.x >= x2[i].min())*(self.x <= x2[i].max())
+            Y[i,m] = sp.interp(self.x[m],x2[i],y2[i])
+            Y[i,m] -= Y[i,m].mean()
+
+        cc = fft.irfft(self.fref[None,:]*sp.conj(fft.rfft(Y,self.nfft,axis=1)),self.nfft,axis=1)
+        #lags from -maxlag to maxlag
+        lags = sp.r_[-self.maxlag:self.maxlag + 1]
+        cc = cc[:,lags % self.nfft]
+
+        i = sp.clip(sp.argmax(cc,axis=1),1,lags.size - 2)
+        rows = sp.r_[0:cc.shape[0]]
+        c0,c1,c2 = cc[rows,i - 1],cc[rows,i],cc[rows,i + 1]
+        denom = c0 - 2*c1 + c2
+        frac = sp.where(denom < 0,0.5*(c0 - c2)/sp.where(denom < 0,denom,1.0),0.0)
+
+        return -self.grid[1]*(lags[i] + frac)
+
+#most recent CrossCorr used by get_cc
+_cc_cache = [None,None]
+
 def get_cc(y1,y2,x1,x2):
     """
-    Easy way of estimating the shift to the nearest pixel (given in
-    wavelength units).
+    Easy way of estimating the shift (given in wavelength units),
+    to a fraction of a pixel.  See CrossCorr---the transform of spec1
+    is kept for the next call, so use the same reference for a list
+    of spectra.
 
     y1 = flux of spec1
-    y2 = flux of spec2
+    y2 = flux of spec2 (or a 2D array/list of many spectra)
     x1 = wavelengths of spec1
-    x2 = wavelengths of spec2
-    """
-
-    if x1.size > x2.size:
-        m = (x1 > x2.min())*(x1 < x2.max())
-        yuse = [y1[m],y2]
-    else:
-        m = (x2 > x1.min())*(x2 < x1.max())
-        yuse = [y1,y2[m]]
-
+    x2 = wavelengths of spec2 (or one array for each)
 
-    cc = sp.correlate(yuse[0],yuse[1],mode='same')
-    i  = sp.where(cc == cc.max())[0]
-    shift = (x1[1] - x1[0] )*(cc.size//2 - i)
-    return shift
+    Returns an array of shifts, one for each spectrum (so size 1 for
+    a single spectrum).
+    """
+    key = hashlib.md5(sp.ascontiguousarray(x1).tostring() + sp.ascontiguousarray(y1).tostring()).hexdigest()
+    if _cc_cache[0] != key:
+        _cc_cache[0] = key
+        _cc_cache[1] = CrossCorr(y1,x1)
+    return _cc_cache[1](y2,x2)
 
-def get_covarmatrix(x,xinterp,z,k,breakwidth):
+def get_covarmatrix(x,xinterp,z,k,breakwidth=None,grid=None,style='linear'):
     """
     Calculates the covariance matrix when needed.  Assumes both an
-    interpolation and a smoothing----for now, only linear
-    interpolation will work (only does one diagonal, but propagates
-    the error correctly).
+    interpolation and a smoothing.  Both are linear operations, so
+    the covariance is propagated exactly with sparse matrices (see
+    operators.py)---for matrix equation, see Gardner 2003,
+    Uncertainties in Interpolated Spectral Data; equation 6.
+
+    x = old wavelengths
+    xinterp = new wavelengths
+    z = old error spectrum
+    k = convolution kernel (as applied with sp.convolve, mode='same')
+    grid = (start, step, n) of x, if evenly spaced (see Spectrum.grid)
+    style = interpolation style
+
+    breakwidth is no longer needed (the kernel is trimmed where it is
+    negligible), and is kept so that old calls still work.
     """
+    A = interp_operator(x,xinterp,style,grid)
+    T = convolve_operator(k,xinterp.size)*A
+    return propagate_covar(T,z**2)
 
-    isort = sp.searchsorted(x,xinterp)
-    f = (xinterp - x[isort -1 ])/(x[isort] - x[isort -1])
-    z2 = sp.sqrt(
-        (f**2)*(z[isort]**2) + ((1 - f)**2)*(z[isort - 1]**2)
-        )
-    #for a delta function
-    if k.size == 1:
-        return sp.diag(z2**2)
-
-    covar1 = sp.zeros((z2.size ,z2.size ))
-    covar2 = sp.zeros((z2.size ,z2.size ))
-
-    #the part from interpolation---searchsorted has thrown out the
-    #first index, the last index won't be selected because of the slice
-    covar1[sp.diag_indices_from(covar1)] = z2**2
-#    print sp.shape(f), sp.shape(z[isort.min():isort.max()-1]),sp.shape(z)
-    diag1 = f[0:-1]*(1-f[0:-1])*(z[isort.min()  : isort.max() ]**2)
-
-    #linear interpolation only has one diagonal
-    covar1 += sp.diag(diag1,1)
-    covar1 += sp.diag(diag1,-1)
-    covar1 = sp.matrix(covar1)
-                
-    #the part from convolution
-    #make kernel match size of input
-    if k.size == z2.size  - 2:
-        k = sp.r_[0,k,0]
-    elif k.size == z2.size -1:
-        k = sp.r_[0,k]
-    #force it to wrap around
-    cent = k.size//2
-    k = sp.r_[ k[cent::], k[0:cent ] ]
-
-    #for matrix equation, see Gardner 2003, Uncertainties in
-    #Interpolated Spectral Data; equation 6
-
-    # seems like there is a better way than a double loop....
-    for i in range(z2.size):
-        for n in range(int(breakwidth)):
-            #can shorten the loop because most of the matrix is
-            #zero:the idea is that kernels that are far apart
-            #should have zero overlap.  If k2 gets shifted
-            #relative to k1 more than 5x the kernel width, assume
-            #no overlap
-            j = i + n
-            if j > z2.size - 1: j = z2.size -1
-            k1 = sp.matrix(sp.roll(k,i))
-            k2 = sp.matrix(sp.roll(k,j))
-            trim1 = cent + i
-            if trim1 <= k1.size:
-                k1[:,trim1::] = 0
-            else:
-                k1[:,0: trim1 - k1.size] = 0
-
-            trim2 = cent + j
-            if trim2 <= k2.size:
-                k2[:,trim2::] = 0
-            else:
-                k2[:,0: (trim2 - k2.size)] = 0
-
-            covar2[i,j] = k1*covar1*k2.T
-        #matrix is symmetric
-    covar2 += covar2.T
-    covar2[sp.diag_indices_from(covar2)] /= 2.
-   
-    return covar2
-
-
-def metro_hast(ntrial,D,M,plot=False,keep=False):
+
+def metro_hast(ntrial,D,M,plot=False,keep=False,thin=1,maxkeep=None,nburn=0,chain=None):
     """
     This actualy does the work to fit the model to the data.  
 
@@ -562,10 +1151,14 @@ def metro_hast(ntrial,D,M,plot=False,keep=False):
     chains as they progress!
 
     keep=True will return the Chain object used to store the MCMC,
-    which can be saved latter (see do_map.py).
-    
+    which can be saved latter (see do_map.py).  thin, maxkeep, and
+    nburn are passed to the Chain.  chain = a Chain to continue (M.p
+    should be its last state), instead of starting a new one.
 
+    If M.profile is a Profile, the steps, acceptance, and total time
+    are recorded, along with the stages of the likelihood.
     """
+    t0 = time()
     Mtry= deepcopy(M)
     chi2 = 1.e12
     chi2best = 1.e12
@@ -573,14 +1166,21 @@ def metro_hast(ntrial,D,M,plot=False,keep=False):
     pbest = deepcopy(M.p)
     accept = 0
 
-    c = Chain()
-    c.add(M,M(D))
+    if chain is None:
+        c = Chain(thin=thin,maxkeep=maxkeep,nburn=nburn)
+        c.add(M,M(D))
+    else:
+        #the first step is compared to where the chain left off
+        c = chain
+        chi2 = M(D)
+        chi2best = chi2
     if plot ==1:
         plt.ion()
         c.plot()
 
     for i in range(ntrial):
-        Mtry.p = M.step()
+        with M._stage('step'):
+            Mtry.p = M.step()
         chi2try = Mtry(D)
         
         if chi2try < chi2:
@@ -589,7 +1189,7 @@ def metro_hast(ntrial,D,M,plot=False,keep=False):
             chi2 = deepcopy(chi2try)
 
             accept += 1
-            c.add(M,chi2)
+            c.add(M,chi2,accept=True)
                 
             if chi2 < chi2best:
                 chi2best = deepcopy(chi2)
@@ -602,16 +1202,645 @@ def metro_hast(ntrial,D,M,plot=False,keep=False):
                 M.p = deepcopy(Mtry.p)
                 chi2 = deepcopy(chi2try)
                 accept += 1
-            c.add(M,chi2)
+            c.add(M,chi2,accept=r <= prob)
                 
         if i%500 == 0 :
             print i,chi2best,chi2try
             if plot ==1:
                 c.plot()
 
+    if M.profile is not None:
+        M.profile.add_run(ntrial,accept,time() - t0)
+
+    if keep == 1:
+        return chi2best,pbest,accept/float(ntrial),c
+    else:
+        return chi2best,pbest,accept/float(ntrial)
+
+
+def hmc(ntrial,D,M,nleap=10,eps=0.1,target=0.8,nadapt=None,nopt=50,keep=False,thin=1,maxkeep=None):
+    """
+    Hamiltonian Monte Carlo version of metro_hast, with the analytic
+    derivatives of RescaleModel.chi2_grad (linear interpolation, data
+    errors only).  The posterior is exp(-chi^2/2).
+
+    ntrial = number of trajectories
+    D = Data (EmissionLine Object)
+    M = RescaleModel object
+    nleap = mean number of leapfrog steps per trajectory (the number
+            is drawn between 1 and 2*nleap - 1, so that trajectories
+            do not all have the same length)
+    eps = initial step size
+    nadapt = number of trajectories (default ntrial/3) used to tune
+             the step size (to an acceptance of target) and the
+             metric: the parameters are rescaled twice, at 3/8 and
+             3/4 of nadapt, by the covariance of the chain so far, so
+             that correlated parameters (e.g., width and h4) are
+             sampled as well as independent ones.  These steps are
+             left out of the Chain summaries (nburn).
+    nopt = maximum number of iterations of the L-BFGS minimizations of
+           -2 ln of the posterior that give the start of the chain
+           (0 starts at M.p)
+    keep, thin, maxkeep = as metro_hast
+
+    The limits of RescaleModel._prior_limits would stop trajectories,
+    so width and h3/h4 are sampled as log(width - width_min) and
+    arctanh(h/0.3), with the Jacobian of the transformation in the
+    posterior (the posterior of width, h3, and h4 is unchanged).
+
+    Returns chi2best, pbest, acceptance fraction, and the Chain if
+    keep=True, as metro_hast.  The number of chi^2 and gradient
+    evaluations is in M.ngrad.
+    """
+    t0 = time()
+    if nadapt is None:
+        nadapt = ntrial//3
+    keys = [ key for key in M.p.keys() if key != 'scale_err' and not (key == 'scale' and M.scale_mode is not None) ]
+    wmin = 0.5*(M.Lref.wv[1] - M.Lref.wv[0])
+    hmax = 0.3
+
+    #start inside the limits
+    if 'width' in keys and M.p['width'] <= wmin:
+        M.p['width'] = wmin + M.set_scale['width']
+    for key in ['h3','h4']:
+        if key in keys:
+            M.p[key] = sp.clip(M.p[key],-0.9*hmax,0.9*hmax)
+
+    def to_x(u):
+        #parameters, their derivatives with u, and ln of the Jacobian
+        x = u.copy()
+        dx = sp.ones(u.size)
+        dlnj = sp.zeros(u.size)
+        lnj = 0.
+        for j,key in enumerate(keys):
+            if key == 'width':
+                x[j] = wmin + sp.exp(u[j])
+                dx[j] = x[j] - wmin
+                lnj += u[j]
+                dlnj[j] = 1.
+            elif key in ['h3','h4']:
+                th = sp.tanh(u[j])
+                x[j] = hmax*th
+                dx[j] = hmax*(1 - th*th)
+                #ln(1 - tanh(u)**2), without underflow for large u
+                au = abs(u[j])
+                lnj += sp.log(hmax) - 2*(au + sp.log1p(sp.exp(-2*au)) - sp.log(2))
+                dlnj[j] = -2*th
+        return x,dx,lnj,dlnj
+
+    def to_u(x):
+        u = x.copy()
+        for j,key in enumerate(keys):
+            if key == 'width':
+                u[j] = sp.log(x[j] - wmin)
+            elif key in ['h3','h4']:
+                u[j] = sp.arctanh(x[j]/hmax)
+        return u
+
+    #the sampler works in q, with u = S q
+    x0 = sp.array([ M.p[key] for key in keys ])
+    S = sp.diag(sp.array([ M.set_scale[key] for key in keys ])/to_x(to_u(x0))[1])
+    M.ngrad = 0
+
+    def evaluate(q):
+        #-2 ln of the posterior in q and its gradient, and chi^2
+        x,dx,lnj,dlnj = to_x(sp.dot(S,q))
+        for j,key in enumerate(keys):
+            M.p[key] = x[j]
+        chi2,grad = M.chi2_grad(D)
+        M.ngrad += 1
+        gu = sp.array([ grad[key] for key in keys ])*dx - 2*dlnj
+        return chi2 - 2*lnj,sp.dot(S.T,gu),chi2
+
+    q = linalg.solve(S,to_u(x0))
+    if nopt > 0:
+        #a far start (e.g., the default parameters) is slow to leave
+        #with small leapfrog steps, so the chain starts at the best of
+        #the modes found from M.p and from wider kernels (narrow
+        #kernels can have a separate, worse, mode at width_min), each
+        #with the best scale for its kernel
+        starts = [q]
+        if 'width' in keys:
+            for k in [2,4,8]:
+                x = x0.copy()
+                x[keys.index('width')] = wmin*(1 + k)
+                if 'scale' in keys:
+                    p_save = deepcopy(M.p)
+                    M.p.update(zip(keys,x))
+                    M._solve_scale(D)
+                    x[keys.index('scale')] = M.p['scale']
+                    M.p = p_save
+                starts.append(linalg.solve(S,to_u(x)))
+        best = None
+        for qstart in starts:
+            res = minimize(lambda q: evaluate(q)[0:2],qstart,jac=True,method='L-BFGS-B',
+                           options={'maxiter':nopt})
+            if sp.isfinite(res.fun) and (best is None or res.fun < best.fun):
+                best = res
+        if best is not None:
+            q = best.x
+    u2,g,chi2 = evaluate(q)
+    p_now = deepcopy(M.p)
+    chi2best = chi2
+    pbest = deepcopy(M.p)
+    accept = 0
+
+    c = Chain(thin=thin,maxkeep=maxkeep,nburn=nadapt)
+    c.add(M,chi2)
+
+    #dual averaging of the step size (Hoffman & Gelman 2014)
+    def restart(eps):
+        return {'mu':sp.log(10*eps),'hbar':0.,'logeps_bar':0.,'m':0}
+    da = restart(eps)
+    usave = []
+    windows = [ (nadapt//8,3*nadapt//8),(3*nadapt//8,3*nadapt//4) ]
+
+    for i in range(ntrial):
+        #leapfrog trajectory, with potential u2/2
+        nstep = sp.random.randint(1,2*nleap)
+        p0 = sp.randn(q.size)
+        qnew = q.copy()
+        gnew = g
+        pnew = p0 - 0.25*eps*gnew
+        u2new = sp.inf
+        for l in range(nstep):
+            qnew = qnew + eps*pnew
+            u2new,gnew,chi2new = evaluate(qnew)
+            if not sp.isfinite(u2new):
+                break
+            if l < nstep - 1:
+                pnew -= 0.5*eps*gnew
+        pnew -= 0.25*eps*gnew
+
+        if sp.isfinite(u2new):
+            dH = 0.5*(u2new - u2) + 0.5*(sp.dot(pnew,pnew) - sp.dot(p0,p0))
+            alpha = sp.exp(min(0.,-dH))
+        else:
+            alpha = 0.
+        if sp.rand() < alpha:
+            q,g,u2,chi2 = qnew,gnew,u2new,chi2new
+            p_now = deepcopy(M.p)
+            accept += 1
+            if chi2 < chi2best:
+                chi2best = chi2
+                pbest = deepcopy(M.p)
+            c.add(M,chi2,accept=True)
+        else:
+            M.p = deepcopy(p_now)
+            c.add(M,chi2,accept=False)
+
+        if i < nadapt:
+            da['m'] += 1
+            mm = da['m']
+            da['hbar'] = (1 - 1./(mm + 10))*da['hbar'] + (target - alpha)/(mm + 10)
+            logeps = da['mu'] - sp.sqrt(mm)/0.05*da['hbar']
+            da['logeps_bar'] = mm**-0.75*logeps + (1 - mm**-0.75)*da['logeps_bar']
+            eps = sp.exp(logeps)
+            for start,end in windows:
+                if start <= i < end:
+                    usave.append(sp.dot(S,q))
+                if i == end - 1 and len(usave) > q.size + 5:
+                    #new metric from the covariance of the window,
+                    #shrunk a little towards the current one
+                    n = len(usave)
+                    C = (n*sp.cov(sp.array(usave).T) + 5.e-3*sp.dot(S,S.T))/(n + 5)
+                    u = sp.dot(S,q)
+                    S = linalg.cholesky(C,lower=True)
+                    q = linalg.solve(S,u)
+                    u2,g,chi2 = evaluate(q)
+                    usave = []
+                    da = restart(eps)
+        elif i == nadapt:
+            eps = sp.exp(da['logeps_bar'])
+
+        if i%500 == 0 :
+            print i,chi2best,chi2,eps
+
+    M.p = deepcopy(p_now)
+    if M.profile is not None:
+        M.profile.add_run(ntrial,accept,time() - t0)
+
+    if keep == 1:
+        return chi2best,pbest,accept/float(ntrial),c
+    else:
+        return chi2best,pbest,accept/float(ntrial)
+
+def tempered(ntrial,D,M,ntemp=12,tmax=None,temps=None,maxshift=None,target=0.25,nadapt=None,
+             keep=False,thin=1,maxkeep=None,chain=None):
+    """
+    Parallel tempering version of metro_hast, for posteriors with
+    more than one mode (e.g., in the shift, when the cross correlation
+    is off by a pixel, or the line has a neighbouring feature), where
+    a single random walk gets stuck.
+
+    ntrial = number of trials
+    D = Data (EmissionLine Object)
+    M = RescaleModel object
+    ntemp = number of chains, at temperatures T from 1 to tmax,
+            evenly spaced in ln T, or at the list temps.  The default
+            tmax is half of chi^2 at the start (M.p), so that the
+            hottest chain can climb out of the mode it starts in, or
+            the number of pixels of the reference line if that is
+            larger
+    maxshift = limit on |shift| (a flat prior), so that hot chains do
+               not wander to shifts where only a few pixels overlap
+               (and chi^2 has fewer terms).  Default 1/4 of the
+               wavelength range of the reference line.
+    target = acceptance of the random walk of each chain, to which
+             its step size is tuned in the first nadapt trials
+             (default ntrial/10)
+    keep, thin, maxkeep, chain = as metro_hast
+
+    Each chain samples exp(-chi^2/2T), with the usual Metropolis rule
+    and steps of M.set_scale*sqrt(T) (times the tuned factor).  Each
+    trial is one step of every chain, all evaluated at once with
+    M.chi2_batch, and then a swap of the states of neighbouring
+    temperatures (the even pairs, then the odd pairs, in turn).  Hot
+    chains cross between modes, and the swaps carry their states down
+    to the T = 1 chain, which is the one kept.
+
+    Returns chi2best (of any chain), pbest, acceptance fraction (steps
+    or swaps that moved the T = 1 chain), and the Chain if keep=True,
+    as metro_hast.  The temperatures and the swap acceptance of each
+    neighbouring pair are in M.temps and M.swap_rates.
+    """
+    t0 = time()
+    if nadapt is None:
+        nadapt = ntrial//4
+    keys = M.p.keys()
+    #parameters that are stepped (not the scale with scale_mode set)
+    skeys = [ key for key in keys if M.set_scale.get(key,0.0) > 0 ]
+    nd = len(skeys)
+    npix = M.Lref.wv.size
+    if temps is None:
+        if tmax is None:
+            chi2_start = M.chi2_batch(D,dict([ (key,sp.array([M.p[key]])) for key in keys ]))[0]
+            tmax = max(float(npix),0.5*chi2_start) if sp.isfinite(chi2_start) else float(npix)
+        temps = sp.exp(sp.linspace(0.,sp.log(tmax),ntemp))
+    temps = sp.asarray(temps,dtype=float)
+    ntemp = temps.size
+    if maxshift is None:
+        maxshift = 0.25*(M.Lref.wv.max() - M.Lref.wv.min())
+
+    #state of every chain, as arrays (one value per temperature)
+    P = dict([ (key,sp.zeros(ntemp) + M.p[key]) for key in keys ])
+    chi2 = M.chi2_batch(D,P)
+    #random walk of each chain: steps of S[j] times normal deviates,
+    #times exp(lnfac[j])
+    S = sp.array([ sp.diag([ M.set_scale[key]*sp.sqrt(T) for key in skeys ]) for T in temps ])
+    lnfac = sp.zeros(ntemp)
+    iadapt = 0
+    saved = []
+    windows = [ nadapt//4,nadapt//2,3*nadapt//4 ]
+    nswap = sp.zeros(ntemp - 1)
+    naccept_swap = sp.zeros(ntemp - 1)
+
+    ibest = sp.argmin(chi2)
+    chi2best = chi2[ibest]
+    pbest = dict([ (key,P[key][ibest]) for key in keys ])
+    accept = 0
+
+    M.p = dict([ (key,P[key][0]) for key in keys ])
+    if chain is None:
+        c = Chain(thin=thin,maxkeep=maxkeep,nburn=nadapt)
+        c.add(M,chi2[0])
+    else:
+        c = chain
+
+    for i in range(ntrial):
+        #one random walk step of each chain
+        dx = sp.einsum('tij,tj->ti',S,sp.randn(ntemp,nd))*sp.exp(lnfac)[:,None]
+        Ptry = dict([ (key,P[key].copy()) for key in keys ])
+        for a,key in enumerate(skeys):
+            Ptry[key] += dx[:,a]
+        chi2try = M.chi2_batch(D,Ptry)
+        chi2try[sp.absolute(Ptry['shift']) > maxshift] = sp.inf
+        with sp.errstate(invalid='ignore'):
+            lnprob = -0.5*(chi2try - chi2)/temps
+            ok = sp.log(sp.rand(ntemp)) < sp.where(sp.isnan(lnprob),-sp.inf,lnprob)
+        for key in keys:
+            P[key] = sp.where(ok,Ptry[key],P[key])
+        chi2 = sp.where(ok,chi2try,chi2)
+        moved = ok[0]
+
+        if i < nadapt:
+            lnfac += (ok - target)/(1 + (i - iadapt)/10.)**0.6
+            saved.append(sp.array([ P[key] for key in skeys ]).T)
+            if i + 1 in windows:
+                #steps from the covariance of each chain in the window
+                #(Haario et al. 2001), for chains that moved enough
+                X = sp.array(saved)
+                for j in range(ntemp):
+                    if len(set(X[:,j,0])) <= nd + 5:
+                        continue
+                    C = sp.atleast_2d(sp.cov(X[:,j,:].T))
+                    n = X.shape[0]
+                    C = (n*C + 5.e-3*sp.dot(S[j],S[j].T))/(n + 5)
+                    S[j] = 2.38/sp.sqrt(nd)*linalg.cholesky(C,lower=True)
+                    lnfac[j] = 0.
+                saved = []
+                iadapt = i + 1
+
+        #swap neighbouring temperatures
+        for j in range(i%2,ntemp - 1,2):
+            nswap[j] += 1
+            with sp.errstate(invalid='ignore'):
+                lnprob = 0.5*(chi2[j] - chi2[j + 1])*(1./temps[j] - 1./temps[j + 1])
+            if sp.log(sp.rand()) < lnprob:
+                naccept_swap[j] += 1
+                for key in keys:
+                    P[key][j],P[key][j + 1] = P[key][j + 1],P[key][j]
+                chi2[j],chi2[j + 1] = chi2[j + 1],chi2[j]
+                if j == 0:
+                    moved = True
+
+        if chi2.min() < chi2best:
+            ibest = sp.argmin(chi2)
+            chi2best = chi2[ibest]
+            pbest = dict([ (key,P[key][ibest]) for key in keys ])
+
+        M.p = dict([ (key,P[key][0]) for key in keys ])
+        if moved:
+            accept += 1
+        c.add(M,chi2[0],accept=moved)
+
+        if i%500 == 0 :
+            print i,chi2best,chi2[0]
+
+    M.temps = temps
+    M.swap_rates = naccept_swap/sp.maximum(nswap,1)
+    print 'temperatures:',' '.join([ '%.3g'%T for T in temps ])
+    print 'swap rates:',' '.join([ '%.2f'%r for r in M.swap_rates ])
+    if M.profile is not None:
+        M.profile.add_run(ntrial,accept,time() - t0)
+
     if keep == 1:
         return chi2best,pbest,accept/float(ntrial),c
     else:
         return chi2best,pbest,accept/float(ntrial)
 
 
+def _delta_profile(D,ref,shifts):
+    """
+    For delta_grid: interpolated data Y and variance V at all shifts,
+    the pixel masks m2 (same as RescaleModel._get_yz), and the best
+    scale, chi^2, and curvature at each shift.
+    """
+    m = (ref.wv[None,:] >= D.wv.min() - shifts[:,None])*(ref.wv[None,:] <= D.wv.max() - shifts[:,None])
+    n = m.sum(axis=1)
+    i0 = sp.argmax(m,axis=1)
+    trim = sp.floor(0.05*n + 0.5).astype(int)
+    ipix = sp.r_[0:ref.wv.size][None,:]
+    m2 = (ipix >= (i0 + trim)[:,None])*(ipix <= (i0 + n - 1 - trim)[:,None])*(trim > 0)[:,None]
+    if not m2.any():
+        raise ValueError("shifts do not overlap the reference")
+
+    #interpolate data at all shifts with one operator
+    X = ref.wv[None,:] + shifts[:,None]
+    A = D.interp_operator(X[m2],cache=False)
+    Y = sp.zeros(X.shape)
+    V = sp.zeros(X.shape)
+    Y[m2] = A*D.f
+    V[m2] = propagate_var(A,D.ef**2)
+
+    #shifts with no overlap are left out
+    use = m2.any(axis=1)
+    sbest = sp.zeros(shifts.size)
+    chi2prof = sp.zeros(shifts.size) + sp.inf
+    d2 = sp.zeros(shifts.size)
+    sbest[use],chi2prof[use],d2[use] = _profile_scale(ref.f[None,:],ref.ef[None,:]**2,Y[use],V[use],m2[use])
+    chi2prof[d2 <= 0] = sp.inf
+    return m2,sbest,chi2prof,d2,Y,V
+
+def delta_grid(D,M,shifts=None,nscale=201,nsample=1000,keep=False):
+    """
+    Deterministic replacement for metro_hast when the kernel is a
+    delta function.  The model only has a shift and a scale, so the
+    posterior is evaluated directly on a grid: the data are
+    interpolated for all shifts at once (one sparse operator), the
+    best scale is solved at each shift, and chi^2 is calculated on a
+    2D grid of shift and scale.
+
+    D = Data (EmissionLine Object)
+    M = RescaleModel object, with kernel='Delta'
+    shifts = grid of shifts.  Default is a coarse grid of +/- 10
+             pixels around M.p['shift'] (steps of 0.05 pixels),
+             followed by a fine grid of 401 shifts that covers the
+             peak of the posterior
+    nscale = number of scales in the grid, which covers the
+             conditional distribution of the scale
+    nsample = number of samples drawn from the posterior for the
+              Chain
+
+    Returns the same as metro_hast: chi2best, pbest, frac (always 1,
+    samples are independent), and the Chain if keep=True.  M.p is
+    set to pbest, and M.grid_posterior holds the grids, chi^2,
+    normalized posterior exp(-chi^2/2), and the 16th, 50th, and 84th
+    percentiles of the marginal distributions of shift and scale.
+
+    Priors in M.prior_prob are included (functions must work on
+    arrays).
+    The likelihood is from data errors only (fit_with_covar=False).
+    If M.profile is a Profile, the time is recorded as stage 'grid'.
+    """
+    t0 = time()
+    if M.kernelname != 'Delta':
+        raise ValueError("delta_grid only works for kernel='Delta'")
+    if M.use_covar:
+        raise ValueError("delta_grid cannot fit with the covariance matrix")
+
+    ref = M.Lref
+    if shifts is None:
+        dx = sp.median(sp.diff(ref.wv))
+        shifts = M.p['shift'] + dx*sp.r_[-10:10.001:0.05]
+        chi2prof = _delta_profile(D,ref,shifts)[2]
+        prob = sp.exp(-0.5*(chi2prof - chi2prof.min()))
+        prob /= prob.sum()
+        mu = sp.sum(prob*shifts)
+        sig = sp.sqrt(sp.sum(prob*(shifts - mu)**2))
+        half = max(10*sig,0.1*dx)
+        shifts = sp.linspace(mu - half,mu + half,401)
+    shifts = sp.asarray(shifts,dtype=float)
+
+    m2,sbest,chi2prof,d2,Y,V = _delta_profile(D,ref,shifts)
+    good = chi2prof < sp.inf
+    r  = ref.f[None,:]
+    er = ref.ef[None,:]**2
+
+    #scale grid that covers the conditional distributions of
+    #plausible shifts
+    serr = sp.sqrt(2./d2[good])
+    near = chi2prof[good] - chi2prof[good].min() < 25
+    scales = sp.linspace((sbest[good] - 6*serr)[near].min(),(sbest[good] + 6*serr)[near].max(),nscale)
+
+    chi2 = sp.zeros((shifts.size,scales.size))
+    for j,a in enumerate(scales):
+        chi2[:,j] = sp.sum(m2*(r - a*Y)**2/(er + a*a*V),axis=1)
+    chi2[~good,:] = sp.inf
+
+    #priors
+    prior_shift = sp.zeros(shifts.size)
+    prior_scale = sp.zeros(scales.size)
+    if 'shift' in M.prior_prob.keys():
+        prior_shift = prior_chi2(M.prior_prob['shift'],shifts)
+    if 'scale' in M.prior_prob.keys():
+        prior_scale = prior_chi2(M.prior_prob['scale'],scales)
+    chi2 += prior_shift[:,None] + prior_scale[None,:]
+
+    prob = sp.exp(-0.5*(chi2 - chi2.min()))
+    prob /= prob.sum()
+
+    def percentiles(x,px):
+        cdf = sp.cumsum(px)
+        return sp.interp([0.16,0.50,0.84],cdf - 0.5*px,x)
+
+    #best fit at the grid shift, with the exact best scale
+    chi2best = chi2prof + prior_shift
+    if 'scale' in M.prior_prob.keys():
+        chi2best += prior_chi2(M.prior_prob['scale'],sbest)
+    ibest = sp.argmin(chi2best)
+    M.p['shift'] = shifts[ibest]
+    M.p['scale'] = sbest[ibest]
+    if 'scale_err' in M.p.keys():
+        M.p['scale_err'] = sp.sqrt(2./d2[ibest])
+    pbest = deepcopy(M.p)
+
+    if M.profile is not None:
+        M.profile.add('grid',time() - t0)
+
+    M.grid_posterior = {'shift':shifts,'scale':scales,'chi2':chi2,'prob':prob,
+                        'percentiles':{'shift':percentiles(shifts,prob.sum(axis=1)),
+                                       'scale':percentiles(scales,prob.sum(axis=0))}}
+
+    if keep == 1:
+        #independent draws from the posterior, stored like an MCMC
+        c = Chain()
+        Mc = deepcopy(M)
+        isample = sp.random.choice(prob.size,size=nsample,p=prob.ravel())
+        for i in isample:
+            Mc.p['shift'] = shifts[i//scales.size]
+            Mc.p['scale'] = scales[i%scales.size]
+            c.add(Mc,chi2.ravel()[i])
+        return chi2best[ibest],pbest,1.0,c
+    else:
+        return chi2best[ibest],pbest,1.0
+
+
+def compare_kernels(chi2_simple,chi2_complex,ndata,nextra,criterion='bic',alpha=0.01):
+    """
+    Is a kernel with nextra more parameters (e.g., Gauss-Hermite
+    instead of Gauss) warranted by the improvement in chi^2?
+
+    criterion = 'bic' needs a drop in chi^2 larger than
+                nextra*ln(ndata) (Bayesian information criterion)
+                'lrt' needs a drop larger than the 1 - alpha point of
+                a chi^2 distribution with nextra degrees of freedom
+                (likelihood ratio test)
+
+    Returns True/False, the drop in chi^2, and the threshold.
+    """
+    dchi2 = chi2_simple - chi2_complex
+    if criterion == 'bic':
+        threshold = nextra*sp.log(ndata)
+    elif criterion == 'lrt':
+        threshold = chi2_dist.ppf(1 - alpha,nextra)
+    else:
+        raise ValueError("criterion must be 'bic' or 'lrt'")
+    return bool(dchi2 > threshold),float(dchi2),float(threshold)
+
+
+def _batch_kernels(kernelname,x,P,n=None):
+    """
+    For propagate_chain: the Gauss or Gauss-Hermite kernels (as
+    RescaleModel._Gauss and _Hermite) for all parameter sets in P, one
+    per row.  None for the Delta kernel.  n = the number of pixels of
+    each set (for RescaleModel.chi2_batch), if the kernel of each row
+    is cut as it would be for an x of that size.
+    """
+    if kernelname == 'Delta':
+        return None
+    dlambda = x[1] - x[0]
+    prange = sp.r_[ -(x.size //2) + 1 : (x.size)//2  ]
+    u = prange[None,:]/(sp.asarray(P['width'])[:,None]/dlambda)
+    k = sp.exp(-0.5*u**2)
+    if kernelname == 'Hermite':
+        #1 + h3 He_3(u) + h4 He_4(u)
+        k *= 1 + sp.asarray(P['h3'])[:,None]*(u**3 - 3*u) + sp.asarray(P['h4'])[:,None]*(u**4 - 6*u**2 + 3)
+    if n is not None:
+        k *= sp.absolute(prange)[None,:] <= (sp.asarray(n)//2 - 1)[:,None]
+    k /= abs(sp.sum(k,axis=1))[:,None]
+    return k
+
+def _convolve_rows(y,k):
+    #sp.convolve(y[i],k[i],mode='same') for every row, with FFTs
+    nfft = 2**int(sp.ceil(sp.log2(y.shape[1] + k.shape[1] - 1)))
+    full = fft.irfft(fft.rfft(y,nfft,axis=1)*fft.rfft(k,nfft,axis=1),nfft,axis=1)
+    i0 = (k.shape[1] - 1)//2
+    return full[:,i0:i0 + y.shape[1]]
+
+def propagate_chain(M,S,C,nsample=1000,burn=0.5,getcovar=False,chunk=200):
+    """
+    Uncertainty of the rescaled spectrum from the uncertainty of the
+    rescaling parameters.  Draws nsample parameter sets from Chain C
+    (after throwing out the first burn fraction), and applies each to
+    Spectrum S, as M.output would, but in batches of chunk samples:
+    the interpolation for all shifts is one sparse operator, and all
+    kernels are applied at once with FFTs.
+
+    M = RescaleModel for the kernel of the chain.  Parameters that
+        are not in the chain are fixed at M.p.  If the scale was solved
+        for at each step (scale_mode set, so the chain has scale_err),
+        each scale is drawn from N(scale, scale_err).
+    S = Spectrum, as it was fit (i.e., after the shift from the cross
+        correlation, see runner.py)
+
+    Returns Spectrum sout with the mean of the rescaled spectra, and
+    ef the data and model errors added in quadrature, the mask of
+    S.wv (only wavelengths covered for every sample are kept), and the
+    model error (standard deviation of the samples).  With
+    getcovar=True, the model covariance matrix is returned as well.
+    """
+    pchain = sp.array(C.pchain)
+    pchain = pchain[int(burn*pchain.shape[0])::]
+    isample = sp.random.randint(0,pchain.shape[0],nsample)
+    P = {}
+    for key in M.p.keys():
+        if key in C.index.keys():
+            P[key] = pchain[isample,C.index[key]]
+        else:
+            P[key] = sp.zeros(nsample) + M.p[key]
+    if 'scale_err' in C.index.keys():
+        #the chain has the conditional best scale, not a sample of it
+        serr = pchain[isample,C.index['scale_err']]
+        serr = sp.where(sp.isfinite(serr),serr,0.0)
+        P['scale'] = P['scale'] + serr*sp.random.randn(nsample)
+
+    m = (S.wv >= S.wv.min() - P['shift'].min())*(S.wv <= S.wv.max() - P['shift'].max())
+    x = S.wv[m]
+    k = _batch_kernels(M.kernelname,x,P)
+
+    Y = sp.zeros((nsample,x.size))
+    V = sp.zeros((nsample,x.size))
+    for i0 in range(0,nsample,chunk):
+        j = slice(i0,min(i0 + chunk,nsample))
+        X = x[None,:] + P['shift'][j,None]
+        A = S.interp_operator(X.ravel(),cache=False)
+        y = (A*S.f).reshape(X.shape)
+        v = propagate_var(A,S.ef**2).reshape(X.shape)
+        if k is not None:
+            y = _convolve_rows(y,k[j])
+            v = _convolve_rows(v,k[j]**2)
+        Y[j] = P['scale'][j,None]*y
+        V[j] = P['scale'][j,None]**2*v
+
+    mean = Y.mean(axis=0)
+    dY = Y - mean[None,:]
+    err_model = sp.sqrt(sp.sum(dY**2,axis=0)/(nsample - 1))
+
+    sout = Spectrum()
+    sout.wv = deepcopy(x)
+    sout.f  = mean
+    sout.ef = sp.sqrt(V.mean(axis=0) + err_model**2)
+    if getcovar:
+        return sout,m,err_model,sp.dot(dY.T,dY)/(nsample - 1)
+    return sout,m,err_model
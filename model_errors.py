@@ -0,0 +1,70 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import scipy as sp
+from spectrum import *
+from mapspec import *
+from runner import read_spec
+import sys,os
+
+"""
+Model errors of a rescaled spectrum, from the MCMC chain saved by
+do_map.py (chains/*.chain.gauss or chains/*.chain.herm).  Parameter
+sets are drawn from the chain and applied to the spectrum in batches
+(mapspec.propagate_chain), and the mean spectrum is written with the
+data and model errors added in quadrature, and the model errors alone:
+
+model_<spectrum>: wavelength, flux, error, model error
+
+With 'covar', the model covariance matrix is written to
+covar_matrices/covar_model_<spectrum>.  The kernel is read from the
+parameters in the chain.  If the chain has scale_err (the scale was
+solved for at each step), the scales are drawn from N(scale, scale_err).
+"""
+
+if len(sys.argv) < 6:
+    print 'Usage:'
+    print 'python  model_errors.py   ref.txt  window  istyle  spectrum  chain  [nsample]  [burn]  [covar]'
+    print 'nsample---  number of draws from the chain (default 1000)'
+    print 'burn---  fraction of the chain thrown out as burn in (default 0.5)'
+    print 'covar---  also write the model covariance matrix'
+    sys.exit()
+
+istyle = sys.argv[3]
+sref   = read_spec(sys.argv[1],style=istyle)
+window = sp.genfromtxt(sys.argv[2])
+nsample = int(sys.argv[6]) if len(sys.argv) > 6 else 1000
+burn = float(sys.argv[7]) if len(sys.argv) > 7 else 0.5
+get_covar = 'covar' in sys.argv[8:]
+
+lref = EmissionLine(sref,window[0],[ window[1],window[2] ] )
+
+#same shift from the cross correlation as do_map.py
+s = read_spec(sys.argv[4],style=istyle)
+s0 = CrossCorr(sref.f,sref.wv)(s.f,s.wv)
+s.wv -= s0[0]
+
+C = Chain()
+C.read(sys.argv[5])
+if 'h3' in C.index.keys():
+    kernel = 'Hermite'
+elif 'width' in C.index.keys():
+    kernel = 'Gauss'
+else:
+    kernel = 'Delta'
+#chains with scale_err solved for the scale at each step
+scale_mode = 'profile' if 'scale_err' in C.index.keys() else None
+M = RescaleModel(lref,kernel=kernel,scale_mode=scale_mode)
+
+out = propagate_chain(M,s,C,nsample=nsample,burn=burn,getcovar=get_covar)
+sout,m,err_model = out[0:3]
+
+name = os.path.basename(sys.argv[4])
+sp.savetxt('model_'+name,sp.c_[sout.wv,sout.f,sout.ef,err_model],fmt='% 6.2f % 4.4e % 4.4e % 4.4e')
+print '%s kernel, %d samples: median model error %.3g, median data error %.3g'%\
+    (kernel,nsample,sp.median(err_model),sp.median(sp.sqrt(sout.ef**2 - err_model**2)))
+
+if get_covar:
+    if not os.path.isdir('covar_matrices'):
+        os.makedirs('covar_matrices')
+    sp.savetxt(os.path.join('covar_matrices','covar_model_'+name),out[3])
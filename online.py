@@ -0,0 +1,109 @@
+import scipy as sp
+
+__all__ = ['OnlineStats']
+
+"""
+Summary statistics of a stream of parameter vectors (e.g., the steps
+of an MCMC) in fixed memory.  Values are collected in a small buffer,
+and each full buffer is merged into the running mean and covariance
+and into a quantile sketch, so that the cost per step is one row copy.
+"""
+
+
+class OnlineStats(object):
+    """
+    Running mean, covariance, and quantiles of vectors of npar values.
+
+    The quantiles are from a sketch of at most size weighted points
+    per parameter, evenly spaced in rank, so the error of a quantile is
+    about 1/size in probability.  The memory is fixed (nbuf + size
+    rows), however many vectors are added.
+
+    Examples
+    --------
+    >>> stats = OnlineStats(2)
+    >>> for x in sp.randn(100000,2): stats.add(x)
+    >>> print stats.mean(),stats.quantile([0.16,0.50,0.84])
+    """
+    def __init__(self,npar,size=200,nbuf=500):
+        self.npar = npar
+        self.size = size
+        self.buf = sp.zeros((nbuf,npar))
+        self.nbuf = 0
+        self.n = 0
+        self._mean = sp.zeros(npar)
+        self._m2 = sp.zeros((npar,npar))
+        #sketch: values and weights of each parameter
+        self.values = [ sp.zeros(0) for i in range(npar) ]
+        self.weights = [ sp.zeros(0) for i in range(npar) ]
+
+    def add(self,x):
+        """
+        Adds one vector of npar values.
+        """
+        self.buf[self.nbuf] = x
+        self.nbuf += 1
+        if self.nbuf == self.buf.shape[0]:
+            self._merge()
+
+    def count(self):
+        return self.n + self.nbuf
+
+    def mean(self):
+        self._merge()
+        return self._mean.copy()
+
+    def covar(self):
+        self._merge()
+        if self.n < 2:
+            return sp.zeros((self.npar,self.npar))
+        return self._m2/(self.n - 1)
+
+    def quantile(self,q):
+        """
+        Quantiles q (between 0 and 1) of each parameter, as an array of
+        shape (len(q), npar).
+        """
+        self._merge()
+        q = sp.atleast_1d(q)
+        out = sp.zeros((q.size,self.npar))
+        for i in range(self.npar):
+            w = self.weights[i]
+            if w.size == 0:
+                out[:,i] = sp.nan
+                continue
+            #rank of the center of each point
+            rank = sp.cumsum(w) - 0.5*w
+            out[:,i] = sp.interp(q*w.sum(),rank,self.values[i])
+        return out
+
+    def _merge(self):
+        #merges the buffer into the moments and the sketch
+        if self.nbuf == 0:
+            return
+        x = self.buf[:self.nbuf]
+        nb = self.nbuf
+        mb = x.mean(axis=0)
+        dx = x - mb
+        #combines the moments of two sets (Chan et al. 1979)
+        delta = mb - self._mean
+        ntot = self.n + nb
+        self._m2 += sp.dot(dx.T,dx) + sp.outer(delta,delta)*self.n*nb/float(ntot)
+        self._mean += delta*nb/float(ntot)
+        self.n = ntot
+        self.nbuf = 0
+
+        for i in range(self.npar):
+            v = sp.r_[self.values[i],x[:,i]]
+            w = sp.r_[self.weights[i],sp.ones(nb)]
+            isort = sp.argsort(v,kind='mergesort')
+            v,w = v[isort],w[isort]
+            if v.size > self.size:
+                #groups neighbours into size points of equal weight
+                group = sp.floor(self.size*(sp.cumsum(w) - 0.5*w)/w.sum()).astype(int)
+                wg = sp.bincount(group,weights=w)
+                keep = wg > 0
+                v = (sp.bincount(group,weights=w*v)[keep])/wg[keep]
+                w = wg[keep]
+            self.values[i] = v
+            self.weights[i] = w
@@ -0,0 +1,217 @@
+import scipy as sp
+from scipy import sparse
+from scipy.interpolate import interp1d,splev
+from scipy.linalg import solve_banded
+import hashlib
+from collections import OrderedDict
+
+from sinc_interp import SincInterp
+from bsplines import Bspline
+from grids import get_grid,grid_index
+
+__all__ = ['interp_operator','rebin_operator','convolve_operator','propagate_var','propagate_covar',
+           'spline_interp_var','clear_cache']
+
+"""
+Interpolation, rebinning, shifting, and convolution are all linear in
+the flux.  These functions return each operation as a sparse matrix A,
+so that the new flux is f' = A*f and the new covariance is C' = A C
+A^T, whatever the interpolation style.
+
+Operators only depend on the input and output grids, so the most
+recently used ones are cached and reused by any spectrum on the same
+grids.  One-off grids (e.g., a new shift at each step of an MCMC)
+should be built with cache=False, so that they do not push out the
+reusable operators or fill the memory.
+"""
+
+#number of operators, and total number of stored (nonzero) elements,
+#to keep around
+cache_size = 16
+cache_nnz = 2000000
+_cache = OrderedDict()
+
+def clear_cache():
+    _cache.clear()
+
+def _grid_key(x):
+    #evenly spaced grids are described by (start, step, n), otherwise
+    #use a hash of the array
+    grid = get_grid(x)
+    if grid is not None:
+        return grid
+    return (x.size,hashlib.md5(sp.ascontiguousarray(x).tostring()).hexdigest())
+
+def _cached(key,build):
+    #least recently used operators are dropped first
+    if key in _cache:
+        A = _cache.pop(key)
+        _cache[key] = A
+        return A
+    A = build()
+    if A.nnz > cache_nnz:
+        return A
+    _cache[key] = A
+    while len(_cache) > cache_size or sum([ B.nnz for B in _cache.values() ]) > cache_nnz:
+        _cache.popitem(last=False)
+    return A
+
+def interp_operator(x,xnew,style='linear',grid=None,window='lanczos',kw=15,order=3,cache=True):
+    """
+    Sparse matrix that interpolates data at x onto xnew, for any
+    style allowed by Spectrum.set_interp ('linear', 'sinc',
+    'bspline', or a 'kind' of scipy.interpolate.interp1d).
+
+    grid is (start, step, n) for x if evenly spaced (see
+    Spectrum.grid).  cache=False builds the operator without looking
+    in (or adding to) the cache, for grids that are only used once.
+    """
+    if grid is None:
+        grid = get_grid(x)
+    if not cache:
+        return _build_interp(x,xnew,style,grid,window,kw,order)
+    key = ('interp',grid if grid is not None else _grid_key(x),_grid_key(xnew),style,window,kw,order)
+    return _cached(key,lambda: _build_interp(x,xnew,style,grid,window,kw,order))
+
+def _build_interp(x,xnew,style,grid,window,kw,order):
+    if style == 'linear':
+        i,f = grid_index(x,xnew,grid)
+        rows = sp.r_[0:xnew.size]
+        return sparse.csr_matrix((sp.r_[1 - f,f],(sp.r_[rows,rows],sp.r_[i - 1,i])),
+                                 shape=(xnew.size,x.size))
+
+    elif style == 'sinc':
+        return SincInterp(x,sp.zeros(x.size),window=window,kw=kw,grid=grid).operator(xnew)
+
+    elif style == 'bspline':
+        #splines are linear in y, so interpolate each unit vector to get
+        #the columns
+        A = sp.zeros((xnew.size,x.size))
+        for j in range(x.size):
+            e = sp.zeros(x.size)
+            e[j] = 1.0
+            A[:,j] = Bspline(x,e,order=order)(xnew)
+        return sparse.csr_matrix(A)
+
+    else:
+        return sparse.csr_matrix(interp1d(x,sp.eye(x.size),kind=style,axis=0)(xnew))
+
+def rebin_operator(x,xnew,style='linear',grid=None,window='lanczos',kw=15,order=3,cache=True):
+    """
+    Sparse matrix for Spectrum.rebin: up sampling is interpolation,
+    down sampling takes the mean of the interpolated spectrum within
+    bins centered on xnew (xnew must be sorted).  cache as for
+    interp_operator.
+    """
+    if not cache:
+        return _build_rebin(x,xnew,style,grid,window,kw,order)
+    key = ('rebin',grid if grid is not None else _grid_key(x),_grid_key(xnew),style,window,kw,order)
+    return _cached(key,lambda: _build_rebin(x,xnew,style,grid,window,kw,order))
+
+def _build_rebin(x,xnew,style,grid,window,kw,order):
+    m = (x >= xnew[0])*(x <= xnew[-1])
+    if x[m].size <= xnew.size - 1:
+        return interp_operator(x,xnew,style,grid,window,kw,order,cache=False)
+
+    #define bins so that xnew is at the center, and interpolate to
+    #account for fractional pixel weights
+    db  = 0.5*sp.diff(xnew)
+    b2  = xnew[1::] - db
+    b2  = sp.insert(b2,0,xnew[0])
+    xinsert = sp.unique(sp.r_[x,xnew])
+    A = interp_operator(x,xinsert,style,grid,window,kw,order,cache=False)
+
+    #mean within each bin
+    i = sp.digitize(xinsert,b2)
+    use = (i >= 1)*(i <= b2.size)
+    nbin = sp.bincount(i,minlength=b2.size + 1)[1:b2.size + 1]
+    B = sparse.csr_matrix((1./nbin[i[use] - 1],(i[use] - 1,sp.r_[0:xinsert.size][use])),
+                          shape=(b2.size,xinsert.size))
+    return (B*A).tocsr()
+
+def convolve_operator(k,n,tol=1.e-12):
+    """
+    Sparse (banded) matrix K such that K*y = sp.convolve(y,k,mode='same')
+    for an array y of size n.
+
+    The tails of the kernel below tol*max(abs(k)) are trimmed
+    (symmetrically, so that the kernel stays centered).
+    """
+    k = sp.asarray(k,dtype=float)
+    big = sp.where(sp.absolute(k) > tol*sp.absolute(k).max())[0]
+    t = min(big.min(),k.size - 1 - big.max())
+    k = k[t:k.size - t]
+
+    cent = (k.size - 1)//2
+    offsets = cent - sp.r_[0:k.size]
+    use = sp.absolute(offsets) < n
+    return sparse.diags(list(k[use]),list(offsets[use]),shape=(n,n),format='csr')
+
+def propagate_var(A,v):
+    """
+    New variances (the diagonal of A C A^T) for independent errors
+    with variances v.
+    """
+    return A.multiply(A)*v
+
+def spline_interp_var(t,k,x,xnew,v,maxsize=2000000):
+    """
+    Variances at xnew of the spline with knots t and degree k that
+    interpolates data at x with variances v, i.e., propagate_var for
+    the interpolation operator A, but without building A column by
+    column.
+
+    A = B G^-1, where B and G are the (banded) B-spline bases at xnew
+    and x, so A^T is one banded solve with G^T (split up so that
+    the dense right hand side has at most maxsize elements).
+    """
+    n = len(t) - k - 1
+    ig,g = _bspline_basis(t,k,x)
+    ib,b = _bspline_basis(t,k,xnew)
+    #G^T in the banded storage of solve_banded
+    rows = ig.ravel()
+    cols = sp.repeat(sp.r_[0:x.size],k + 1)
+    lo = max((rows - cols).max(),0)
+    up = max((cols - rows).max(),0)
+    ab = sp.zeros((lo + up + 1,n))
+    ab[up + rows - cols,cols] = g.ravel()
+
+    out = sp.zeros(xnew.size)
+    chunk = max(maxsize//n,1)
+    for i0 in range(0,xnew.size,chunk):
+        j = sp.r_[i0:min(i0 + chunk,xnew.size)]
+        Bt = sp.zeros((n,j.size))
+        Bt[ib[j].ravel(),sp.repeat(sp.r_[0:j.size],k + 1)] = b[j].ravel()
+        W = solve_banded((lo,up),ab,Bt)
+        out[j] = sp.dot(v,W**2)
+    return out
+
+def _bspline_basis(t,k,x):
+    #indices and values of the k + 1 B-splines that can be nonzero at
+    #each x.  B-splines whose indices differ by k + 1 do not overlap,
+    #so each evaluation of a sum of every (k + 1)-th one gives one
+    #column.
+    n = len(t) - k - 1
+    l = sp.clip(sp.searchsorted(t,x,side='right') - 1,k,n - 1)
+    idx = l[:,None] - k + sp.r_[0:k + 1][None,:]
+    vals = sp.zeros(idx.shape)
+    for r in range(k + 1):
+        c = sp.zeros(len(t))
+        c[r:n:k + 1] = 1.0
+        vals[sp.r_[0:x.size],(r - l + k) % (k + 1)] = splev(x,(t,c,k))
+    return idx,vals
+
+def propagate_covar(A,C):
+    """
+    New covariance matrix A C A^T.  C can be a full (dense or sparse)
+    covariance matrix, or a 1D array of variances for independent
+    errors.  Returns a dense array.
+    """
+    if sp.ndim(C) == 1:
+        out = A.multiply(C[None,:]).dot(A.T)
+    else:
+        #C is symmetric, so A (A C)^T = A C A^T
+        out = A.dot(A.dot(C).T)
+    if sparse.issparse(out):
+        out = out.toarray()
+    return sp.asarray(out)
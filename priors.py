@@ -0,0 +1,186 @@
+import scipy as sp
+from collections import OrderedDict
+import json
+
+__all__ = ['TabulatedPrior','save_priors','load_priors','prior_chi2','prior_dchi2']
+
+"""
+Priors on the rescaling parameters, tabulated as -2 ln p on a fine,
+evenly spaced grid.  A prior is made once (from chain samples, with a
+kernel density estimate or a histogram, or from a function), and each
+evaluation is a linear interpolation in the table, for one value or
+an array.  Tables are saved to JSON (save_priors), so that the priors
+from one run can be used for later epochs without rebuilding them.
+"""
+
+
+def prior_chi2(prior,x):
+    """
+    -2 ln p of prior at x.  prior is a TabulatedPrior, or a function
+    that returns the prior probability (see
+    RescaleModel.make_func_prior).
+    """
+    if isinstance(prior,TabulatedPrior):
+        return prior.chi2(x)
+    return -2*sp.log(prior(x))
+
+def prior_dchi2(prior,x,h=1.e-6):
+    """
+    Derivative of prior_chi2(prior,x) with x.  Functions are
+    differentiated numerically (central differences, step h*max(1,|x|)).
+    """
+    if isinstance(prior,TabulatedPrior):
+        return prior.dchi2(x)
+    dx = h*sp.maximum(1.,sp.absolute(x))
+    return (prior_chi2(prior,x + dx) - prior_chi2(prior,x - dx))/(2*dx)
+
+
+class TabulatedPrior(object):
+    """
+    Prior tabulated as chi2 = -2 ln p on the grid x0 + dx*arange(n).
+    The probability is 0 (chi2 = inf) outside of the grid.
+
+    Examples
+    --------
+    >>> prior = TabulatedPrior.from_samples(chain_width,method='kde')
+    >>> prior.chi2(sp.array([1.5,1.8]))
+    >>> M.make_tab_prior('width',prior)
+    """
+    def __init__(self,x0,dx,table):
+        self.x0 = float(x0)
+        self.dx = float(dx)
+        self.table = sp.asarray(table,dtype=float)
+        #a probability is only known up to a constant
+        self.table -= self.table.min()
+
+    def grid(self):
+        return self.x0 + self.dx*sp.r_[0:self.table.size]
+
+    def chi2(self,x):
+        """
+        -2 ln p at x (a number or an array).
+        """
+        if sp.isscalar(x):
+            #one value per MCMC step, without array overheads
+            u = (x - self.x0)/self.dx
+            if u < 0 or u > self.table.size - 1:
+                return sp.inf
+            i = min(int(u),self.table.size - 2)
+            t = u - i
+            return (1 - t)*self.table[i] + t*self.table[i + 1]
+        u = (sp.asarray(x,dtype=float) - self.x0)/self.dx
+        i = sp.clip(sp.floor(u),0,self.table.size - 2).astype(int)
+        t = u - i
+        out = (1 - t)*self.table[i] + t*self.table[i + 1]
+        return sp.where((u >= 0)*(u <= self.table.size - 1),out,sp.inf)
+
+    def dchi2(self,x):
+        """
+        Derivative of chi2 at x (the slope of the table), 0 outside
+        of the grid.
+        """
+        u = (sp.asarray(x,dtype=float) - self.x0)/self.dx
+        i = sp.clip(sp.floor(u),0,self.table.size - 2).astype(int)
+        out = (self.table[i + 1] - self.table[i])/self.dx
+        return sp.where((u >= 0)*(u <= self.table.size - 1),out,0.)
+
+    def __call__(self,x):
+        """
+        Prior probability at x (normalized to 1 at the peak), as the
+        functions in RescaleModel.prior_prob.
+        """
+        return sp.exp(-0.5*self.chi2(x))
+
+    def as_dict(self):
+        return OrderedDict([('x0',self.x0),('dx',self.dx),('table',self.table.tolist())])
+
+    @classmethod
+    def from_dict(cls,d):
+        return cls(d['x0'],d['dx'],d['table'])
+
+    @classmethod
+    def from_function(cls,func,params,lo,hi,ngrid=1001):
+        """
+        Tabulates func(x,params), the prior probability (e.g., as for
+        RescaleModel.make_func_prior), between lo and hi.  func must
+        work on arrays.
+        """
+        x = sp.linspace(lo,hi,ngrid)
+        p = sp.asarray(func(x,params),dtype=float)
+        return cls(lo,x[1] - x[0],_density_chi2(p))
+
+    @classmethod
+    def from_samples(cls,samples,method='kde',bandwidth=None,nbins=50,ngrid=1001,pad=5.):
+        """
+        Prior from samples of a parameter (e.g., a chain of an earlier
+        epoch).
+
+        method = 'kde' for a Gaussian kernel density estimate, with
+                 bandwidth (default from Silverman's rule, which needs
+                 samples that are not all the same).  The grid covers
+                 the samples, plus pad bandwidths on each side.
+                 'hist' for a histogram with nbins bins, interpolated
+                 between bin centers.
+        """
+        x = sp.asarray(samples,dtype=float).ravel()
+        if x.size == 0:
+            raise ValueError('No samples')
+        if method == 'kde':
+            if bandwidth is None:
+                iqr = sp.subtract(*sp.percentile(x,[75,25]))
+                sig = min(x.std(),iqr/1.34) if iqr > 0 else x.std()
+                if sig == 0:
+                    raise ValueError('All samples are the same (a fixed parameter?)---give a bandwidth')
+                bandwidth = 0.9*sig*x.size**(-0.2)
+            if bandwidth <= 0:
+                raise ValueError('bandwidth must be > 0')
+            lo = x.min() - pad*bandwidth
+            hi = x.max() + pad*bandwidth
+            dx = (hi - lo)/(ngrid - 1)
+            #samples binned on the grid, then smoothed by the kernel
+            counts = sp.bincount(sp.floor((x - lo)/dx + 0.5).astype(int),minlength=ngrid)[:ngrid]
+            nk = min(int(pad*bandwidth/dx),(ngrid - 1)//2)
+            u = dx*sp.r_[-nk:nk + 1]
+            k = sp.exp(-0.5*(u/bandwidth)**2)
+            p = sp.convolve(counts,k,mode='same')
+            return cls(lo,dx,_density_chi2(p))
+        elif method == 'hist':
+            p,edges = sp.histogram(x,bins=nbins)
+            centers = 0.5*(edges[1:] + edges[:-1])
+            return cls(centers[0],centers[1] - centers[0],_density_chi2(p))
+        else:
+            raise ValueError("method must be 'kde' or 'hist'")
+
+    @classmethod
+    def from_chain(cls,C,pname,burn=0.5,**kw):
+        """
+        Prior from parameter pname of Chain C, after throwing out the
+        first burn fraction (see from_samples for the keywords).
+        """
+        x = sp.array(C.pchain)[:,C.index[pname]]
+        return cls.from_samples(x[int(burn*x.size)::],**kw)
+
+
+def _density_chi2(p,floor=1.e-30):
+    #-2 ln p, with p floored (relative to the peak) so that the table
+    #is finite and can be interpolated
+    p = sp.maximum(p,floor*p.max())
+    return -2*sp.log(p)
+
+
+def save_priors(ofile,priors):
+    """
+    Save a dictionary of TabulatedPriors (e.g., RescaleModel.prior_prob,
+    or one for each parameter name) to a JSON file.
+    """
+    fout = open(ofile,'w')
+    json.dump(OrderedDict([ (key,priors[key].as_dict()) for key in sorted(priors.keys())
+                            if isinstance(priors[key],TabulatedPrior) ]),fout)
+    fout.close()
+
+def load_priors(ifile):
+    """
+    Dictionary of TabulatedPriors saved with save_priors.
+    """
+    d = json.load(open(ifile))
+    return dict([ (key,TabulatedPrior.from_dict(d[key])) for key in d.keys() ])
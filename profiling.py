@@ -0,0 +1,134 @@
+from time import time
+from collections import OrderedDict
+import json
+
+__all__ = ['Profile','save_profiles']
+
+"""
+Opt-in timing of the stages of the rescaling model.  A RescaleModel
+with model.profile = Profile() records the wall time and number of
+calls of each stage, and metro_hast records the number of steps,
+acceptance, and total time.  With model.profile = None (the default),
+each stage costs one attribute lookup.
+"""
+
+
+class _Stage(object):
+    #context manager that adds the elapsed time to a Profile
+    def __init__(self,profile,name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time()
+
+    def __exit__(self,*args):
+        self.profile.add(self.name,time() - self.t0)
+
+
+class _NullStage(object):
+    #does nothing, used when profiling is off
+    def __enter__(self):
+        pass
+
+    def __exit__(self,*args):
+        pass
+
+null_stage = _NullStage()
+
+
+class Profile(object):
+    """
+    Cumulative wall time and call counts for named stages, plus the
+    number of MCMC steps, accepted steps, and the total time of the
+    run.
+
+    Copies of a model share the same Profile (deepcopy returns the
+    same object), so that the trial model in metro_hast is timed too.
+
+    Examples
+    --------
+    >>> M = RescaleModel(lref,kernel='Gauss')
+    >>> M.profile = Profile()
+    >>> metro_hast(5000,l,M)
+    >>> print M.profile.summary()
+    >>> M.profile.save('profile.json')
+    """
+    def __init__(self):
+        self.time = OrderedDict()
+        self.calls = OrderedDict()
+        self.steps = 0
+        self.accepted = 0
+        self.wall = 0.0
+
+    def __deepcopy__(self,memo):
+        return self
+
+    def stage(self,name):
+        """
+        Context manager that times the enclosed block as stage name.
+        """
+        return _Stage(self,name)
+
+    def add(self,name,dt,ncalls=1):
+        self.time[name] = self.time.get(name,0.0) + dt
+        self.calls[name] = self.calls.get(name,0) + ncalls
+
+    def add_run(self,steps,accepted,wall):
+        """
+        Record a run of steps (e.g., one call to metro_hast).
+        """
+        self.steps += steps
+        self.accepted += accepted
+        self.wall += wall
+
+    def as_dict(self):
+        out = OrderedDict()
+        out['stages'] = OrderedDict([ (name,{'time':self.time[name],'calls':self.calls[name]})
+                                      for name in self.time.keys() ])
+        out['steps'] = self.steps
+        out['accepted'] = self.accepted
+        out['wall'] = self.wall
+        out['steps_per_sec'] = self.steps/self.wall if self.wall > 0 else None
+        out['accept_rate'] = self.accepted/float(self.steps) if self.steps > 0 else None
+        return out
+
+    def summary(self):
+        """
+        Table of the stages, as a string.
+        """
+        lines = ['%-12s %10s %10s %12s'%('stage','time (s)','calls','per call (s)')]
+        for name in self.time.keys():
+            lines.append('%-12s %10.4f %10d %12.4e'%(name,self.time[name],self.calls[name],
+                                                     self.time[name]/self.calls[name]))
+        d = self.as_dict()
+        if self.steps > 0:
+            lines.append('steps: %d  steps/s: %.1f  acceptance: %.3f'%(self.steps,d['steps_per_sec'],d['accept_rate']))
+        return '\n'.join(lines)
+
+    def save(self,ofile):
+        fout = open(ofile,'w')
+        json.dump(self.as_dict(),fout,indent=1)
+        fout.close()
+
+    @classmethod
+    def combine(cls,profiles):
+        """
+        Sum of many Profiles (e.g., all spectra in a run).
+        """
+        out = cls()
+        for p in profiles:
+            for name in p.time.keys():
+                out.add(name,p.time[name],p.calls[name])
+            out.add_run(p.steps,p.accepted,p.wall)
+        return out
+
+def save_profiles(ofile,profiles):
+    """
+    Save a dictionary of Profiles (e.g., one for each kernel) to a
+    JSON file.
+    """
+    fout = open(ofile,'w')
+    json.dump(OrderedDict([ (key,profiles[key].as_dict()) for key in sorted(profiles.keys()) ]),
+              fout,indent=1)
+    fout.close()
@@ -0,0 +1,182 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import scipy as sp
+from spectrum import *
+import json
+import sys
+
+
+"""
+Non-interactive version of ref_smooth.py, for batch jobs.
+
+Calculates the resolution of a list of spectra (FWHM of Gaussian fits
+to an emission line, fit in parallel), chooses a target resolution
+with a cut rule, and smooths the reference spectrum 'sref' by a
+Gaussian kernel with
+
+kernel.FWHM**2 = target.FWHM**2 - sref.FWHM**2
+
+The target is the worst (highest) FWHM that passes the cut.  The cut
+rule is one of:
+
+percentile:q  ---  keep FWHMs at or below the q-th percentile of the
+                   FWHM distribution
+sigma:n       ---  iteratively clip FWHMs more than n standard
+                   deviations from the median (default is sigma:3)
+cut:x         ---  keep FWHMs at or below x angstroms (the interactive
+                   cut in ref_smooth.py, except that it also drops
+                   FWHMs equal to x)
+kernel:x      ---  skip the cut and smooth by a kernel with FWHM x
+                   angstroms (same as the manual option in ref_smooth.py)
+
+Writes the smoothed spectrum, 'ref_resolution.dat' (same format as
+ref_smooth.py), and 'ref_resolution.json', which has the fits of
+every spectrum and which passed the cut.  Values that do not apply
+(the cut and target of kernel:x) are null in the JSON file.
+
+The window file follows the usual format, i.e., 3 lines specifying:
+
+line_blue_edge     line_red_edge
+bluecont_blue_edge bluecont_red_edge
+redcont_blue_edge  redcont_red_edge
+"""
+
+if len(sys.argv) == 1:
+    print 'Usage:'
+    print 'python  ref_smooth_batch.py   infile.txt  speclist   window outfile.txt  [rule]  [nproc]'
+    print 'infile.txt---  input spectrum to smooth (usually the reference for alignment)'
+    print 'speclist--  1 col ascii file with list of files to compare---determines target resolution'
+    print 'window---  window file designating wavelengths for the EmissionLine'
+    print 'outfile.txt---  output spectrum, after smoothing'
+    print 'rule---  percentile:q, sigma:n, cut:x, or kernel:x (default sigma:3)'
+    print 'nproc---  number of processes for the fits (default 1)'
+    sys.exit()
+
+#reference
+sref = TextSpec(sys.argv[1],style='linear')
+#list of spectra
+speclist = sp.atleast_1d(sp.genfromtxt(sys.argv[2],dtype=str))
+#line used to calculate resolution
+window   = sp.genfromtxt(sys.argv[3])
+
+if len(sys.argv) > 5:
+    rule = sys.argv[5]
+else:
+    rule = 'sigma:3'
+rulename,ruleval = rule.split(':')
+ruleval = float(ruleval)
+if rulename not in ['percentile','sigma','cut','kernel']:
+    raise ValueError('Unknown cut rule: '+rule)
+
+if len(sys.argv) > 6:
+    nproc = int(sys.argv[6])
+else:
+    nproc = 1
+
+
+lref = EmissionLine(sref,window[0],[window[1],window[2]])
+lcenter = lref.wv_mean()
+
+#model as a Gaussian, so that everything is measured in the same way
+lmodelref = LineModel(lref,func='gaussian')
+#convert sigma to FWHM
+res = abs(lmodelref.p[2])*2.35
+
+L,fwhm_direct = [],[]
+for spec in speclist:
+    s = TextSpec(spec)
+    l = EmissionLine(s,window[0],[window[1],window[2]])
+    L.append(l)
+    fwhm_direct.append(l.fwhm(lcenter)[0])
+
+fits = fit_lines(L,func='gaussian',nproc=nproc)
+centdist = sp.array([ p[1] for p in fits['p'] ])
+dispdist = sp.absolute(sp.array([ p[2] for p in fits['p'] ]))*2.35
+
+print 'name         FWHM, FWHM fit'
+for spec,fwhm,disp in zip(speclist,fwhm_direct,dispdist):
+    print spec,fwhm,disp
+print 'parameters of reference fit: (scale, center, width):',lmodelref.p
+print 'native reference resolution:',res
+
+
+#which spectra pass the cut
+if rulename == 'percentile':
+    cut = sp.percentile(dispdist,ruleval)
+    m = dispdist <= cut
+elif rulename == 'sigma':
+    m = sp.ones(dispdist.size,dtype=bool)
+    while True:
+        med,std = sp.median(dispdist[m]),sp.std(dispdist[m])
+        mnew = sp.absolute(dispdist - med) <= ruleval*std
+        if (mnew == m).all() or mnew.sum() == 0:
+            break
+        m = mnew
+    cut = dispdist[m].max()
+elif rulename == 'cut':
+    cut = ruleval
+    m = dispdist <= cut
+else:
+    cut = sp.nan
+    m = sp.ones(dispdist.size,dtype=bool)
+
+if m.sum() == 0:
+    raise ValueError('Cut is below the lowest FWHM: '+rule)
+
+#smoothing width (sigma) to get to max resolution below the cut
+if rulename == 'kernel':
+    target = sp.nan
+    newres = ruleval/2.35
+else:
+    target = dispdist[m].max()
+    if target > res:
+        newres = sp.sqrt(target**2 - res**2 )/2.35
+    else:
+        print 'Reference resolution is already worse than the target---not smoothing'
+        newres = 0.0
+    print 'max resolution below the cut:', target
+print 'smoothing width (FWHM):',newres*2.35, '('+str(2.35*newres/(sref.wv[1] - sref.wv[0]))+' pixels)'
+
+#do the smoothing
+if newres > 0:
+    newres_pix =  newres/(sref.wv[1] - sref.wv[0])
+    #kernel is +/- 5 sigma, and must have an odd number of pixels
+    sref.smooth(2*int(5*newres_pix) + 1, name = ('gaussian', newres_pix) )
+lref = EmissionLine(sref,window[0],[window[1],window[2]])
+lmodel = LineModel(lref,func='gaussian')
+res2 = abs(lmodel.p[2])*2.35
+print 'new reference resolution:',res2
+
+sp.savetxt(sys.argv[4],sp.c_[sp.real(sref.wv),sp.real(sref.f),sp.real(sref.ef)])
+
+fout = open('ref_resolution.dat','w')
+fout.write('Ref native resolution:    % 2.4f\n'%res)
+fout.write('Cut for worst resolution: % 2.4f\n'%cut)
+fout.write('Worst object  below cut:  % 2.4f\n'%target)
+fout.write('Kernel width:             % 2.4f\n'%(newres*float(2.35)) )
+fout.write('New ref resolution:       % 2.4f\n'%res2)
+fout.close()
+
+#NaN is not valid JSON, so anything undefined is written as null
+tojson = lambda x: float(x) if sp.isfinite(x) else None
+summary = {'rule':rule,
+           'native_fwhm':tojson(res),
+           'cut':tojson(cut),
+           'target_fwhm':tojson(target),
+           'kernel_fwhm':tojson(newres*2.35),
+           'new_fwhm':tojson(res2),
+           'nused':int(m.sum()),
+           'center_median':tojson(sp.median(centdist)),
+           'center_std':tojson(sp.std(centdist)),
+           'spectra':[ {'name':str(spec),
+                        'fwhm_fit':tojson(disp),
+                        'fwhm':tojson(fwhm),
+                        'center':tojson(cent),
+                        'chi2':tojson(chi2),
+                        'used':bool(use)}
+                       for spec,disp,fwhm,cent,chi2,use in
+                       zip(speclist,dispdist,fwhm_direct,centdist,fits['chi2'],m) ]}
+fout = open('ref_resolution.json','w')
+json.dump(summary,fout,indent=1)
+fout.close()
@@ -0,0 +1,206 @@
+import scipy as sp
+from scipy.optimize import minimize_scalar
+from multiprocessing import Pool
+from spectrum import Spectrum
+
+__all__ = ['get_chi2','align','align_all','CoAdd']
+
+"""
+Tools for building a reference spectrum (see ref_make.py): aligning
+spectra to each other with a deterministic search for the shift, and
+combining them with a weighted average.
+"""
+
+
+def get_chi2(s1,s2,shift,trim=None):
+    """
+    chi^2 between spectrum s2 and spectrum s1 shifted by shift
+    (s1 is interpolated at s2.wv - shift).
+
+    trim is the number of pixels dropped at each end of s2.  The
+    default is just enough to cover the shift, but then the degrees
+    of freedom change with the shift---align fixes trim for the
+    whole search.
+    """
+    return sp.sum(_chi2_terms(s1,s2,shift,trim))
+
+def _chi2_terms(s1,s2,shift,trim=None):
+    #contribution of each pixel to chi^2
+    if trim is None:
+        trim = int(abs(shift/(s1.wv[1] - s1.wv[0]))) + 1
+    xnew = s2.wv[trim : -trim] - shift
+    #resample the reference at the new wavelength grid
+    y1,z1 = s1.interp(xnew)
+
+    return (y1 - s2.f[trim: - trim])**2/(z1**2 + s2.ef[trim: - trim]**2)
+
+def _parabola(x,y,i):
+    #vertex of the parabola through (x,y) at i-1, i, i+1 (evenly
+    #spaced x), for each row of y
+    rows = sp.r_[0:y.shape[0]]
+    c0,c1,c2 = y[rows,i - 1],y[rows,i],y[rows,i + 1]
+    denom = c0 - 2*c1 + c2
+    frac = sp.where(denom > 0,0.5*(c0 - c2)/sp.where(denom > 0,denom,1.0),0.0)
+    return x[i] + frac*(x[1] - x[0])
+
+def align(s1,s2,shift0=0.0,width=2.0,step=0.1,nboot=0):
+    """
+    Find the shift that best aligns s2 with s1 (minimizes
+    get_chi2).  The objective is smooth and 1D, so chi^2 is
+    calculated on a grid of shifts (shift0 +/- width pixels, in steps
+    of step pixels), and the minimum is refined with a bounded
+    (golden section/parabolic) search between the neighboring grid
+    points.  The same pixels are used for every shift.
+
+    nboot > 0 estimates the uncertainty on the shift by resampling
+    the pixels (with replacement) nboot times, and finding the
+    minimum on the grid for each (refined with a parabola).
+
+    Returns chi2, shift, and the bootstrap uncertainty (None if nboot
+    = 0).
+    """
+    dx = s1.wv[1] - s1.wv[0]
+    trim = int(abs(shift0)/dx + width) + 1
+    shifts = shift0 + dx*sp.r_[-width:width + 0.5*step:step]
+
+    terms = sp.array([ _chi2_terms(s1,s2,shift,trim) for shift in shifts ])
+    chi2 = terms.sum(axis=1)
+    i = int(sp.clip(sp.argmin(chi2),1,shifts.size - 2))
+
+    res = minimize_scalar(lambda x: get_chi2(s1,s2,x,trim),
+                          bounds=(shifts[i - 1],shifts[i + 1]),method='bounded',
+                          options={'xatol':1.e-4*dx})
+    chi2best,shift = res.fun,res.x
+    if chi2[i] < chi2best:
+        chi2best,shift = chi2[i],shifts[i]
+
+    eshift = None
+    if nboot > 0:
+        npix = terms.shape[1]
+        counts = sp.random.multinomial(npix,sp.ones(npix)/npix,size=nboot)
+        chi2boot = sp.dot(counts,terms.T)
+        iboot = sp.clip(sp.argmin(chi2boot,axis=1),1,shifts.size - 2)
+        eshift = sp.std(_parabola(shifts,chi2boot,iboot))
+
+    return chi2best,shift,eshift
+
+def align_all(s1,slist,shifts0=None,nproc=1,**kw):
+    """
+    Align every spectrum in slist with s1 (see align, kw are passed
+    along).  shifts0 are the starting shifts (e.g., from
+    mapspec.get_cc), default is 0.  nproc > 1 aligns the spectra in a
+    process pool.
+
+    Returns arrays of chi2, shift, and bootstrap uncertainty.
+    """
+    if shifts0 is None:
+        shifts0 = sp.zeros(len(slist))
+    ref = _spec_data(s1)
+    args = [ (ref,_spec_data(s),shift0,kw) for s,shift0 in zip(slist,shifts0) ]
+
+    if nproc > 1:
+        pool = Pool(nproc)
+        try:
+            out = pool.map(_align_one,args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        out = [ _align_one(a) for a in args ]
+
+    chi2,shift,eshift = zip(*out)
+    eshift = [ sp.nan if e is None else e for e in eshift ]
+    return sp.array(chi2),sp.array(shift),sp.array(eshift)
+
+def _spec_data(s):
+    #spectra are passed to the process pool as plain arrays
+    return (s.wv,s.f,s.ef,s.style)
+
+def _make_spec(data):
+    wv,f,ef,style = data
+    s = Spectrum(style=style)
+    s.wv = wv
+    s.f  = f
+    s.ef = ef
+    return s
+
+def _align_one(args):
+    #helper for align_all.  Must be at the top level of the module for
+    #the process pool.
+    ref,data,shift0,kw = args
+    return align(_make_spec(ref),_make_spec(data),shift0,**kw)
+
+
+class CoAdd(object):
+    """
+    Streaming inverse-variance weighted average of spectra on a fixed
+    wavelength grid.  Spectra are added one at a time, and only the
+    running sums of f/sigma^2 and 1/sigma^2 (and the number of
+    spectra that cover each pixel) are kept, so the memory does not
+    grow with the number of spectra.
+
+    For sigma clipping, make a second CoAdd with clip set to the
+    first, and add the same spectra again: pixels more than nsigma
+    errors from the first average are left out.
+
+    Parameters
+    ----------
+    wv = output wavelengths
+    clip = CoAdd from a previous pass, for sigma clipping
+    nsigma = clipping threshold (in units of the error of each pixel)
+
+    Examples
+    --------
+    >>> c = CoAdd(s0.wv)
+    >>> for s,shift in zip(speclist,shifts): c.add(s,shift)
+    >>> c2 = CoAdd(s0.wv,clip=c,nsigma=3.)
+    >>> for s,shift in zip(speclist,shifts): c2.add(s,shift)
+    >>> wv,f,ef = c2.result()
+    """
+    def __init__(self,wv,clip=None,nsigma=3.0):
+        self.wv = wv
+        self.sumfw = sp.zeros(wv.size)
+        self.sumw = sp.zeros(wv.size)
+        self.ncover = sp.zeros(wv.size,dtype=int)
+        self.nspec = 0
+        #number of pixels removed by clipping
+        self.nclip = 0
+
+        if clip is not None:
+            m = clip.ncover > 0
+            self._fclip = sp.zeros(wv.size)*sp.nan
+            self._fclip[m] = sp.interp(wv[m],clip.wv[m],(clip.sumfw/sp.where(m,clip.sumw,1.0))[m])
+        self.clip = clip
+        self.nsigma = nsigma
+
+    def add(self,s,shift=0.0):
+        """
+        Add spectrum s, aligned by s.wv -= shift (s itself is not
+        changed).  s is interpolated onto self.wv where it is
+        defined.
+        """
+        m = (self.wv + shift >= s.wv.min())*(self.wv + shift <= s.wv.max())
+        y,z = s.interp(self.wv[m] + shift)
+        w = 1./z**2
+
+        if self.clip is not None:
+            bad = sp.absolute(y - self._fclip[m]) > self.nsigma*z
+            bad[sp.isnan(self._fclip[m])] = False
+            self.nclip += bad.sum()
+            w[bad] = 0.0
+
+        self.sumfw[m] += y*w
+        self.sumw[m] += w
+        self.ncover[m] += 1
+        self.nspec += 1
+
+    def result(self,mincover=1):
+        """
+        Returns wavelengths, weighted average, and its error, where at
+        least mincover spectra were added (mincover=None means all of
+        them).
+        """
+        if mincover is None:
+            mincover = self.nspec
+        m = (self.ncover >= mincover)*(self.sumw > 0)
+        return self.wv[m],self.sumfw[m]/self.sumw[m],sp.sqrt(1./self.sumw[m])
@@ -26,8 +26,8 @@ python ../../do_map.py ref.smooth.txt oiii.window linear speclist_use mapspec.pa
 #you must specify blue before red wavelengths.  See EmissionLine class
 #in spectrum.py for more info.
 
-#linear is the type of interpolation.  Other options exists, but
-#linear is the only option that rigorously does the errors
+#linear is the type of interpolation.  Other options exists (errors are
+#propagated for all of them), but linear is the fastest
 
 #speclist_use is a 1 column ascii file, corresponding to the list of
 #spectra that will be matched to the reference.
@@ -43,6 +43,40 @@ python ../../do_map.py ref.smooth.txt oiii.window linear speclist_use mapspec.pa
 #you posterior distributions for the rescaling parameters.  To turn
 #off, set 'no_chains'
 
+#an optional last argument 'profile' times each stage of the fits, and
+#writes the timings for each spectrum and the whole run to profiles/
+
+#an optional argument 'store' saves the rescaled spectra and covariance
+#matrices in one binary store (mapspec.bin and mapspec.idx) instead of
+#text files.  Only the band of each covariance matrix is kept, and
+#'float32' and 'compress' make them smaller still, e.g.
+#python ../../do_map.py ref.smooth.txt oiii.window linear speclist_use mapspec.params covar chains store float32
+#python ../../store_to_text.py mapspec writes the usual text files.
+
+#to rescale new spectra as they are written to a directory (e.g.,
+#incoming/) during a campaign, use watch_map.py with the same
+#arguments, but the directory instead of the list of spectra:
+#python ../../watch_map.py ref.smooth.txt oiii.window linear incoming mapspec.params no_covar chains store
+
+#an optional argument 'nproc=N' fits the spectra with N worker
+#processes, which share one memory-mapped copy of the reference, e.g.
+#python ../../do_map.py ref.smooth.txt oiii.window linear speclist_use mapspec.params no_covar chains nproc=4
+
+#on a slow (e.g., network) disk, 'prefetch' reads the next spectra
+#and writes the outputs in background threads while the fits run
+
+#'select=bic' or 'select=lrt' only runs the full Gauss-Hermite chain
+#when a short pilot chain shows that h3 and h4 improve the fit (the
+#decision is in the last 4 columns of mapspec.params)
+
+#with linear interpolation, 'hmc' samples the Gauss and Gauss-Hermite
+#chains with Hamiltonian Monte Carlo (analytic gradients), which gives
+#many more independent samples for the same number of chi^2 evaluations
+
+#'tempered' samples with parallel tempering instead, for spectra whose
+#shift posterior has more than one mode (e.g., the cross correlation
+#is off by a pixel), which would otherwise trap the chain
+
 #see do_map.py for more.  As a default, it will output rescaled
 #spectra, MCMC chains, and a summary file (mapspec.params). Note that
 #do_map.py does some crude model comparisons between smoothing with
@@ -0,0 +1,733 @@
+import scipy as sp
+import matplotlib.pyplot as plt
+from spectrum import *
+from mapspec import *
+from priors import load_priors
+from collections import OrderedDict
+from multiprocessing import Pool
+import threading
+import Queue
+import tempfile
+import shutil
+import json
+import os
+
+__all__ = ['MapRunner','read_spec','params_line','parse_options','run_parallel','share_reference','attach_reference',
+           'Writer','prefetch','run_pipeline']
+
+"""
+The fits that do_map.py runs on each spectrum, as an object that
+keeps the reference in memory, so that other drivers (e.g.,
+watch_map.py) can fit one spectrum at a time.
+"""
+
+
+def read_spec(ifile,style='linear'):
+    """
+    FitsSpec for .fits files, otherwise TextSpec.
+    """
+    if ifile.lower().endswith('.fits') or ifile.lower().endswith('.fit'):
+        return FitsSpec(ifile,style=style)
+    return TextSpec(ifile,style=style)
+
+
+def params_line(out):
+    """
+    Line of the parameter file (e.g., mapspec.params) for the output
+    of MapRunner.run.  With kernel selection (MapRunner.select), the
+    decision is in 4 extra columns at the end.
+    """
+    d,g,h = out['Delta'],out['Gauss'],out['Hermite']
+    line = "%15s % 8.4f  %10.2f % 8.4f % 8.4f % 5.2f %10.2f % 8.4f % 8.4f % 8.4f % 5.2f % 10.2f % 8.4f % 8.4f % 8.4f % 5.4e % 5.4e %8.4f\n"%\
+        (out['name'],out['cc_shift'],
+         d['chi2'],d['shift'],d['scale'],d['frac'],
+         g['chi2'],g['shift'],g['scale'],g['width'],g['frac'],
+         h['chi2'],h['shift'],h['scale'],h['width'],h['h3'],h['h4'],h['frac'])
+    if out.get('select') is not None:
+        #staged kernel selection: drop in chi^2 from the pilot
+        #Gauss-Hermite chain, threshold, full chain run (1) or not
+        #(0), and Gauss-Hermite steps saved
+        s = out['select']
+        line = line[:-1] + " % 10.2f % 8.2f %1d %7d\n"%(s['dchi2'],s['threshold'],s['run'],s['steps_saved'])
+    return line
+
+def parse_options(options,extra=()):
+    """
+    Optional keywords of do_map.py, watch_map.py, and map_daemon.py
+    (the 'options' of a job), e.g., ['store','thin=10','hmc'].
+    Returns the MapRunner keywords for the fits, and a dictionary of
+    the options for the run.  extra = names of options that only one
+    driver takes (e.g., 'poll' for watch_map.py), which are returned
+    with the run options (the value as a string, or True).  Unknown
+    options raise a ValueError.
+
+    Fits:
+    profile           --- time each stage of the fits
+    select=bic|lrt    --- run a short pilot Gauss-Hermite chain first,
+                          and only finish it if h3 and h4 improve the
+                          fit significantly (see MapRunner.select)
+    thin=N            --- keep only every N-th step of the chains
+    maxkeep=N         --- keep at most N steps (the thinning doubles
+                          as needed).  Summaries of all steps are saved
+                          next to each chain either way.
+    burn=F            --- fraction of each chain left out of its
+                          summary as burn in (default 0.5)
+    priors=file.json  --- tabulated priors, e.g., made with
+                          make_priors.py from the chains of earlier
+                          epochs
+    hmc               --- sample with Hamiltonian Monte Carlo (linear
+                          interpolation only, see mapspec.hmc)
+    tempered          --- sample with parallel tempering, for shift
+                          posteriors with more than one mode (see
+                          mapspec.tempered)
+
+    Run:
+    store             --- save the rescaled spectra and covariances in
+                          one RunStore, instead of a text file for each
+    float32, compress --- make the covariances in the store smaller
+    nproc=N           --- fit with N worker processes (run_parallel)
+    prefetch          --- read the spectra and write the outputs in
+                          background threads (run_pipeline)
+    """
+    kw = {}
+    run = {'store':False,'float32':False,'compress':False,'nproc':1,'prefetch':False}
+    for opt in options:
+        key,eq,val = opt.partition('=')
+        if key == 'profile':
+            kw['get_profile'] = True
+        elif key == 'select':
+            kw['select'] = val
+        elif key in ['thin','maxkeep']:
+            kw[key] = int(val)
+        elif key == 'burn':
+            kw['burn'] = float(val)
+        elif key == 'priors':
+            kw['priors'] = load_priors(val)
+        elif key in ['hmc','tempered']:
+            #tempered wins if both are given
+            if kw.get('sampler') != 'tempered':
+                kw['sampler'] = key
+        elif key == 'nproc':
+            run['nproc'] = int(val)
+        elif key in ['store','float32','compress','prefetch']:
+            run[key] = True
+        elif key in extra:
+            run[key] = val if eq else True
+        else:
+            raise ValueError('Unknown option: '+opt)
+    return kw,run
+
+
+class MapRunner(object):
+    """
+    Rescales spectra to a reference, in the same way as do_map.py:
+    cross correlation against the reference, then the Delta (on a
+    grid), Gauss, and Gauss-Hermite kernels.  The Gauss and
+    Gauss-Hermite fits are applied to the whole spectrum (or the Delta
+    fit, if it has a lower chi^2).
+
+    The reference line and the Fourier transform of the reference
+    (for the cross correlation) are made once, so each call only costs
+    the fits of that spectrum.
+
+    Parameters
+    ----------
+    sref = reference Spectrum
+    window = window of the reference line (3x2, see run_map.sh)
+    istyle = interpolation style
+    fout = open file for the parameters of each fit (see do_map.py for
+           the columns), or None
+    store = RunStore for the rescaled spectra and covariances, or None
+            to write text files in outdir
+    get_covar = save the covariance matrices
+    get_chains = save the MCMC chains in outdir/chains
+    get_profile = time the stages of each fit (saved in
+                  outdir/profiles)
+    nstep_gauss, nstep_herm = number of MCMC steps
+    outdir = directory for the outputs
+    kernels = kernels to fit (any of 'Delta', 'Gauss', and 'Hermite')
+    thin, maxkeep = thinning of the MCMC chains, and the most steps
+                    kept in memory and saved (see mapspec.Chain).
+                    Summaries of every step are saved next to the
+                    chains either way.
+    burn = fraction of each metro_hast chain left out of its summary
+           as burn in (nburn, see mapspec.Chain).  The default 0.5 is
+           the same as make_priors.py and TabulatedPrior.from_chain.
+           The burn in of a staged Gauss-Hermite chain is that of the
+           pilot.  hmc and tempered leave out their tuning steps
+           instead.
+    priors = dictionary of priors for any of the parameters (e.g.,
+             TabulatedPriors from priors.load_priors), used for every
+             kernel that has that parameter
+    sampler = 'metro_hast', or 'hmc' for Hamiltonian Monte Carlo with
+              analytic gradients (mapspec.hmc, linear interpolation
+              only).  hmc runs nstep/10 trajectories of 10 leapfrog
+              steps on average, so the number of likelihood
+              evaluations is about the same.  'tempered' for parallel
+              tempering (mapspec.tempered), for shift posteriors with
+              more than one mode: nstep/2 trials of all temperatures,
+              which take about as long as nstep metro_hast steps.  The
+              swap rates are in the output ('swap_rates').
+    select = None to always run the full Gauss-Hermite chain, or 'bic'
+             or 'lrt' to run a pilot chain of nstep_pilot steps first,
+             and only finish the chain if the drop in chi^2 from the
+             best simpler kernel passes that test (see
+             mapspec.compare_kernels, alpha is for 'lrt')
+    cc = CrossCorr of the reference, if already made (e.g., by
+         attach_reference)
+    writer = Writer for the output files, or None to write them
+             before run returns (see run_pipeline)
+
+    Examples
+    --------
+    >>> runner = MapRunner(sref,window,fout=open('mapspec.params','a'))
+    >>> for spec in speclist: runner.run(spec)
+    """
+    def __init__(self,sref,window,istyle='linear',fout=None,store=None,
+                 get_covar=False,get_chains=False,get_profile=False,
+                 nstep_gauss=5000,nstep_herm=20000,outdir='.',kernels=('Delta','Gauss','Hermite'),
+                 cc=None,writer=None,select=None,nstep_pilot=2000,alpha=0.01,
+                 thin=1,maxkeep=None,burn=0.5,priors=None,sampler='metro_hast'):
+        self.sref = sref
+        self.window = window
+        self.istyle = istyle
+        #pops out the line from the reference spectrum
+        self.lref = EmissionLine(sref,window[0],[ window[1],window[2] ] )
+        if cc is None:
+            cc = CrossCorr(sref.f,sref.wv)
+        self.cc = cc
+
+        self.fout = fout
+        self.store = store
+        self.get_covar = get_covar
+        self.get_chains = get_chains
+        self.get_profile = get_profile
+        self.nstep_gauss = nstep_gauss
+        self.nstep_herm = nstep_herm
+        self.outdir = outdir
+        self.kernels = kernels
+        self.priors = {} if priors is None else priors
+        if sampler not in ['metro_hast','hmc','tempered']:
+            raise ValueError("sampler must be 'metro_hast', 'hmc', or 'tempered'")
+        if sampler == 'hmc' and istyle != 'linear':
+            raise ValueError("hmc needs linear interpolation")
+        self.sampler = sampler
+        self.thin = thin
+        self.maxkeep = maxkeep
+        self.burn = burn
+        self.select = select
+        self.nstep_pilot = nstep_pilot
+        self.alpha = alpha
+        self.writer = writer
+        self.run_profiles = {'Delta':[], 'Gauss':[], 'Hermite':[]}
+
+    def run(self,spec,s=None,kernels=None,outdir=None):
+        """
+        Fit spectrum spec (a file name, see read_spec), or Spectrum s
+        with name spec.  Output files are named after the base name of
+        spec, and written to outdir (default self.outdir).  kernels
+        is a list of the kernels to fit (default self.kernels).
+        Returns the parameters of each fit, and the output files.
+        """
+        name = os.path.basename(spec)
+        if s is None:
+            s = read_spec(spec,style=self.istyle)
+        if kernels is None:
+            kernels = self.kernels
+        if outdir is None:
+            outdir = self.outdir
+        self._makedirs(outdir)
+        output = []
+
+        s0 = self.cc(s.f,s.wv)
+        s.wv -= s0[0]
+
+        l = EmissionLine(s,self.window[0],[ self.window[1],self.window[2] ])
+        l.set_interp(style=self.istyle)
+
+        profiles = {'Delta':Profile(), 'Gauss':Profile(), 'Hermite':Profile()}
+
+        #values for failed (or skipped) fits
+        chi2_delta,p_delta,frac_delta = 999,{'shift':-99, 'scale':-99}, 0
+        chi2_gauss,p_gauss,frac_gauss = 999,{'shift':-99, 'scale':-99, 'width':-99}, 0
+        chi2_herm,p_herm,frac_herm = 999, {'shift':99,'scale':-99,'width':-99,'h3':-99,'h4':-99}, 0
+        #swap rates of the tempered chains (sampler='tempered')
+        swap_rates = {}
+
+        if 'Delta' in kernels:
+            f   = RescaleModel(self.lref,kernel="Delta")
+            if self.get_profile: f.profile = profiles['Delta']
+            self._set_priors(f)
+            try:
+#               Only shift and scale, so the posterior is calculated on a grid
+#               instead of with an MCMC (frac_delta is always 1)
+                chi2_delta,p_delta,frac_delta = delta_grid(l,f,keep=False)
+                print frac_delta
+            except:
+                pass
+
+        if 'Gauss' in kernels:
+            f    = RescaleModel(self.lref,kernel="Gauss")
+            if self.get_profile: f.profile = profiles['Gauss']
+            self._set_priors(f)
+
+            chain_gauss = None
+            try:
+#               keep = True returns the chain, which can be saved and used latter for getting model errors (model_errors.py).
+                chi2_gauss,p_gauss,frac_gauss,chain_gauss = self._sample(self.nstep_gauss,l,f)
+#               Try this code to watch the chain as it progresses
+#                plt.ion()
+#                chi2_gauss,p_gauss,frac_gauss,chain_gauss = metro_hast(5000,l,f,keep=True,plot=True)
+                print frac_gauss
+            except:
+                pass
+            if hasattr(f,'swap_rates'):
+                swap_rates['Gauss'] = f.swap_rates.tolist()
+
+            if chi2_delta < chi2_gauss:
+                f.p = {'shift':p_delta['shift'], 'scale':p_delta['scale'], 'width': 0.001 }
+            else:
+                f.p = p_gauss
+            output += self._save(f,s,outdir,'scale_'+name,'covar_'+name)
+            if self.get_chains and chain_gauss is not None:
+                self._save_chain(chain_gauss,os.path.join(outdir,'chains',name+'.chain.gauss'))
+
+        if 'Hermite' in kernels:
+#           The scale is solved for at each step (scale_mode='profile'), so
+#           the chain only has to explore shift, width, h3, and h4---this
+#           converges in far fewer steps than sampling all 5 parameters.
+            f    = RescaleModel(self.lref,kernel="Hermite",scale_mode='profile')
+            if self.get_profile: f.profile = profiles['Hermite']
+            self._set_priors(f)
+#           Here is an example of how to put in a prior----we are using the
+#           posterior distribution of the kernel width from the pure Gaussian
+#           as a prior on the width for the Gauss-Hermite kernel.
+#           'burn=0.75' means we throw out the first 3/4 of the chain
+#           (assumed to be burn in).
+
+#            f.make_dist_prior(chain_gauss,'width', burn=0.75)
+
+#           Or, you can specify an analytic function, if say, you have a
+#           guess of what the width should be----here, the prior is a
+#           Gaussian of mean 1.8 angstroms and std 1.0 angstroms.
+
+#            def wprior(x,params):
+#                return sp.exmp(-0.5*(x - params[0])**2/ (params[1])**2 )
+#            f.make_func_prior('width', wprior, [1.8, 1.0] )
+
+            chain_herm = None
+            select = None
+            try:
+                if self.select is None or self.nstep_pilot >= self.nstep_herm:
+                    chi2_herm,p_herm,frac_herm,chain_herm = self._sample(self.nstep_herm,l,f)
+                else:
+                    chi2_herm,p_herm,frac_herm,chain_herm,select = self._staged_hermite(l,f,chi2_delta,chi2_gauss)
+                print frac_herm
+            except:
+                pass
+            if hasattr(f,'swap_rates'):
+                swap_rates['Hermite'] = f.swap_rates.tolist()
+
+            if select is not None and not select['run']:
+                #the pilot did not justify h3 and h4, so the output is
+                #from the best simpler kernel
+                if chi2_delta < chi2_gauss:
+                    f.p = {'shift':p_delta['shift'], 'scale':p_delta['scale'], 'width': 0.001 , 'h3':0.0, 'h4':0.0}
+                else:
+                    f.p = dict(p_gauss,h3=0.0,h4=0.0)
+            elif chi2_delta < chi2_herm:
+                f.p = {'shift':p_delta['shift'], 'scale':p_delta['scale'], 'width': 0.001 , 'h3':0.0, 'h4':0.0}
+            else:
+                f.p = p_herm
+            output += self._save(f,s,outdir,'scale.h._'+name,'covar.h._'+name)
+            if self.get_chains and chain_herm is not None:
+                self._save_chain(chain_herm,os.path.join(outdir,'chains',name+'.chain.herm'))
+
+        if self.get_profile:
+            self._write(save_profiles,os.path.join(outdir,'profiles',name+'.profile.json'),profiles)
+            for key in profiles.keys():
+                self.run_profiles[key].append(profiles[key])
+
+        plt.close('all')
+
+        out = OrderedDict()
+        out['name'] = name
+        out['cc_shift'] = float(s0[0])
+        for key,chi2,p,frac in [('Delta',chi2_delta,p_delta,frac_delta),
+                                ('Gauss',chi2_gauss,p_gauss,frac_gauss),
+                                ('Hermite',chi2_herm,p_herm,frac_herm)]:
+            out[key] = dict([ (k,float(v)) for k,v in p.items() ])
+            out[key]['chi2'] = float(chi2)
+            out[key]['frac'] = float(frac)
+        if self.select is not None and 'Hermite' in kernels:
+            out['select'] = select
+        if self.sampler == 'tempered':
+            out['swap_rates'] = swap_rates
+        out['output'] = output
+
+        if self.fout is not None:
+            self.fout.write(params_line(out))
+            self.fout.flush()
+        return out
+
+    def _staged_hermite(self,l,f,chi2_delta,chi2_gauss):
+        #pilot Gauss-Hermite chain, and the rest of the chain only if
+        #the pilot is a significant improvement on Delta or Gauss.
+        #Returns the same as metro_hast, and the decision.
+        chi2_herm,p_herm,frac_herm,chain_herm = self._sample(self.nstep_pilot,l,f)
+        if chi2_gauss <= chi2_delta:
+            chi2_simple,nextra = chi2_gauss,2
+        else:
+            chi2_simple,nextra = chi2_delta,3
+        run,dchi2,threshold = compare_kernels(chi2_simple,chi2_herm,l.wv.size,nextra,
+                                              criterion=self.select,alpha=self.alpha)
+        select = {'criterion':self.select,'dchi2':dchi2,'threshold':threshold,'run':run,
+                  'steps_saved':0 if run else self.nstep_herm - self.nstep_pilot}
+        print 'Gauss-Hermite: dchi2 = %.2f, threshold = %.2f, %s'%(dchi2,threshold,'run' if run else 'skipped')
+        if run:
+            #continues from the end of the pilot chain (hmc starts a
+            #new chain there, and tunes itself again)
+            nrest = self.nstep_herm - self.nstep_pilot
+            chi2_rest,p_rest,frac_rest,chain_herm = self._sample(nrest,l,f,chain=chain_herm)
+            frac_herm = (frac_herm*self.nstep_pilot + frac_rest*nrest)/self.nstep_herm
+            if chi2_rest < chi2_herm:
+                chi2_herm,p_herm = chi2_rest,p_rest
+        return chi2_herm,p_herm,frac_herm,chain_herm,select
+
+    def _sample(self,nstep,l,f,chain=None):
+        #MCMC of model f, with nstep steps of metro_hast, or hmc or
+        #tempered with about the same cost
+        if self.sampler == 'hmc':
+            return hmc(max(nstep//10,100),l,f,nleap=10,keep=True,thin=self.thin,maxkeep=self.maxkeep)
+        if self.sampler == 'tempered':
+            return tempered(max(nstep//2,100),l,f,keep=True,thin=self.thin,maxkeep=self.maxkeep,chain=chain)
+        return metro_hast(nstep,l,f,keep=True,thin=self.thin,maxkeep=self.maxkeep,
+                          nburn=int(self.burn*nstep),chain=chain)
+
+    def _set_priors(self,f):
+        for key in self.priors.keys():
+            if key in f.p.keys():
+                f.prior_prob[key] = self.priors[key]
+
+    def _save_chain(self,chain,ofile):
+        #the kept steps, and the summary of all steps
+        self._write(chain.save,ofile)
+        self._write(chain.save_summary,ofile+'.summary.json')
+
+    def _makedirs(self,outdir):
+        for d,use in [('covar_matrices',self.get_covar and self.store is None),
+                      ('chains',self.get_chains),('profiles',self.get_profile)]:
+            if use and not os.path.isdir(os.path.join(outdir,d)):
+                os.makedirs(os.path.join(outdir,d))
+
+    def _save(self,f,s,outdir,sname,cname):
+        #applies the best fit to the whole spectrum and saves it.
+        #Returns the output files (or names in the store).
+        if self.get_covar:
+            sout,dummy,covar = f.output(s)
+        else:
+            sout,dummy = f.output(s,getcovar=False)
+        if self.store is None:
+            out = [ os.path.join(outdir,sname) ]
+            self._write(sp.savetxt,out[0],sp.c_[sout.wv,sout.f,sout.ef],fmt='% 6.2f % 4.4e % 4.4e')
+        else:
+            out = [ sname ]
+            self._write_store(self.store.put_spectrum,sname,sout,meta=dict([ (k,float(v)) for k,v in f.p.items() ]))
+
+        if self.get_covar:
+            if self.store is None:
+                out.append(os.path.join(outdir,'covar_matrices',cname))
+                self._write(sp.savetxt,out[-1],covar)
+            else:
+                out.append(cname)
+                self._write_store(self.store.put_covar,cname,covar)
+        return out
+
+    def _write(self,func,*args,**kw):
+        #writes now, or hands the write to self.writer
+        if self.writer is None:
+            func(*args,**kw)
+        else:
+            self.writer.put(func,*args,**kw)
+
+    def _write_store(self,func,*args,**kw):
+        #the store appends to one file, so only one thread writes to it
+        if self.writer is None:
+            func(*args,**kw)
+        else:
+            self.writer.put_locked(func,*args,**kw)
+
+    def profile_summary(self):
+        """
+        Profiles of all spectra so far, combined for each kernel.
+        """
+        return dict([ (key,Profile.combine(self.run_profiles[key])) for key in self.run_profiles.keys() ])
+
+
+"""
+Parallel runs.  The reference spectrum and the cross correlation
+tables are written once to memory mapped files (share_reference), and
+each worker process maps them (attach_reference) instead of getting
+its own copy, so the pages are shared by all workers.
+"""
+
+def share_reference(runner,path):
+    """
+    Writes the reference arrays of MapRunner runner to directory
+    path, for attach_reference.
+    """
+    arrays = {'wv':runner.sref.wv,'f':runner.sref.f,'ef':runner.sref.ef,
+              'window':runner.window,'cc_x':runner.cc.x,'cc_fref':runner.cc.fref}
+    for key in arrays.keys():
+        sp.save(os.path.join(path,key+'.npy'),sp.ascontiguousarray(arrays[key]))
+    fout = open(os.path.join(path,'reference.json'),'w')
+    json.dump({'style':runner.sref.style,'cc_grid':list(runner.cc.grid),
+               'cc_nfft':runner.cc.nfft,'cc_maxlag':runner.cc.maxlag},fout)
+    fout.close()
+
+def attach_reference(path):
+    """
+    Reference Spectrum, window, and CrossCorr from the files written by
+    share_reference.  The arrays are read only memory maps.
+    """
+    load = lambda key: sp.load(os.path.join(path,key+'.npy'),mmap_mode='r')
+    info = json.load(open(os.path.join(path,'reference.json')))
+    sref = Spectrum(style=info['style'])
+    sref.wv = load('wv')
+    sref.f  = load('f')
+    sref.ef = load('ef')
+
+    cc = CrossCorr.__new__(CrossCorr)
+    cc.grid = tuple(info['cc_grid'])
+    cc.x = load('cc_x')
+    cc.nfft = info['cc_nfft']
+    cc.fref = load('cc_fref')
+    cc.maxlag = info['cc_maxlag']
+    return sref,sp.array(load('window')),cc
+
+
+class _StoreRecorder(object):
+    #stands in for a RunStore in the workers---records are sent back
+    #to the parent process, which owns the store
+    def __init__(self):
+        self.records = []
+
+    def put_spectrum(self,name,s,meta=None):
+        self.records.append(('spectrum',name,sp.array([s.wv,s.f,s.ef]),meta))
+
+    def put_covar(self,name,C,meta=None):
+        self.records.append(('covar',name,C,meta))
+
+#MapRunner of each worker process
+_worker = [None]
+
+def _init_worker(path,kw):
+    #forked workers start with the same random state
+    sp.random.seed()
+    sref,window,cc = attach_reference(path)
+    if kw.pop('store'):
+        kw['store'] = _StoreRecorder()
+    _worker[0] = MapRunner(sref,window,cc=cc,**kw)
+
+def _run_one(spec):
+    #helper for run_parallel.  Must be at the top level of the module
+    #for the process pool.
+    runner = _worker[0]
+    try:
+        out = runner.run(spec)
+    except Exception as e:
+        return {'name':os.path.basename(spec),'error':str(e)},[],{}
+    records = []
+    if runner.store is not None:
+        records = runner.store.records
+        runner.store.records = []
+    profiles = {}
+    if runner.get_profile:
+        profiles = dict([ (key,runner.run_profiles[key].pop()) for key in runner.run_profiles.keys() ])
+    return out,records,profiles
+
+def run_parallel(runner,speclist,nproc):
+    """
+    Runs runner.run on every spectrum in speclist, in nproc worker
+    processes that share the reference (see share_reference).  The
+    options of runner (outputs, kernels, number of steps) are used by
+    every worker, and the parameter file and RunStore of runner are
+    written by this process, in the order of speclist.
+
+    Returns the outputs of runner.run for each spectrum (a dictionary
+    with the name and 'error' for spectra that could not be read).
+    """
+    path = tempfile.mkdtemp(prefix='mapspec_ref')
+    share_reference(runner,path)
+    kw = {'istyle':runner.istyle,'get_covar':runner.get_covar,'get_chains':runner.get_chains,
+          'get_profile':runner.get_profile,'nstep_gauss':runner.nstep_gauss,
+          'nstep_herm':runner.nstep_herm,'outdir':runner.outdir,'kernels':runner.kernels,
+          'priors':runner.priors,'sampler':runner.sampler,'thin':runner.thin,'maxkeep':runner.maxkeep,'burn':runner.burn,'select':runner.select,'nstep_pilot':runner.nstep_pilot,'alpha':runner.alpha,
+          'store':runner.store is not None}
+    runner._makedirs(runner.outdir)
+
+    results = []
+    pool = Pool(nproc,initializer=_init_worker,initargs=(path,kw))
+    try:
+        for out,records,profiles in pool.imap(_run_one,speclist):
+            results.append(out)
+            if 'error' in out:
+                print 'Failed on %s: %s'%(out['name'],out['error'])
+                continue
+            for kind,name,data,meta in records:
+                if kind == 'spectrum':
+                    runner.store.put(name,data,kind='spectrum',meta=meta)
+                else:
+                    runner.store.put_covar(name,data,meta=meta)
+            for key in profiles.keys():
+                runner.run_profiles[key].append(profiles[key])
+            if runner.fout is not None:
+                runner.fout.write(params_line(out))
+                runner.fout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(path)
+    return results
+
+
+"""
+Pipelined runs, for slow (e.g., network) file systems.  Spectra are
+read ahead by a pool of reader threads (prefetch), and the output
+files are written by a pool of writer threads (Writer), so the fits
+do not wait on the disk.  Reads and writes are bounded, so a slow disk
+holds back the fits instead of filling up memory.
+"""
+
+class Writer(object):
+    """
+    Pool of threads that run writes (any function and its arguments)
+    in the background.  put blocks while maxqueue writes are waiting.
+    An error in a write is raised by the next put, or by close.
+
+    Examples
+    --------
+    >>> writer = Writer(nthread=2)
+    >>> writer.put(sp.savetxt,'out.txt',x)
+    >>> writer.close()
+    """
+    def __init__(self,nthread=2,maxqueue=8):
+        self.queue = Queue.Queue(maxqueue)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.threads = [ threading.Thread(target=self._work) for i in range(nthread) ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self,func,*args,**kw):
+        """
+        Queues func(*args,**kw).
+        """
+        self._check()
+        self.queue.put((func,args,kw,False))
+
+    def put_locked(self,func,*args,**kw):
+        """
+        Queues func(*args,**kw), to be run by one thread at a time
+        (e.g., for a RunStore).
+        """
+        self._check()
+        self.queue.put((func,args,kw,True))
+
+    def close(self):
+        """
+        Waits for the queued writes, and stops the threads.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._check()
+
+    def _check(self):
+        if len(self.errors) > 0:
+            raise IOError('Write failed: %s'%self.errors[0])
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            func,args,kw,locked = job
+            try:
+                if locked:
+                    with self.lock:
+                        func(*args,**kw)
+                else:
+                    func(*args,**kw)
+            except Exception as e:
+                self.errors.append(e)
+
+
+def prefetch(speclist,read=read_spec,nthread=2,depth=4):
+    """
+    Yields (spec,s) for each file in speclist, in order, where s is
+    read(spec).  Up to depth spectra are read ahead by nthread threads.
+    An error reading a spectrum is raised when it is reached.
+    """
+    todo = Queue.Queue()
+    def work():
+        while True:
+            job = todo.get()
+            if job is None:
+                break
+            spec,slot = job
+            try:
+                slot['s'] = read(spec)
+            except Exception as e:
+                slot['error'] = e
+            slot['done'].set()
+
+    threads = [ threading.Thread(target=work) for i in range(nthread) ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    pending = []
+    specs = iter(speclist)
+    try:
+        while True:
+            #keeps depth spectra in flight
+            for spec in specs:
+                slot = {'done':threading.Event()}
+                pending.append((spec,slot))
+                todo.put((spec,slot))
+                if len(pending) >= depth:
+                    break
+            if len(pending) == 0:
+                break
+            spec,slot = pending.pop(0)
+            slot['done'].wait()
+            if 'error' in slot:
+                raise slot['error']
+            yield spec,slot['s']
+    finally:
+        for thread in threads:
+            todo.put(None)
+
+
+def run_pipeline(runner,speclist,nread=2,nwrite=2,depth=4):
+    """
+    Runs runner.run on every spectrum in speclist, with the spectra
+    read ahead by nread threads (up to depth at a time, see prefetch)
+    and the outputs written by nwrite threads (see Writer).  The
+    parameter file is written as each fit finishes, so it is in the
+    order of speclist.  Returns the outputs of runner.run.
+    """
+    writer = Writer(nwrite,maxqueue=2*depth)
+    runner.writer = writer
+    results = []
+    try:
+        for spec,s in prefetch(speclist,lambda spec: read_spec(spec,style=runner.istyle),nread,depth):
+            print spec
+            results.append(runner.run(spec,s=s))
+    finally:
+        runner.writer = None
+        writer.close()
+    return results
@@ -1,6 +1,7 @@
 import scipy as sp
 from scipy.signal import get_window 
-from scipy.interpolate import interp1d 
+from scipy import sparse
+from grids import get_grid,grid_index
 
 __all__ = ['SincInterp']
 
@@ -86,14 +87,18 @@ class SincInterp(object):
     >>> si.window = 'boxcar' #from sp.signal.get_window
     >>> yin2 = si(xnew)
     """
-    def __init__(self,x,y,window='lanczos',kw = 15):
+    def __init__(self,x,y,window='lanczos',kw = 15,grid=None):
         i = sp.argsort(x)
+        self.isort = i
         self.x = x[i]
         self.y = y[i]
-        #enforce equal spacing
-        d = sp.diff(x)
-        if (sp.absolute(d - d.max()) > 1.e-10 ).any():
-            raise ValueError("abcissas are not evenly spaced")
+        #enforce equal spacing---skip the check if the caller already
+        #knows the grid (start, step, n)
+        if grid is None:
+            grid = get_grid(self.x)
+            if grid is None:
+                raise ValueError("abcissas are not evenly spaced")
+        self.grid = grid
 
         self.window=window
         #kernel half-width
@@ -105,56 +110,76 @@ class SincInterp(object):
         if (xnew < self.x[0]).any() or (xnew > self.x[-1]).any():
             raise ValueError("new abcissas are outside of original domain")
 
-        self.out = sp.zeros(xnew.size)
-        for ex in xnew:
-            k = self._get_kernel(ex,self.window)
-            yi = sp.convolve(self.y,k,mode='same')
-            self._tidy(ex,xnew,yi)
+        #one row of kernel weights for each new point, applied to the
+        #pixels within kw of the next lesser self.x
+        i,dpix = self._get_index(xnew)
+        k = self._get_kernel(dpix,self.window)
+        j = i[:,None] + sp.r_[self.kw:-self.kw - 1:-1]
+        m = (j >= 0)*(j < self.y.size)
+        yuse = sp.where(m, self.y[sp.clip(j,0,self.y.size - 1)], 0)
+
+        self.out = sp.sum(k*yuse,axis=1)
+        self._tidy(i,xnew)
 
         return self.out
 
-    def _get_kernel(self,x1,func_name):
+    def operator(self,xnew):
+        """
+        The interpolation as a sparse matrix W, such that self(xnew)
+        = W*y.  Rows follow xnew (which is not sorted), columns follow
+        the original (unsorted) input x.
+        """
+        i,dpix = self._get_index(xnew)
+        k = self._get_kernel(dpix,self.window)
+        j = i[:,None] + sp.r_[self.kw:-self.kw - 1:-1]
+        rows = sp.repeat(sp.r_[0:xnew.size],k.shape[1]).reshape(k.shape)
+        e = self._edge_mask(i)
+        m = (j >= 0)*(j < self.y.size)
+        m[e] = False
+
+        #linear interpolation at the edges
+        il,f = grid_index(self.x,xnew[e],self.grid)
+        re = sp.r_[0:xnew.size][e]
+
+        rows = sp.r_[rows[m],re,re]
+        cols = sp.r_[j[m],il - 1,il]
+        vals = sp.r_[k[m],1 - f,f]
+        return sparse.csr_matrix((vals,(rows,self.isort[cols])),shape=(xnew.size,self.y.size))
+
+    def _get_index(self,xnew):
+        #index of the next lesser self.x, and fractional pixel shift
+        #from that point.  Evenly spaced, so no need to search.
+        x0,dx,n = self.grid
+        pos = (xnew - x0)/dx
+        i = sp.clip(sp.floor(pos).astype(int),0,n - 1)
+        dpix = pos - i
+        assert (sp.absolute(dpix) < 1.0 + 1.e-8).all()
+        return i,dpix
+
+    def _get_kernel(self,dpix,func_name):
         #evaluate pixel shift
+        kx = sp.r_[-self.kw:self.kw + 1][None,:] + dpix[:,None]
         if func_name in func_dic.keys():
             func = func_dic[func_name]
+            k = func(kx.ravel()).reshape(kx.shape)
         else:
-            func = lambda kx:  sp.sinc(kx)*get_window(func_name,kx.size)
-        
-        i = sp.searchsorted(self.x,x1)
-        dpix = (x1 - self.x[i - 1])/(self.x[i] - self.x[i - 1])
-        if dpix == 1.0: dpix = 0
-        assert sp.absolute(dpix) < 1.0
-        kx = sp.r_[-self.kw:self.kw + 1] + dpix
-        k = func(kx)
-        k = k/sp.sum(k)
+            k = sp.sinc(kx)*get_window(func_name,kx.shape[1])
+        k = k/sp.sum(k,axis=1)[:,None]
         return k
 
-    def _tidy(self,x1,xnew,yi):
-        i = sp.searchsorted(self.x,x1) 
-        #if x1 is in self.x, search.sorted returns the correct index.
-        #Other wise, it matches the index for the next greater self.x,
-        #but we want the index for the next lesser.
-        if self.x[i] != x1:
-            i -= 1
-        assert i.size == 1
-
-        #just do linear interpolation on the section spoiled by the
-        #convolution
+    def _edge_mask(self,i):
+        #points near the edges, spoiled by the convolution
         if self.window =='lanczos':
             edge = 11.
         elif self.window =='cubic_conv':
             edge = 5.
         else:
             edge = 2*self.kw + 1
-        if i < edge :
-            z = interp1d(self.x,self.y)
-            yi[i] = z(x1)
-
-        elif  i > yi.size - edge:
-            z = interp1d(self.x,self.y)
-            yi[i] = z(x1)
-
-        i2 = sp.where(xnew == x1)[0]
-        assert i2.size == 1
-        self.out[i2] = yi[i]
+        return (i < edge) + (i > self.y.size - edge)
 
+    def _tidy(self,i,xnew):
+        #just do linear interpolation on the section spoiled by the
+        #convolution
+        m = self._edge_mask(i)
+        if m.any():
+            self.out[m] = sp.interp(xnew[m],self.x,self.y)
@@ -1,23 +1,26 @@
 import scipy as sp
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d,make_interp_spline
 from scipy.integrate import simps
 from scipy.signal import get_window
 from scipy import linalg,optimize
-from numpy.polynomial.hermite import Hermite as H
+from numpy.polynomial.hermite import hermval
 
 from astropy.io import ascii,fits
 from astropy.table import Table,Column
 
 import re
+from multiprocessing import Pool
 
 from sinc_interp import SincInterp
 from bsplines import Bspline
+from grids import get_grid,grid_index
+from operators import interp_operator,rebin_operator,propagate_var,spline_interp_var
 
 from copy import deepcopy
 
 import matplotlib.pyplot as plt
 
-__all__ = ['linear_interp_error','extinction','Spectrum','EmissionLine','LineModel','TextSpec','TextSpec_2c','FitsSpec']
+__all__ = ['linear_interp_error','extinction','Spectrum','EmissionLine','LineModel','fit_lines','TextSpec','TextSpec_2c','FitsSpec']
 
 
 
@@ -41,6 +44,8 @@ class Spectrum(object):
         self._f   = None
         self._ef  = None
         self.sky = None
+        #(start, step, n) if wavelengths are evenly spaced, else None
+        self.grid = None
 
         self.wv_orig = deepcopy(self.wv)
         self.f_orig  = deepcopy(self.f)
@@ -59,6 +64,7 @@ class Spectrum(object):
     @wv.setter
     def wv(self,wvnew):
         self._wv  = wvnew
+        self.grid = get_grid(wvnew)
         if self.f is not None:
             if self.f.size == self._wv.size:
                 self.set_interp(style = self.style)
@@ -117,69 +123,79 @@ class Spectrum(object):
         Choose which interpolation technique to use.  Relevent for
         self.interp() and self.rebin()
 
-
-        Note that errors are only rigorous for linear interpolation.
-        Otherwise, for now it will interpolate the squared error
-        spectrum using the method of choice (i.e., splines, sinc,
-        etc.).
-
         Uses scipy.interp1d---anything that can be pased to 'kind'
         keyword in this package is valid.
+
+        Every style is linear in the flux, so errors are propagated
+        through the interpolation weights (see
+        self.interp_operator).  Except for sinc interpolation, this
+        is done directly without building the operator (splines use
+        operators.spline_interp_var).
         """
         self.style = style
+        self._interp_kw = {'window':window1,'kw':kw1,'order':order1}
         if style == 'sinc':
-            self._interpolator = SincInterp(self.wv,self.f, window=window1,kw=kw1)
-            if self.ef is not None:  self._interpolator_error = SincInterp(self.wv,self.ef**2, window=window1,kw=kw1)
+            self._interpolator = SincInterp(self.wv,self.f, window=window1,kw=kw1,grid=self.grid)
 
         elif style == 'bspline':
             self._interpolator = Bspline(self.wv,self.f, order=order1)
-            if self.ef is not None:  self._interpolator_error = Bspline(self.wv,self.ef**2,order=order1)
-
-        elif style == 'linear':
-            self._interpolator = interp1d(self.wv,self.f,kind=style)
-            if self.ef is not None:  self._interpolator_error = lambda xnew: linear_interp_error(self.wv,xnew, self.ef)
 
         else:
             self._interpolator = interp1d(self.wv,self.f,kind=style)
-            if self.ef is not None:  self._interpolator_error = interp1d(self.wv,self.ef**2,kind=style)
+
+        if self.ef is not None:
+            if style == 'linear':
+                self._interpolator_error = lambda xnew: linear_interp_error(self.wv,xnew, self.ef,self.grid)
+            elif style == 'sinc':
+                self._interpolator_error = lambda xnew: propagate_var(self.interp_operator(xnew,cache=False),self.ef**2)
+            elif style == 'nearest':
+                #the weights are 0 or 1
+                self._interpolator_error = interp1d(self.wv,self.ef**2,kind=style)
+            elif style == 'bspline':
+                tck = self._interpolator.tck
+                self._interpolator_error = lambda xnew: spline_interp_var(tck[0],tck[2],self.wv,xnew,self.ef**2)
+            else:
+                #the other interp1d styles are splines of this degree
+                k = {'zero':0,'slinear':1,'quadratic':2,'cubic':3}.get(style,style)
+                self._interpolator_error = lambda xnew: spline_interp_var(make_interp_spline(self.wv,self.f,k=k).t,k,
+                                                                          self.wv,xnew,self.ef**2)
+
+    def interp_operator(self,xnew,cache=True):
+        """
+        Returns the interpolation onto xnew as a sparse matrix A, so
+        that the interpolated flux is A*self.f, and the covariance
+        matrix is A C A^T.  Operators are cached, so spectra on the
+        same grid share them (see operators.py); use cache=False for
+        a grid that will not be used again.
+        """
+        return interp_operator(self.wv,xnew,self.style,self.grid,cache=cache,**self._interp_kw)
+
+    def rebin_operator(self,xnew,cache=True):
+        """
+        As interp_operator, but for self.rebin(xnew).
+        """
+        return rebin_operator(self.wv,xnew,self.style,self.grid,cache=cache,**self._interp_kw)
 
     def rebin(self,xnew):
         """
         Rebin the spectrum on a new grid named xnew
+
+        Up sampling is just interpolation.  When down sampling, bins
+        are defined so that xnew is at the center, and the flux is the
+        mean of the interpolated spectrum within each bin.  Errors are
+        propagated through the same (sparse) linear operator.
         """
 
         #Does not need equal spaced bins, but why would you not?
         xnew.sort()
 
-        fbin  = sp.zeros(xnew.size)
-        efbin = sp.zeros(xnew.size)
-
-        #up sampling is just interpolation
-        m = (self.wv >= xnew[0])*(self.wv <= xnew[-1])
-        if self.wv[m].size <= xnew.size - 1:
-            fbin,efbin  = self.interp(xnew)
-            
-        else:
-        #down sampling--
-        #1) define bins so that xnew is at the center.
-        #2) interpolate to account for fractional pixel weights
-        #3) take the mean within each bin
-            db  = 0.5*sp.diff(xnew)
-            b2  = xnew[1::] - db
-            b2  = sp.insert(b2,0,xnew[0])
-
-            insert = sp.searchsorted(self.wv,b2)
-            xinsert = sp.insert(self.wv,insert,xnew)
-            xinsert = sp.unique(xinsert)
-            yinsert,zinsert = self.interp(xinsert)
-
-            i = sp.digitize(xinsert,b2)
-            for j in range(b2.size):
-                iuse = sp.where(i == j+1)[0]
-                fbin[j]  = sp.mean(yinsert[iuse])
-                efbin[j] = sp.mean(zinsert[iuse])
+        R = self.rebin_operator(xnew)
+        fbin = R*self.f
+        if self.ef is not None:
+            efbin = sp.sqrt(propagate_var(R,self.ef**2))
 
         self._wv = xnew
+        self.grid = get_grid(xnew)
         if self.ef is not None:        
             self._ef = efbin            
         self.f = fbin
@@ -555,10 +571,14 @@ class LineModel(EmissionLine):
     object, which will be used as a template, and this will shift,
     rescale, and float the empircal line.
 
+    The initial guess for the parameters can be given with pinit
+    (default is to guess from the data), which is useful to
+    warm-start fits of similar lines (see fit_lines).
+
     Note that the functional models are defined after this class.
     """
 
-    def __init__(self,EmLine,func = 'gaussian',window = None,nline=1,floating=False,linedata = None):
+    def __init__(self,EmLine,func = 'gaussian',window = None,nline=1,floating=False,linedata = None,pinit = None):
         super(EmissionLine,self).__init__()  
         self.wv   = EmLine.wv
         self.lf   = EmLine.f
@@ -575,9 +595,16 @@ class LineModel(EmissionLine):
             y = EmLine.f
             z = EmLine.ef
 
-        self.fuse,pinit = self._init_params(func,x,y,nline,linedata)
-        #all the heavy lifting is in this step
-        self.p,self.covar = fitfunc(self.fuse,pinit,x,y,z)
+        self.fuse,pguess = self._init_params(func,x,y,nline,linedata)
+        if pinit is None:
+            pinit = pguess
+        #all the heavy lifting is in this step.  Components that
+        #start at the same place have identical analytic derivatives,
+        #and a floating offset is nearly degenerate with the wings,
+        #so leastsq can end up somewhere else with them---these fits
+        #keep the finite differences
+        jac = self.jac if nline == 1 and not floating else None
+        self.p,self.covar = fitfunc(self.fuse,pinit,x,y,z,jac=jac)
 
 #        self.fuse,pinit,pbounds = self._init_params(func,x,y,nline,linedata)
 #        print pbounds,pinit
@@ -601,9 +628,11 @@ class LineModel(EmissionLine):
 
             if self.floating == True:
                 fuse = lambda x,p: multiwrapper(floating(gauss),x,p,nparams[func] + 1)
+                self.jac = lambda x,p: multiwrapper_jac(floating_jac(gauss_jac),x,p,nparams[func] + 1)
                 self.fuse2=floating(gauss)
             else:
                 fuse = lambda x,p: multiwrapper(gauss,x,p,nparams[func])
+                self.jac = lambda x,p: multiwrapper_jac(gauss_jac,x,p,nparams[func])
                 self.fuse2=gauss
 
         if func =='gauss-hermite':
@@ -619,9 +648,11 @@ class LineModel(EmissionLine):
 
             if self.floating == True:
                 fuse = lambda x,p: multiwrapper(floating(gauss_hermite),x,p,nparams[func] + 1)
+                self.jac = lambda x,p: multiwrapper_jac(floating_jac(gauss_hermite_jac),x,p,nparams[func] + 1)
                 self.fuse2=floating(gauss_hermite)
             else:
                 fuse = lambda x,p: multiwrapper(gauss_hermite,x,p,nparams[func])
+                self.jac = lambda x,p: multiwrapper_jac(gauss_hermite_jac,x,p,nparams[func])
                 self.fuse2=gauss_hermite
 
 
@@ -636,9 +667,11 @@ class LineModel(EmissionLine):
 
             if self.floating == True:
                 fuse = lambda x,p: multiwrapper(floating(lorentzian),x,p,nparams[func] + 1)
+                self.jac = lambda x,p: multiwrapper_jac(floating_jac(lorentzian_jac),x,p,nparams[func] + 1)
                 self.fuse2=floating(lorentzian)
             else:
                 fuse = lambda x,p: multiwrapper(lorentzian,x,p,nparams[func])
+                self.jac = lambda x,p: multiwrapper_jac(lorentzian_jac,x,p,nparams[func])
                 self.fuse2=lorentzian
 
 
@@ -655,9 +688,11 @@ class LineModel(EmissionLine):
 
             if self.floating == True:
                 fuse = lambda x,p: multiwrapper(floating(approx_voigt),x,p,nparams[func] + 1)
+                self.jac = lambda x,p: multiwrapper_jac(floating_jac(approx_voigt_jac),x,p,nparams[func] + 1)
                 self.fuse2=floating(approx_voigt)
             else:
                 fuse = lambda x,p: multiwrapper(approx_voigt,x,p,nparams[func])
+                self.jac = lambda x,p: multiwrapper_jac(approx_voigt_jac,x,p,nparams[func])
                 self.fuse2=approx_voigt
 
         if func == 'data':
@@ -666,6 +701,8 @@ class LineModel(EmissionLine):
             pinit = [ 1.0,x.mean(),0.0 ]
             l = argv[0]
             fuse = lambda x,p : empiriline(x,p,l)
+            #no analytic derivatives for a template
+            self.jac = None
 
 #        return fuse,pinit
 
@@ -721,16 +758,35 @@ nparams = {'gaussian':3,
 
 def multiwrapper(func,x,p,np):
     """
-    If you want several components, this will iteratively add them.
+    If you want several components, this will add them.  The
+    parameters are reshaped so that each row of p[i] holds a
+    component, and all components are evaluated at once (the model
+    functions broadcast).
+    """
+    x = sp.asarray(x)
+    P = _components(p,np,x.ndim)
+    return sp.sum(func(x[None,...],P),axis=0)
+
+def multiwrapper_jac(jac,x,p,np):
+    """
+    Jacobian of multiwrapper(func,...), given the Jacobian of a
+    single component.  Returns an array of shape (len(p), x.size),
+    i.e., the derivative of the model with respect to each parameter.
     """
-    puse = []
-    y = 0
-    for i in range(len(p)):
-        puse.append(p[i])
-        if len(puse)%np == 0:
-            y += func(x, puse )
-            puse = []
-    return y
+    x = sp.asarray(x)
+    P = _components(p,np,x.ndim)
+    J = jac(x[None,...],P)
+    #(param, component, x) -> (component*param, x)
+    J = sp.swapaxes(J,0,1)
+    return sp.reshape(J,(-1,) + J.shape[2::])
+
+def _components(p,np,xdim):
+    #one row per parameter, one column per component (extra
+    #parameters that do not make a full component are ignored), with
+    #extra axes to broadcast against x
+    ncomp = len(p)//np
+    P = sp.reshape(sp.asarray(p,dtype=float)[0:ncomp*np],(ncomp,np)).T
+    return P.reshape(P.shape + (1,)*xdim)
 
 def floating(func):
     """
@@ -741,6 +797,15 @@ def floating(func):
         return func(x,p[0:-1]) + p[-1]
     return floatfunc
 
+def floating_jac(jac):
+    """
+    Jacobian of floating(func), given the Jacobian of func.
+    """
+    def floatjac(x,p):
+        J = jac(x,p[0:-1])
+        return sp.r_[J,sp.ones((1,) + J.shape[1::])]
+    return floatjac
+
 #for feeding a line template
 def empiriline(x,p,L):
     """
@@ -753,24 +818,62 @@ def empiriline(x,p,L):
     ynew,znew = L.interp(xnew[m])
     return p[0]*ynew + p[2]
 
-#functions for use with Line Model
+#functions for use with Line Model.  These broadcast, so that p[i]
+#may be an array (see multiwrapper).  Each has a Jacobian, which
+#returns the derivatives with respect to p stacked along the first
+#axis.
 def gauss(x,p):
     return p[0]*sp.exp(-0.5*(x - p[1])**2/p[2]**2)
 
+def gauss_jac(x,p):
+    w = (x - p[1])/p[2]
+    g = sp.exp(-0.5*w**2)
+    return sp.array([g,
+                     p[0]*g*w/p[2],
+                     p[0]*g*w**2/p[2]])
+
+def _hermite(w,p):
+    #physicists' Hermite polynomials, h = H0 + p[3]*H3 + p[4]*H4, and dh/dw
+    h3 = 8*w**3 - 12*w
+    h4 = 16*w**4 - 48*w**2 + 12
+    h  = 1 + p[3]*h3 + p[4]*h4
+    dh = p[3]*(24*w**2 - 12) + p[4]*(64*w**3 - 96*w)
+    return h,dh,h3,h4
 
 def gauss_hermite(x,p):
     #The constants are only to make p[3] and p[4] correspond to a
     #rigorous definition of h3 and h4
     A = p[0]*(p[2]/sp.sqrt(2*sp.pi))
     w = (x - p[1])/p[2]
-    h = H([ 1., 0., 0., p[3], p[4] ])
+    #evaluated as numpy's Hermite series (as the scalar fits always
+    #have been), with the coefficients broadcast over components
+    h = hermval(w,sp.array(sp.broadcast_arrays(1.,0.,0.,p[3],p[4])),tensor=False)
     
-    return A*sp.exp(-0.5*w**2)*h(w)
+    return A*sp.exp(-0.5*w**2)*h
+
+def gauss_hermite_jac(x,p):
+    a = p[2]/sp.sqrt(2*sp.pi)
+    w = (x - p[1])/p[2]
+    e = sp.exp(-0.5*w**2)
+    h,dh,h3,h4 = _hermite(w,p)
+    #derivative with respect to w, then chain rule
+    dw = p[0]*a*e*(dh - w*h)
+    return sp.array([a*e*h,
+                     -dw/p[2],
+                     p[0]*e*h/sp.sqrt(2*sp.pi) - dw*w/p[2],
+                     p[0]*a*e*h3,
+                     p[0]*a*e*h4])
 
 def lorentzian(x,p):
     w = (x - p[1])/p[2]
     return p[0]/(1 + w**2)
 
+def lorentzian_jac(x,p):
+    w = (x - p[1])/p[2]
+    l = 1./(1 + w**2)
+    return sp.array([l,
+                     2*p[0]*w*l**2/p[2],
+                     2*p[0]*w**2*l**2/p[2]])
 
 def approx_voigt(x,p):
     #just sum the gaussian and lorentz
@@ -781,6 +884,88 @@ def approx_voigt(x,p):
 
     return p[0]*(g + p[4]*l)
 
+def approx_voigt_jac(x,p):
+    w1 = (x - p[1])/p[2]
+    w2 = (x - p[1])/p[3]
+    g = sp.exp(-0.5*w1**2)
+    l = 1./(1 + w2**2)
+    return sp.array([g + p[4]*l,
+                     p[0]*(g*w1/p[2] + 2*p[4]*w2*l**2/p[3]),
+                     p[0]*g*w1**2/p[2],
+                     2*p[0]*p[4]*w2**2*l**2/p[3],
+                     p[0]*l])
+
+
+
+def fit_lines(lines,func='gaussian',window=None,nline=1,floating=False,linedata=None,warm=True,nproc=1):
+    """
+    Fit the same LineModel to a stack of line profiles, e.g., the
+    EmissionLines of one object at many epochs.
+
+    lines is a list of EmissionLine objects (anything with wv, f, and
+    ef will do).  The other keywords are passed to LineModel.
+
+    warm=True starts each fit from the solution of the previous line
+    in the list, since the line profiles should be nearly identical.
+    A fit that fails (singular covariance) is re-done from the usual
+    guesses.
+
+    nproc > 1 splits the list into nproc contiguous blocks that are
+    fit in a process pool (warm starts are used within each block).
+
+    Returns an astropy Table with a row for each line: the index in
+    the input list, the parameters 'p', covariance matrix 'covar',
+    and 'chi2'.
+    """
+    data = [ (l.wv,l.f,l.ef) for l in lines ]
+    kw = {'func':func,'window':window,'nline':nline,'floating':floating,'linedata':linedata}
+
+    if nproc > 1:
+        if func == 'data':
+            raise ValueError("Template (func='data') fits cannot be run in a process pool")
+        nblock = int(sp.ceil(len(data)/float(nproc)))
+        blocks = [ (data[i:i + nblock],kw,warm) for i in range(0,len(data),nblock) ]
+        pool = Pool(nproc)
+        try:
+            out = pool.map(_fit_block,blocks)
+        finally:
+            pool.close()
+            pool.join()
+        out = [ o for block in out for o in block ]
+    else:
+        out = _fit_block((data,kw,warm))
+
+    npar = max([ o[0].size for o in out ])
+    ptab = sp.zeros((len(out),npar))
+    ctab = sp.zeros((len(out),npar,npar))*sp.nan
+    for i,o in enumerate(out):
+        ptab[i] = o[0]
+        if o[1] is not None:
+            ctab[i] = o[1]
+
+    return Table([sp.r_[0:len(out)],ptab,ctab,sp.array([ o[2] for o in out ])],
+                 names=('index','p','covar','chi2'))
+
+def _fit_block(args):
+    #helper for fit_lines, fits a list of (wv, f, ef) in order.  Must
+    #be at the top level of the module for the process pool.
+    data,kw,warm = args
+    out = []
+    pinit = None
+    for wv,f,ef in data:
+        l = Spectrum()
+        l.wv = wv
+        l.f  = f
+        l.ef = ef
+
+        m = LineModel(l,pinit=pinit,**kw)
+        if m.covar is None and pinit is not None:
+            m = LineModel(l,**kw)
+        if warm and m.covar is not None:
+            pinit = m.p
+
+        out.append( (sp.asarray(m.p),m.covar,m.chi2()) )
+    return out
 
 
 ####testing
@@ -949,7 +1134,7 @@ def linfit(x,y,ey):
     covar = linalg.inv(A)
     return p,covar
 
-def fitfunc(func,pin,x,y,ey):
+def fitfunc(func,pin,x,y,ey,jac=None):
     """
     Non-linear least square fitter.  Assumes no errors in x.  Utilizes
     scipy.optimize.leastsq.  Uses a Levenberg-Marquardt algorithm
@@ -957,33 +1142,48 @@ def fitfunc(func,pin,x,y,ey):
     object that is the functional form to be fit, as well as initial
     guesses for the parameters.
 
+    jac is an optional function that returns the analytic derivatives
+    of func, with shape (len(pin), x.size).  Otherwise, derivatives
+    are estimated by finite differences.
+
     This function returns the parameters and the covariance matrix.
     Note that leastsq returns the jacobian, a message, and a flag as
     well.
     
     """
     merit = lambda params,func,x,y,ey:  (y - func(x,params))/ey
-    p,covar,dum1,dum2,dum3 = optimize.leastsq(merit,pin,args=(func,x,y,ey),xtol = 1e-8,full_output=1)
+    if jac is None:
+        Dfun = None
+    else:
+        Dfun = lambda params,func,x,y,ey: -jac(x,params)/ey
+    p,covar,dum1,dum2,dum3 = optimize.leastsq(merit,pin,args=(func,x,y,ey),Dfun=Dfun,col_deriv=1,xtol = 1e-8,full_output=1)
     return p,covar
 
-def fitfunc_bound(func,pin,x,y,ey,pbound):
+def fitfunc_bound(func,pin,x,y,ey,pbound,jac=None):
     """
     Non-linear least square fitter, with an option of contraints
 
+    jac is an optional function for the analytic derivatives of func
+    (as for fitfunc), used for the gradient of chi^2.
     ***********
     
     """
     merit = lambda params,func,x,y,ey:  sp.sum( 
         ( y - func(x,params) )**2/ey**2 
         )
+    if jac is None:
+        grad = None
+    else:
+        grad = lambda params,func,x,y,ey: -2*sp.dot(jac(x,params),( y - func(x,params) )/ey**2)
     #return with weird object....
     out,dum1,dum2 = optimize.fmin_l_bfgs_b(merit,
                                            pin,
+                                           fprime = grad,
                                            args=(func,x,y,ey),
                                            #                                 tol = 1.e-15,
                                            #                            method='L-BFGS-B',
                                            bounds = pbound,
-                                           approx_grad=True,
+                                           approx_grad=jac is None,
                                            epsilon=1.e-6,
 #                                           pgtol
                                            #                                 options={'disp':True}
@@ -997,19 +1197,21 @@ def fitfunc_bound(func,pin,x,y,ey,pbound):
     print 'WARNING!!!',dum2['warnflag'],dum2['task']
     return out
 
-def linear_interp_error(x,xinterp,z):
+def linear_interp_error(x,xinterp,z,grid=None):
     """
     Does the actual calculation for error propagation on linear interpolation.
 
     x = xold
     xinterp = grid for interpolatin x
     z = old error spectrum
+    grid = (start, step, n) of x, if evenly spaced (see
+           grids.get_grid).  Indices are then calculated directly,
+           instead of searching x.
 
     Note, returns variance, i.e. (new error spectrum)**2
     """
 
-    i = sp.searchsorted(x,xinterp)
-    f = (xinterp - x[i -1 ])/(x[i] - x[i -1])
+    i,f = grid_index(x,xinterp,grid)
     return f**2*z[i]**2 + (1 - f)**2*z[i-1]**2
 
 def extinction(lambda1in,R,unit = 'microns'):
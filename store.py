@@ -0,0 +1,205 @@
+import scipy as sp
+from spectrum import Spectrum
+import json
+import os
+import zlib
+
+__all__ = ['RunStore','band_covar','unband_covar','store_to_text']
+
+"""
+Binary output for do_map.py.  All rescaled spectra and covariance
+matrices of a run go in one RunStore, instead of a text file for
+each.  Covariance matrices are banded (the interpolation and
+convolution only couple nearby pixels), so only the band is saved.
+"""
+
+
+def band_covar(C,tol=0.0):
+    """
+    Upper band of the symmetric matrix C, in the form used by
+    scipy.linalg.solveh_banded and cholesky_banded (lower=False):
+
+    ab[u + i - j, j] = C[i, j],  i <= j
+
+    The bandwidth u is the largest |i - j| with |C[i,j]| > tol*max(|C|).
+    Returns ab (shape (u + 1, n)).
+    """
+    n = C.shape[0]
+    cmax = sp.absolute(C).max()
+    rows,cols = sp.nonzero(sp.absolute(C) > tol*cmax)
+    u = max((cols - rows).max(),0) if rows.size > 0 else 0
+    ab = sp.zeros((u + 1,n),dtype=C.dtype)
+    for k in range(u + 1):
+        ab[u - k,k:] = sp.diagonal(C,k)
+    return ab
+
+def unband_covar(ab):
+    """
+    Full symmetric matrix from its upper band (see band_covar).
+    """
+    u = ab.shape[0] - 1
+    n = ab.shape[1]
+    C = sp.zeros((n,n),dtype=ab.dtype)
+    for k in range(u + 1):
+        d = ab[u - k,k:]
+        C[sp.r_[0:n - k],sp.r_[k:n]] = d
+        C[sp.r_[k:n],sp.r_[0:n - k]] = d
+    return C
+
+
+class RunStore(object):
+    """
+    Append-only store of arrays, for the outputs of a run.  Records
+    are written to path.bin, and indexed in path.idx (one JSON line
+    per record, with the name, offset, shape, dtype, and metadata of
+    each).  Records are added without rewriting the file, so a run
+    can add one spectrum at a time, and an interrupted run keeps
+    everything written so far.
+
+    Uncompressed records are read with memory maps, so large
+    covariance matrices are only loaded as needed.
+
+    Parameters
+    ----------
+    path = file name of the store, without the extension
+    dtype = data type of the covariance matrices (e.g., sp.float32
+            halves the size); spectra are always saved as float64
+    compress = compress each record with zlib (no memory maps)
+    tol = relative tolerance for the covariance bandwidth (see
+          band_covar), 0 keeps the covariance exact
+
+    Examples
+    --------
+    >>> store = RunStore('mapspec')
+    >>> store.put_spectrum('scale_'+spec,sout,meta=p_gauss)
+    >>> store.put_covar('covar_'+spec,covar)
+    >>> s = RunStore('mapspec').get_spectrum('scale_'+spec)
+    """
+    def __init__(self,path,dtype=sp.float64,compress=False,tol=0.0):
+        self.path = path
+        self.dtype = sp.dtype(dtype)
+        self.compress = compress
+        self.tol = tol
+        self.index = {}
+        self.names = []
+        if os.path.exists(path+'.idx'):
+            fidx = open(path+'.idx')
+            for line in fidx:
+                #skip a partly written last line
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec['name'] not in self.index:
+                    self.names.append(rec['name'])
+                self.index[rec['name']] = rec
+            fidx.close()
+
+    def __contains__(self,name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.names)
+
+    def put(self,name,data,kind='array',meta=None,**kw):
+        """
+        Append array data as record name (a record with the same name
+        is replaced in the index, but stays in the file).
+        """
+        data = sp.ascontiguousarray(data)
+        buf = data.tostring()
+        if self.compress:
+            buf = zlib.compress(buf)
+
+        fbin = open(self.path+'.bin','ab')
+        fbin.seek(0,2)
+        offset = fbin.tell()
+        fbin.write(buf)
+        fbin.close()
+
+        rec = {'name':name,'kind':kind,'offset':offset,'nbytes':len(buf),
+               'dtype':data.dtype.str,'shape':list(data.shape),
+               'compressed':self.compress,'meta':meta if meta is not None else {}}
+        rec.update(kw)
+        fidx = open(self.path+'.idx','a')
+        fidx.write(json.dumps(rec)+'\n')
+        fidx.close()
+
+        if name not in self.index:
+            self.names.append(name)
+        self.index[name] = rec
+
+    def get(self,name):
+        """
+        Array of record name (a read only memory map, if not
+        compressed).
+        """
+        rec = self.index[name]
+        shape = tuple(rec['shape'])
+        if rec['compressed']:
+            fbin = open(self.path+'.bin','rb')
+            fbin.seek(rec['offset'])
+            buf = zlib.decompress(fbin.read(rec['nbytes']))
+            fbin.close()
+            return sp.frombuffer(buf,dtype=rec['dtype']).reshape(shape)
+        if rec['nbytes'] == 0:
+            return sp.zeros(shape,dtype=rec['dtype'])
+        return sp.memmap(self.path+'.bin',dtype=rec['dtype'],mode='r',offset=rec['offset'],shape=shape)
+
+    def meta(self,name):
+        return self.index[name]['meta']
+
+    def put_spectrum(self,name,s,meta=None):
+        """
+        Save Spectrum s (wavelengths, flux, errors).  meta is a
+        dictionary, e.g., the best fit parameters.
+        """
+        self.put(name,sp.array([s.wv,s.f,s.ef],dtype=sp.float64),kind='spectrum',meta=meta)
+
+    def get_spectrum(self,name,style='linear'):
+        wv,f,ef = sp.array(self.get(name))
+        s = Spectrum(style=style)
+        s.wv = wv
+        s.f  = f
+        s.ef = ef
+        return s
+
+    def put_covar(self,name,C,meta=None):
+        """
+        Save the band of covariance matrix C (see band_covar).
+        """
+        ab = band_covar(sp.asarray(C),self.tol).astype(self.dtype)
+        self.put(name,ab,kind='covar',meta=meta,band=ab.shape[0] - 1)
+
+    def get_covar(self,name,banded=False):
+        """
+        Covariance matrix name, as a full matrix, or its band (for
+        scipy.linalg.solveh_banded) if banded=True.
+        """
+        ab = self.get(name)
+        if banded:
+            return ab
+        return unband_covar(sp.array(ab,dtype=sp.float64))
+
+    def names_of(self,kind):
+        return [ name for name in self.names if self.index[name]['kind'] == kind ]
+
+
+def store_to_text(store,outdir='.',covardir='covar_matrices'):
+    """
+    Writes the legacy text files of do_map.py from a RunStore:
+    spectra as outdir/name (same format as do_map.py), and covariance
+    matrices as outdir/covardir/name.
+    """
+    if isinstance(store,str):
+        store = RunStore(store)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    for name in store.names_of('spectrum'):
+        wv,f,ef = store.get(name)
+        sp.savetxt(os.path.join(outdir,name),sp.c_[wv,f,ef],fmt='% 6.2f % 4.4e % 4.4e')
+    covars = store.names_of('covar')
+    if len(covars) > 0 and not os.path.isdir(os.path.join(outdir,covardir)):
+        os.makedirs(os.path.join(outdir,covardir))
+    for name in covars:
+        sp.savetxt(os.path.join(outdir,covardir,name),store.get_covar(name))
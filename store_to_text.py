@@ -0,0 +1,18 @@
+import scipy as sp
+from store import *
+import sys
+
+"""
+Writes the text files of do_map.py (scale_*, scale.h._*, and
+covar_matrices/covar*) from a run store made with the 'store' option.
+"""
+
+if len(sys.argv) == 1:
+    print 'Usage:'
+    print 'python  store_to_text.py   store  [outdir]'
+    print 'store---  name of the store, without extension (e.g., mapspec for mapspec.bin and mapspec.idx)'
+    print 'outdir---  output directory (default is the current directory)'
+    sys.exit()
+
+outdir = sys.argv[2] if len(sys.argv) > 2 else '.'
+store_to_text(sys.argv[1],outdir)
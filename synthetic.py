@@ -0,0 +1,255 @@
+import scipy as sp
+from numpy import fft
+from numpy.polynomial.hermite_e import HermiteE as H
+from astropy.io import fits
+from collections import OrderedDict
+from spectrum import Spectrum
+import os
+
+__all__ = ['SyntheticSet','write_dataset']
+
+"""
+Synthetic reverberation mapping data sets, with known shifts, scales,
+and smoothing kernels, for load testing and for checking that the
+rescaling recovers the right answer.
+"""
+
+
+class SyntheticSet(object):
+    """
+    Makes a reference spectrum and any number of epochs that match it
+    after a known rescaling.
+
+    The spectrum is a linear continuum, a narrow line (the reference
+    line, like [OIII]lambda5007), and a broad line that varies from
+    epoch to epoch.  All lines are Gaussians.  The reference has a
+    resolution res (Gaussian sigma, in angstroms), and each epoch is
+    made so that the RescaleModel of the reference line with the true
+    parameters is exact (before noise), i.e.,
+
+    ref(x) = scale*(K * epoch)(x + shift)
+
+    where K is the Gauss-Hermite kernel sampled on the pixels, as in
+    RescaleModel._Hermite (for narrow kernels, this is not the same as
+    the continuous kernel with the same width, h3, and h4).  The epoch
+    is made by dividing by the Fourier transform of K, so the kernel
+    must be narrower than the reference lines (width < res is enough)
+    and h4 >= 0 (otherwise the transform of K can go through zero).
+    The only difference left is the interpolation of the shifted
+    epoch, which also smooths it: with linear interpolation, the fitted
+    width is about linear_width(p), not p['width'] (up to 8% smaller),
+    and h3 and h4 move to match.
+
+    The errors are sqrt(f*fcont)/snr, where fcont is the mean
+    continuum, so the continuum has a S/N of snr per pixel.
+
+    Epochs are made one at a time from their own random seeds, so they
+    do not depend on the order in which they are made.
+
+    Parameters
+    ----------
+    npix = number of pixels
+    dx = wavelength spacing (angstroms per pixel)
+    wv0 = first wavelength
+    res = resolution (sigma, angstroms) of the reference
+    snr = continuum S/N per pixel of the epochs (the reference has
+          snr_ref)
+    line = (center, sigma, flux) of the narrow line, default is at 65%
+           of the wavelength range, sigma 2.5 angstroms, flux 300
+    broad = (center, sigma, flux) of the broad line, default is at 45%
+            of the wavelength range, sigma 40 angstroms, flux 3000
+    cont = (continuum level at the center, slope per angstrom)
+    variability = fractional rms of the broad line flux
+    shift, scale, width, h3, h4 = (low, high) limits of the uniform
+                                  distributions of the true parameters
+    seed = random seed of the whole set
+
+    Examples
+    --------
+    >>> S = SyntheticSet(npix=2000,snr=30.)
+    >>> sref = S.reference()
+    >>> p = S.draw(0)
+    >>> s = S.epoch(p)
+    """
+    def __init__(self,npix=1033,dx=1.25,wv0=4500.,res=3.0,snr=50.,snr_ref=300.,
+                 line=None,broad=None,cont=(10.,0.0),variability=0.2,
+                 shift=(-3.,3.),scale=(0.7,1.3),width=(0.75,2.5),h3=(-0.1,0.1),h4=(0.0,0.1),
+                 seed=1):
+        self.npix = npix
+        self.dx = dx
+        self.wv = wv0 + dx*sp.r_[0:npix]
+        self.res = res
+        self.snr = snr
+        self.snr_ref = snr_ref
+        wrange = self.wv[-1] - self.wv[0]
+        if line is None:
+            line = (self.wv[0] + 0.65*wrange,2.5,300.)
+        if broad is None:
+            broad = (self.wv[0] + 0.45*wrange,40.,3000.)
+        self.line = line
+        self.broad = broad
+        self.cont = cont
+        self.variability = variability
+        self.limits = OrderedDict([('shift',shift),('scale',scale),('width',width),('h3',h3),('h4',h4)])
+        self.seed = seed
+
+        if width[1] >= sp.sqrt(line[1]**2 + res**2):
+            raise ValueError('Kernel width must be less than the width of the reference line')
+        if h4[0] < 0:
+            raise ValueError('h4 must be >= 0')
+
+        #padded FFT grid, so that the lines do not wrap around
+        self._nfft = int(2**sp.ceil(sp.log2(2*npix)))
+        self._u = 2*sp.pi*fft.rfftfreq(self._nfft,dx)
+
+    def window(self):
+        """
+        Window file for the narrow line (see EmissionLine): the line
+        is +/- 5 sigma of the reference line, and the continuum
+        windows are 15 angstroms wide, 5 angstroms away on either
+        side.
+        """
+        cent,sig,flux = self.line
+        half = 5*sp.sqrt(sig**2 + self.res**2)
+        out = sp.array([[cent - half,cent + half],
+                        [cent - half - 20.,cent - half - 5.],
+                        [cent + half + 5.,cent + half + 20.]])
+        if out.min() < self.wv[0] or out.max() > self.wv[-1]:
+            raise ValueError('Line window is outside of the spectrum---use more pixels')
+        return out
+
+    def draw(self,i):
+        """
+        True parameters of epoch i.  'var' is the relative flux of the
+        broad line.
+        """
+        rs = sp.random.RandomState([self.seed,i])
+        p = OrderedDict([ (key,rs.uniform(*lim)) for key,lim in self.limits.items() ])
+        p['var'] = max(1. + self.variability*rs.randn(),0.0)
+        p['seed'] = rs.randint(2**31)
+        return p
+
+    def reference(self):
+        """
+        Reference spectrum, with errors (but no noise added).
+        """
+        p = {'shift':0.0,'scale':1.0,'width':0.0,'h3':0.0,'h4':0.0,'var':1.0}
+        return self._make(p,self.snr_ref,None)
+
+    def epoch(self,p,noise=True):
+        """
+        Epoch with true parameters p (from draw), with noise drawn
+        from p['seed'].
+        """
+        if noise:
+            return self._make(p,self.snr,sp.random.RandomState(p['seed']))
+        return self._make(p,self.snr,None)
+
+    def linear_width(self,p):
+        """
+        Width expected from a fit with linear interpolation.  Linear
+        interpolation at a fraction r of a pixel adds a variance of
+        r*(1 - r)*dx**2 to the kernel, which the fitted kernel makes up
+        for.
+        """
+        r = (p['shift']/self.dx) % 1.0
+        return sp.sqrt(max(p['width']**2 - r*(1 - r)*self.dx**2,0.0))
+
+    def _lines(self,p):
+        #Fourier transform of the lines, as they appear in the
+        #reference, shifted and divided by the kernel
+        u = self._u
+        khat = self._kernel(p)
+        fhat = sp.zeros(u.size,dtype=complex)
+        for (cent,sig,flux),var in [(self.line,1.0),(self.broad,p['var'])]:
+            s2 = sig**2 + self.res**2
+            x = cent + p['shift'] - self.wv[0]
+            fhat += flux*var*sp.exp(-1j*u*x - 0.5*u**2*s2)
+        return fft.irfft(fhat/khat,self._nfft)[0:self.npix]/self.dx
+
+    def _kernel(self,p):
+        #Fourier transform of the kernel, sampled and normalized as in
+        #RescaleModel._Hermite, and centered on pixel 0
+        if p['width'] == 0:
+            return 1.0
+        pixwidth = p['width']/self.dx
+        half = int(sp.ceil(10*pixwidth))
+        prange = sp.r_[-half:half + 1]
+        k = sp.exp(-0.5*prange**2/pixwidth**2)*H([ 1.0, 0.0, 0.0,p['h3'],p['h4'] ])(prange/pixwidth)
+        k /= abs(sp.sum(k))
+        return fft.rfft(sp.roll(sp.r_[k,sp.zeros(self._nfft - k.size)],-half))
+
+    def _make(self,p,snr,rs):
+        c0,slope = self.cont
+        x = self.wv - p['shift']
+        fcont = c0 + slope*(x - self.wv.mean())
+        f = (fcont + self._lines(p))/p['scale']
+        ef = sp.sqrt(sp.absolute(f)*c0/p['scale'])/snr
+        if rs is not None:
+            f = f + ef*rs.randn(self.npix)
+
+        s = Spectrum(style='linear')
+        s.wv = self.wv.copy()
+        s.f = f
+        s.ef = ef
+        return s
+
+
+def _save_fits(ofile,s,clobber=True):
+    #same layout as IRAF multispec output, so FitsSpec reads it with
+    #its default keywords (flux in band 2, errors in band 4)
+    data = sp.array([ [s.f],[s.f],[sp.zeros(s.f.size)],[s.ef] ],dtype=sp.float32)
+    head = fits.Header()
+    head['CRVAL1'] = s.wv[0]
+    head['CD1_1'] = s.wv[1] - s.wv[0]
+    head['CRPIX1'] = 1
+    fits.writeto(ofile,data,header=head,clobber=clobber)
+
+def write_dataset(outdir,S,nepoch,fmt='text',prefix='synth',start=0,verbose=False):
+    """
+    Writes the reference (ref.txt), window file (synth.window), and
+    nepoch epochs of SyntheticSet S to directory outdir, with a
+    speclist (one file name per line, relative to outdir) and a table
+    of the true parameters (truth.dat).  truth.dat also has the width
+    that fits with linear interpolation should find (width_lin, see
+    SyntheticSet.linear_width).
+
+    Epochs are written as they are made, so the memory does not grow
+    with nepoch.  Epoch i is named prefix_NNNNNN.txt (or .fits, for
+    fmt='fits'), and start is the first i---use it to add more epochs
+    to an existing data set.
+
+    Note that do_map.py first removes the cross correlation shift, so
+    the true shift is the sum of that and the fitted shift.
+    """
+    if fmt not in ['text','fits']:
+        raise ValueError('Unknown format: '+fmt)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    ext = '.txt' if fmt == 'text' else '.fits'
+
+    sref = S.reference()
+    sp.savetxt(os.path.join(outdir,'ref.txt'),sp.c_[sref.wv,sref.f,sref.ef])
+    sp.savetxt(os.path.join(outdir,prefix+'.window'),S.window(),fmt='%.4f')
+
+    mode = 'w' if start == 0 else 'a'
+    flist = open(os.path.join(outdir,'speclist'),mode)
+    ftruth = open(os.path.join(outdir,'truth.dat'),mode)
+    if start == 0:
+        ftruth.write('#%19s %10s %10s %10s %10s %10s %10s %10s\n'%('name','shift','scale','width','h3','h4','var','width_lin'))
+
+    for i in range(start,start + nepoch):
+        name = '%s_%06d%s'%(prefix,i,ext)
+        p = S.draw(i)
+        s = S.epoch(p)
+        if fmt == 'text':
+            sp.savetxt(os.path.join(outdir,name),sp.c_[s.wv,s.f,s.ef])
+        else:
+            _save_fits(os.path.join(outdir,name),s)
+        flist.write(name+'\n')
+        ftruth.write('%20s % 10.5f %10.5f %10.5f % 10.5f % 10.5f %10.5f %10.5f\n'%
+                     (name,p['shift'],p['scale'],p['width'],p['h3'],p['h4'],p['var'],S.linear_width(p)))
+        if verbose and (i + 1) % 1000 == 0:
+            print i + 1
+    flist.close()
+    ftruth.close()
@@ -0,0 +1,132 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import scipy as sp
+from mapspec import save_profiles
+from store import RunStore
+from runner import MapRunner,read_spec,parse_options,run_parallel
+from fnmatch import fnmatch
+
+import sys,os,time
+
+"""
+Watches a directory for new spectra during a campaign, and rescales
+each one as soon as it is written, with the same fits as do_map.py.
+The reference line is made once and kept in memory, so each new
+spectrum only costs its own fits.
+
+The directory is polled every 'poll' seconds (default 10).  A file
+is processed once its size and modification time have not changed
+between two polls, so that spectra still being copied are not read.
+Spectra already in the parameter file are skipped, so the watcher can
+be stopped (Ctrl-C) and restarted.  With 'once', every spectrum in
+the directory is processed and the watcher exits.
+
+Spectra are read with TextSpec, or FitsSpec for .fits files (see
+runner.read_spec).  The other arguments and the options are the same
+as do_map.py (see runner.parse_options), except 'prefetch': spectra
+are read as they arrive.  With 'store', all outputs are appended to
+one RunStore, and with 'nproc=N', the spectra found at each poll are
+fit by N worker processes.
+"""
+
+if len(sys.argv) < 8:
+    print 'Usage:'
+    print 'python  watch_map.py   ref.txt  window  istyle  watchdir  mapspec.params  covar|no_covar  chains|no_chains  [options]'
+    print 'options---  any of do_map.py (see runner.parse_options) except prefetch,'
+    print '            poll=seconds (default 10), pattern=glob (default *.txt), once'
+    sys.exit()
+
+istyle = sys.argv[3]
+sref   = read_spec(sys.argv[1],style=istyle)
+window = sp.genfromtxt(sys.argv[2])
+watchdir = sys.argv[4]
+params = sys.argv[5]
+get_covar = sys.argv[6] == 'covar'
+get_chains = sys.argv[7] == 'chains'
+
+kw,run = parse_options(sys.argv[8:],extra=('poll','pattern','once'))
+if run['prefetch']:
+    raise ValueError('watch_map.py reads spectra as they arrive, so prefetch is not used')
+once = run.get('once',False)
+poll = float(run.get('poll',10.))
+pattern = run.get('pattern','*.txt')
+
+if run['store']:
+    store = RunStore(os.path.splitext(params)[0],
+                     dtype=sp.float32 if run['float32'] else sp.float64,
+                     compress=run['compress'])
+else:
+    store = None
+
+#spectra that are already done (first column of the parameter file)
+done = set()
+if os.path.exists(params):
+    for line in open(params):
+        if line.strip() != '':
+            done.add(line.split()[0])
+print '%d spectra already in %s'%(len(done),params)
+
+fout = open(params,'a')
+runner = MapRunner(sref,window,istyle,fout=fout,store=store,
+                   get_covar=get_covar,get_chains=get_chains,**kw)
+
+#(size, mtime) of each file at the last poll, and files that failed
+last = {}
+failed = set()
+nrun = 0
+try:
+    while True:
+        files = []
+        for name in os.listdir(watchdir):
+            path = os.path.join(watchdir,name)
+            if not fnmatch(name,pattern) or name in done or name in failed or not os.path.isfile(path):
+                continue
+            if os.path.abspath(path) == os.path.abspath(sys.argv[1]):
+                continue
+            st = os.stat(path)
+            now = (st.st_size,st.st_mtime)
+            #wait until the file stops changing
+            if once or last.get(name) == now:
+                files.append((st.st_mtime,name))
+            last[name] = now
+
+        if run['nproc'] > 1 and len(files) > 0:
+            t0 = time.time()
+            for out in run_parallel(runner,[ os.path.join(watchdir,name) for mtime,name in sorted(files) ],run['nproc']):
+                if 'error' in out:
+                    failed.add(out['name'])
+                else:
+                    done.add(out['name'])
+                    nrun += 1
+            print '%d spectra done in %.1f s'%(len(files),time.time() - t0)
+            files = []
+
+        for mtime,name in sorted(files):
+            print name
+            t0 = time.time()
+            try:
+                runner.run(os.path.join(watchdir,name))
+            except Exception as e:
+                print 'Failed on %s: %s'%(name,e)
+                failed.add(name)
+                continue
+            done.add(name)
+            nrun += 1
+            print '%s done in %.1f s'%(name,time.time() - t0)
+
+        if once:
+            break
+        time.sleep(poll)
+except KeyboardInterrupt:
+    print 'Stopping'
+finally:
+    fout.close()
+
+print '%d new spectra, %d failed'%(nrun,len(failed))
+if runner.get_profile and nrun > 0:
+    run_profiles = runner.profile_summary()
+    save_profiles('profiles/run.profile.json',run_profiles)
+    for key in sorted(run_profiles.keys()):
+        print key
+        print run_profiles[key].summary()